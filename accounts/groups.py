@@ -0,0 +1,74 @@
+"""Cached group membership of users.
+
+The names of the groups a user belongs to are loaded with one query the first
+time they are needed in a request and kept on the user instance for the rest of
+the request. They are also kept in the cache for settings.GROUP_CACHE_TIMEOUT
+seconds, under a key carrying a version of the membership of the user.
+
+The signal handlers in accounts.models call invalidate when the membership of a
+user changes, from either side of the relation, or a group is renamed or
+deleted. invalidate increments the version instead of deleting the cached names,
+so names read from the database before a change, and cached after it, are stored
+under the old version and never read.
+
+The version is only seen by the processes which share the cache. With the default
+local memory cache the other processes keep the names they cached for up to
+settings.GROUP_CACHE_TIMEOUT seconds, so deployments running more than one
+process must configure a shared cache, see CACHES in gameHub.settings.
+
+Used by game.decorators.group_required and the in_group template filter.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+CACHE_KEY = 'accounts.groups.{0}.{1}'
+VERSION_KEY = 'accounts.groups.{0}.version'
+
+def _version(user_id):
+    """Returns the version of the membership of a user.
+    """
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 0, None)
+        version = cache.get(key, 0)
+    return version
+
+def group_names(user):
+    """Returns a frozenset with the names of the groups a user belongs to.
+    Anonymous users belong to no groups.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    names = getattr(user, '_group_names', None)
+    if names is None:
+        timeout = settings.GROUP_CACHE_TIMEOUT
+        if timeout:
+            #read before the database, a change made meanwhile moves the version on
+            key = CACHE_KEY.format(user.pk, _version(user.pk))
+            names = cache.get(key)
+        if names is None:
+            names = frozenset(user.groups.values_list('name', flat=True))
+            if timeout:
+                cache.set(key, names, timeout)
+        user._group_names = names
+    return names
+
+def in_group(user, *groups):
+    """Tells if a user belongs to at least one of the groups, given by name.
+    """
+    return not group_names(user).isdisjoint(groups)
+
+def invalidate(*user_ids):
+    """Moves the membership of users to a new version, so that their cached group
+    names are no longer used.
+    """
+    for user_id in user_ids:
+        key = VERSION_KEY.format(user_id)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            #evicted since added
+            cache.add(key, 1, None)
@@ -1,18 +1,30 @@
+from django.core.files.storage import default_storage
 from django.db import models
-from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import post_save, pre_delete, m2m_changed
 from django.dispatch import receiver
 
+from . import groups
+
 # Create your models here.
 #
 def user_directory_path(instance, filename):
     return 'user_{0}/profile/{1}'.format(instance.user.id, filename)
 
+DEFAULT_IMAGE = 'default_profile_pic.jpg'
+
+def delete_image(name):
+    """Deletes a profile image from storage, unless it is the image shared by all
+    profiles by default.
+    """
+    if name and name != DEFAULT_IMAGE:
+        default_storage.delete(name)
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     nickname = models.CharField(max_length=20, blank=True)
     description = models.TextField(blank=True)
-    image = models.ImageField(null=True, upload_to = user_directory_path, default = 'default_profile_pic.jpg', blank=True)
+    image = models.ImageField(null=True, upload_to = user_directory_path, default = DEFAULT_IMAGE, blank=True)
     
     @classmethod
     def create(cls, name, nickname='', description='', image=None):
@@ -34,3 +46,38 @@ def update_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
     instance.profile.save()
+
+@receiver(pre_delete, sender=Profile)
+def delete_profile_image(sender, instance, **kwargs):
+    delete_image(instance.image.name)
+
+@receiver(m2m_changed, sender=User.groups.through)
+def update_group_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidates the cached group names of the users whose groups change, whether
+    through user.groups or group.user_set.
+
+    The members of a group cleared through group.user_set are gone after the
+    clear, so they are collected before it.
+    """
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            groups.invalidate(*pk_set)
+        else:
+            groups.invalidate(instance.pk)
+    elif action == 'pre_clear' and reverse:
+        instance._cleared_user_ids = list(instance.user_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        if reverse:
+            groups.invalidate(*getattr(instance, '_cleared_user_ids', ()))
+            instance._cleared_user_ids = ()
+        else:
+            groups.invalidate(instance.pk)
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def update_group(sender, instance, **kwargs):
+    """Invalidates the cached group names of the members of a group that is renamed
+    or deleted.
+    """
+    if instance.pk is not None:
+        groups.invalidate(*instance.user_set.values_list('pk', flat=True))
@@ -1,10 +1,22 @@
 import pdb
 
-from django.test import TestCase, Client
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from PIL import Image
+
+from django.core.files.storage import default_storage
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.template.loader import render_to_string
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User, Group
+from django.core.cache import cache
+from game.models import Game
+from gameHub.settings import ImageSizeEnum
+from game import catalog
+from . import groups
 from .forms import RegisterForm
 
 
@@ -53,7 +65,145 @@ class TemplateTestCase(TestCase):
         group = Group.objects.get(name='Developer')
         self.assertTrue(group.user_set.filter(username='testuser3').exists())
     
+    def testRegistrationImage(self):
+        """Checks that the profile image is resized and stored"""
+        image = BytesIO()
+        Image.new('RGB', (800, 600), (10, 20, 30)).save(image, 'PNG')
+        data = {'username': 'testuser4', 'password1': 'VeryStrong', 'password2': 'VeryStrong', 'email': 'testuser4@mail.com', 'nickname': 'tuser4', 'description':'Awesome',
+            'image': SimpleUploadedFile('me.png', image.getvalue(), content_type='image/png')}
+        media_root = mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.client.post(reverse('accounts:register'), data)
+                profile_image = User.objects.get(username='testuser4').profile.image
+                self.assertTrue(default_storage.exists(profile_image.name))
+                with default_storage.open(profile_image.name) as stored:
+                    self.assertEquals(Image.open(stored).size, ImageSizeEnum.PROFILE.value)
+        finally:
+            rmtree(media_root)
+
     # def testGroupRegistration(self):
     #     res = self.client.post(reverse('accounts:login'), {'username': 'testuser3', 'password': 'password3'}, follow=True)
     #     response = self.client.post('/accounts/choosegroup', {'group': 0})
     #     print (response)
+
+
+class HomeViewTest(TestCase):
+    """Tests the paging and the carousel of the home page"""
+    def setUp(self):
+        """Set up games with increasing popularity"""
+        cache.clear()
+        self.client = Client()
+        developer = User.objects.create_user(username='developer', password='password')
+        for i in range(30):
+            Game.create(title='game{}'.format(i), url='http://foobar.fi', developer=developer).save()
+        Game.objects.filter(title__in=['game{}'.format(i) for i in range(20)]).update(popularity=1.0)
+
+    def testPaging(self):
+        """Checks that pages hold 12 games, and that the game count is cached"""
+        response = self.client.get(reverse('accounts:home'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(response.context['games']), 12)
+        response = self.client.get(reverse('accounts:home'), {'page': 3})
+        self.assertEquals(len(response.context['games']), 6)
+        response = self.client.get(reverse('accounts:home'), {'page': 'foo'})
+        self.assertEquals(response.context['games'].number, 1)
+        # the page of games and the carousel games, the count and top games are cached
+        with self.assertNumQueries(2):
+            self.client.get(reverse('accounts:home'), {'page': 2})
+
+    def testCountInvalidation(self):
+        """Checks that the cached count follows created and deleted games"""
+        self.assertEquals(catalog.game_count(), 30)
+        Game.create(title='new game', url='http://foobar.fi', developer=None).save()
+        self.assertEquals(catalog.game_count(), 31)
+        Game.objects.get(title='new game').delete()
+        self.assertEquals(catalog.game_count(), 30)
+
+    def testCarousel(self):
+        """Checks that the carousel games are picked from the most popular games"""
+        popular = {'game{}'.format(i) for i in range(20)}
+        for i in range(5):
+            response = self.client.get(reverse('accounts:home'))
+            carousel = response.context['carousel_games']
+            self.assertEquals(len(carousel), 3)
+            self.assertTrue({game.title for game in carousel} <= popular)
+
+
+class GroupMembershipTest(TestCase):
+    """Tests the cached group membership"""
+    def setUp(self):
+        """Set up a player"""
+        cache.clear()
+        self.user = User.objects.create_user(username='player', password='password')
+        Group.objects.get(name='Player').user_set.add(self.user)
+
+    def fresh_user(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def testCaching(self):
+        """Checks that the group names are looked up once and then cached"""
+        with self.assertNumQueries(1):
+            self.assertEquals(groups.group_names(self.user), frozenset(['Player']))
+            self.assertTrue(groups.in_group(self.user, 'Player', 'Developer'))
+            self.assertFalse(groups.in_group(self.user, 'Developer'))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(groups.in_group(user, 'Player'))
+
+    @override_settings(GROUP_CACHE_TIMEOUT=0)
+    def testNoCaching(self):
+        """Checks that the group names are looked up once per request without the cache"""
+        groups.group_names(self.user)
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertTrue(groups.in_group(user, 'Player'))
+
+    def testMembershipChanges(self):
+        """Checks that membership changes from either side invalidate the cache"""
+        groups.group_names(self.user)
+        Group.objects.get(name='Developer').user_set.add(self.user)
+        self.assertTrue(groups.in_group(self.fresh_user(), 'Developer'))
+        self.user.groups.remove(Group.objects.get(name='Player'))
+        self.assertFalse(groups.in_group(self.fresh_user(), 'Player'))
+        Group.objects.get(name='Developer').user_set.clear()
+        self.assertEquals(groups.group_names(self.fresh_user()), frozenset())
+        self.user.groups.add(Group.objects.get(name='Player'))
+        self.assertTrue(groups.in_group(self.fresh_user(), 'Player'))
+        Group.objects.get(name='Player').user_set.remove(self.user)
+        self.assertFalse(groups.in_group(self.fresh_user(), 'Player'))
+        self.user.groups.add(Group.objects.get(name='Developer'))
+        groups.group_names(self.fresh_user())
+        self.user.groups.clear()
+        self.assertEquals(groups.group_names(self.fresh_user()), frozenset())
+
+    def testGroupChanges(self):
+        """Checks that renaming or deleting a group invalidates the cache of its members"""
+        groups.group_names(self.user)
+        group = Group.objects.create(name='Tester')
+        group.user_set.add(self.user)
+        groups.group_names(self.fresh_user())
+        group.name = 'Reviewer'
+        group.save()
+        self.assertTrue(groups.in_group(self.fresh_user(), 'Reviewer'))
+        group.delete()
+        self.assertEquals(groups.group_names(self.fresh_user()), frozenset(['Player']))
+
+    def testStaleNames(self):
+        """Checks that names read before a change, and cached after it, are not used"""
+        user = self.fresh_user()
+        version = groups._version(user.pk)
+        stale = frozenset(user.groups.values_list('name', flat=True))
+        self.user.groups.add(Group.objects.get(name='Developer'))
+        cache.set(groups.CACHE_KEY.format(user.pk, version), stale)
+        self.assertTrue(groups.in_group(self.fresh_user(), 'Developer'))
+
+    def testUploadRequiresDeveloper(self):
+        """Checks group_required against the membership"""
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse('game:upload'))
+        self.assertEquals(response.status_code, 302)
+        self.user.groups.add(Group.objects.get(name='Developer'))
+        response = client.get(reverse('game:upload'))
+        self.assertEquals(response.status_code, 200)
@@ -1,7 +1,5 @@
 import pdb
-from random import shuffle
 
-import ast
 from django.db.models import Sum
 from django.shortcuts import render, redirect
 from django.http import Http404
@@ -16,11 +14,14 @@ from django.core import signing
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.views import View
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.paginator import EmptyPage, PageNotAnInteger
 
 from gameHub.settings import ImageSizeEnum
 from .forms import RegisterForm, GroupChoiceForm, ProfileUpdateForm
+from .models import delete_image
 from game.models import Game, PaymentDetail, GamePlayed
+from game.catalog import CatalogPaginator, random_top_games
+from game import savestate
 
 
 # Create your views here.
@@ -36,7 +37,9 @@ class RegisterView(CreateView):
             user.refresh_from_db()  # load the profile instance created by the signal
             tmp_img = form.cleaned_data.get('image')
             if tmp_img is not None:
-                user.profile.image = Game.resize_image( tmp_img, tmp_img.name, ImageSizeEnum.PROFILE)
+                #the resized image is a temporary file, stored before it is closed
+                with Game.resize_image(tmp_img, tmp_img.name, ImageSizeEnum.PROFILE) as profile_image:
+                    user.profile.image.save(profile_image.name, profile_image, save=False)
             else:
                 user.profile.image = form.cleaned_data.get('image')
             user.profile.description = form.cleaned_data.get('description')
@@ -94,14 +97,19 @@ class ProfileUpdateView(UpdateView):
         form = self.get_form(form_class)
         if form.is_valid():
             user = form.save(commit=False)
+            old_image = user.profile.image.name
             tmp_img = form.cleaned_data.get('image')
             if tmp_img is not None:
-                user.profile.image = Game.resize_image(tmp_img, tmp_img.name, ImageSizeEnum.PROFILE)
+                #the resized image is a temporary file, stored before it is closed
+                with Game.resize_image(tmp_img, tmp_img.name, ImageSizeEnum.PROFILE) as profile_image:
+                    user.profile.image.save(profile_image.name, profile_image, save=False)
             else:
                 user.profile.image = form.cleaned_data.get('image')
             user.profile.description = form.cleaned_data.get('description')
             user.profile.nickname = form.cleaned_data.get('nickname')
             user.save()
+            if user.profile.image.name != old_image:
+                delete_image(old_image)
             login(request, user, backend='django.contrib.auth.backends.ModelBackend')
             return redirect(reverse('accounts:detail', kwargs={'pk':self.request.user.id}))
         else:
@@ -129,16 +137,11 @@ class ProfileDetailView(DetailView):
         context = super(ProfileDetailView, self).get_context_data(**kwargs)
         #add what is needed in profiledetails
         developed_games = Game.objects.filter(developer=self.request.user)
-        played_games = self.request.user.gameplayed_set.all()
-        for played_game in played_games:
-            try:
-                dictionary=ast.literal_eval(played_game.gameState)
-                dictionary = dictionary['gameState']
-                played_game.score =  dictionary['score']
-                played_game.playedItems = dictionary['playerItems']
-                #played_game.score = dictionary['score']
-            except TypeError:
-                played_game.gameState = 'No Stats'
+        #the saved scores and items are read from their own columns, the game states
+        #are not loaded
+        played_games = (self.request.user.gameplayed_set
+            .select_related('game')
+            .defer(*savestate.STATE_FIELDS))
         for game in developed_games:
             game.total_earn = game.sellcount * game.price
         context['developed_games'] = developed_games
@@ -148,26 +151,36 @@ class ProfileDetailView(DetailView):
 
 class ProfileStatisticsView(View):
     def get(self, request, **args):
-        return render(request, template_name='accounts/statistic_details.html', context={'game': Game.objects.get(id=args.get('game'))})
+        game = Game.objects.get(id=args.get('game'))
+        context = {
+            'game': game,
+            'played_games': game.gameplayed_set.defer(*savestate.STATE_FIELDS),
+            'save_metrics': savestate.metrics(game),
+        }
+        return render(request, template_name='accounts/statistic_details.html', context=context)
 
 
 class HomeView(View):
     def get(self, request):
-        # Creates a lazy queryset, queryset are evaluated when used (no memory waste)
-        games = list(Game.objects.all())
+        # Creates a lazy queryset, only the games on the requested page are loaded
+        sort = request.GET.get('sort')
+        if sort in Game.SORT_ORDERS:
+            games = Game.objects.order_by(*Game.SORT_ORDERS[sort])
+        else:
+            sort = None
+            games = Game.objects.order_by('viewcount', 'sellcount', 'pk')
         page = request.GET.get('page', 1)
-        # slice the queryset in pages of 12 elements
-        paginator = Paginator(games, 12)
+        # slice the queryset in pages of 12 elements, the number of games is cached
+        paginator = CatalogPaginator(games, 12)
         try:
             games = paginator.page(page)
         except PageNotAnInteger:
             games = paginator.page(1)
         except EmptyPage:
             games = paginator.page(paginator.num_pages)
-        top_20_games = list(games[:20])
-        shuffle(top_20_games) #shuffle the top 20 games
-        carousel_games=top_20_games[:3] #choose only three
-        return render(request, template_name='gamehub/home.html', context={'carousel_games': carousel_games, 'games':games})
+        # choose three games at random from the precomputed top 20 by popularity
+        carousel_games = random_top_games(3)
+        return render(request, template_name='gamehub/home.html', context={'carousel_games': carousel_games, 'games':games, 'sort': sort})
 
 
 class ChooseGroupView(View):
@@ -0,0 +1,126 @@
+"""Pagination for the api views.
+
+By default the views are paginated with the LimitOffsetPagination configured in
+settings.REST_FRAMEWORK. Clients can opt in to keyset pagination, which costs the
+same for every page however deep into the results it is, by passing
+'pagination=cursor' on the first request. The response then has the form:
+
+    {"next": "<url of the next page or null>", "results": [...]}
+
+and the next url carries an opaque 'cursor' parameter. The page size is given with
+'limit', as with the default pagination.
+
+Keyset pagination follows the ordering given with 'order_by', with the primary
+key as tie-breaker. Without 'order_by' the results are ordered by primary key.
+"""
+
+from collections import OrderedDict
+
+from django.core import signing
+from django.db.models import Q
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+class KeysetPagination(BasePagination):
+    """Paginates by filtering on the ordering key of the last object of the
+    previous page, rather than by offset.
+    """
+
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    max_limit = 1000
+    salt = 'api.pagination.cursor'
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE
+        return max(1, min(limit, self.max_limit))
+
+    def get_ordering(self, queryset):
+        """Returns the field to order by, and whether the order is descending.
+        """
+        order_by = queryset.query.order_by
+        if not order_by:
+            return 'pk', False
+        ordering = order_by[0]
+        if ordering[0] == '-':
+            return ordering[1:], True
+        return ordering, False
+
+    def encode_cursor(self, field, descending, obj):
+        value = getattr(obj, field)
+        if not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        return signing.dumps(
+            {'o': field, 'd': descending, 'v': value, 'pk': obj.pk},
+            salt=self.salt
+        )
+
+    def decode_cursor(self, cursor, field, descending, model):
+        """Returns the ordering value and primary key stored in a cursor. Raises
+        NotFound if the cursor is invalid or was made for another ordering.
+        """
+        try:
+            data = signing.loads(cursor, salt=self.salt)
+        except signing.BadSignature:
+            raise NotFound('Invalid cursor')
+        if data.get('o') != field or data.get('d') != descending:
+            raise NotFound('Invalid cursor')
+        value = data['v']
+        if field != 'pk':
+            value = model._meta.get_field(field).to_python(value)
+        return value, data['pk']
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        field, descending = self.get_ordering(queryset)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor, field, descending, queryset.model)
+            if field == 'pk':
+                after = Q(pk__lt=pk) if descending else Q(pk__gt=pk)
+            elif descending:
+                after = Q(**{field + '__lt': value}) | Q(**{field: value, 'pk__lt': pk})
+            else:
+                after = Q(**{field + '__gt': value}) | Q(**{field: value, 'pk__gt': pk})
+            queryset = queryset.filter(after)
+        if field == 'pk':
+            ordering = ('-pk',) if descending else ('pk',)
+        else:
+            ordering = ('-' + field, '-pk') if descending else (field, 'pk')
+        page = list(queryset.order_by(*ordering)[:self.limit + 1])
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        self.next_cursor = (self.encode_cursor(field, descending, page[-1])
+            if self.has_next else None)
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.next_cursor
+        )
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+def pagination_class_for(request):
+    """Returns the pagination class a request asks for.
+    """
+    params = request.query_params
+    if params.get('pagination') == 'cursor' or KeysetPagination.cursor_query_param in params:
+        return KeysetPagination
+    return api_settings.DEFAULT_PAGINATION_CLASS
@@ -23,6 +23,7 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ('username', 'profile')
         ordering_fields = ('username',)
+        select_related = ('profile',)
     
     profile = ProfileSerializer(many=False, read_only=True)
 
@@ -59,6 +60,7 @@ class GameSerializer(serializers.ModelSerializer):
             'popularity',
             'revenue'
         )
+        select_related = ('developer',)
     
     developer = serializers.SlugRelatedField(
         slug_field='username',
@@ -75,6 +77,7 @@ class GamePlayedSerializer(serializers.ModelSerializer):
         model = GamePlayed
         fields = ('game', 'gameScore', 'rating')
         ordering_fields = ('gameScore', 'rating')
+        select_related = ('game',)
     
     game = serializers.SlugRelatedField(
         slug_field='title',
@@ -90,6 +93,7 @@ class UserGamePlayedSerializer(serializers.ModelSerializer):
         model = GamePlayed
         fields = ('user', 'gameScore', 'rating')
         ordering_fields = ('gameScore', 'rating')
+        select_related = ('user',)
     
     user = serializers.SlugRelatedField(
         slug_field='username',
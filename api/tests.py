@@ -1,6 +1,8 @@
 import logging
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User, Group
 from django.utils.six import BytesIO
@@ -301,3 +303,152 @@ class SortByTest(TestCase):
         content = self.parser.parse(BytesIO(response.content))
         for i in range(4):
             self.assertEquals(content['results'][i]['user'], 'ply{}'.format(3 - i))
+
+
+class QueryCountTest(TestCase):
+    """Tests that the number of queries of each endpoint does not depend on the
+    number of results on the page.
+    """
+    
+    def setUp(self):
+        
+        logger.debug('QueryCountTest.setUp')
+        
+        self.client = APIClient()
+        
+        self.dev_group = Group.objects.get(name='Developer')
+        self.ply_group = Group.objects.get(name='Player')
+        
+        self.developer = User.objects.create(username='dev')
+        self.developer.save()
+        self.dev_group.user_set.add(self.developer)
+        self.player = User.objects.create(username='ply')
+        self.player.save()
+        self.ply_group.user_set.add(self.player)
+        self.count = 0
+    
+    def addData(self, n):
+        """Adds n developers, players and games, the games bought by the player.
+        """
+        for i in range(self.count, self.count + n):
+            developer = User.objects.create(username='dev{}'.format(i))
+            developer.save()
+            self.dev_group.user_set.add(developer)
+            player = User.objects.create(username='ply{}'.format(i))
+            player.save()
+            self.ply_group.user_set.add(player)
+            game = Game.create(
+                title='game{}'.format(i),
+                url='http://foobar.fi',
+                developer=self.developer
+            )
+            game.save()
+            buy_game_for_user(self.player, game)
+            buy_game_for_user(player, Game.objects.get(title='game0'))
+        self.count += n
+    
+    def countQueries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, None, format='json')
+        self.assertEquals(response.status_code, 200)
+        return len(queries)
+    
+    def testQueryCounts(self):
+        
+        urls = [
+            reverse('api:user-list', args=['v1']),
+            reverse('api:developer-list', args=['v1']),
+            reverse('api:game-list', args=['v1']),
+            reverse('api:user-games', args=['v1', 'ply']),
+            reverse('api:developer-games', args=['v1', 'dev']),
+            reverse('api:game-buyers', args=['v1', 'game0']),
+        ]
+        self.addData(2)
+        counts = [self.countQueries(url) for url in urls]
+        self.addData(8)
+        self.assertEquals([self.countQueries(url) for url in urls], counts)
+
+
+class CursorPaginationTest(TestCase):
+    """Tests the opt-in keyset pagination.
+    """
+    
+    def setUp(self):
+        
+        logger.debug('CursorPaginationTest.setUp')
+        
+        self.client = APIClient()
+        self.parser = JSONParser()
+        
+        developer = User.objects.create(username='dev')
+        developer.save()
+        
+        for i in range(25):
+            game = Game.create(
+                title='game{:02}'.format(i),
+                url='http://foobar.fi',
+                developer=developer,
+                price=1 + i % 4
+            )
+            game.save()
+            buy_game_for_user(developer, game)
+    
+    def fetchAll(self, url, params):
+        """Follows the next links from url, returns the results and the number of
+        pages.
+        """
+        results = []
+        pages = 0
+        response = self.client.get(url, params, format='json')
+        while True:
+            self.assertEquals(response.status_code, 200)
+            content = self.parser.parse(BytesIO(response.content))
+            self.assertTrue(len(content['results']) <= params['limit'])
+            results += content['results']
+            pages += 1
+            if content['next'] is None:
+                return results, pages
+            response = self.client.get(content['next'], format='json')
+    
+    def testOrderings(self):
+        """Tests that paging through all results gives every game once, in the
+        requested order, with ties broken consistently.
+        """
+        url = reverse('api:game-list', args=['v1'])
+        for order_by in [None, 'title', '-title', 'price', '-price', 'upload_date']:
+            params = {'pagination': 'cursor', 'limit': 4}
+            if order_by is not None:
+                params['order_by'] = order_by
+            results, pages = self.fetchAll(url, params)
+            self.assertEquals(pages, 7)
+            titles = [game['title'] for game in results]
+            qset = Game.objects.all()
+            if order_by is not None:
+                qset = qset.order_by(order_by, ('-pk' if order_by[0] == '-' else 'pk'))
+            else:
+                qset = qset.order_by('pk')
+            self.assertEquals(titles, [game.title for game in qset])
+    
+    def testDetailRoute(self):
+        url = reverse('api:user-games', args=['v1', 'dev'])
+        results, pages = self.fetchAll(url, {'pagination': 'cursor', 'limit': 10})
+        self.assertEquals(pages, 3)
+        self.assertEquals(len({game['game'] for game in results}), 25)
+    
+    def testInvalidCursor(self):
+        url = reverse('api:game-list', args=['v1'])
+        response = self.client.get(url, {'cursor': 'foobar'}, format='json')
+        self.assertEquals(response.status_code, 404)
+        response = self.client.get(url, {'pagination': 'cursor', 'limit': 5}, format='json')
+        content = self.parser.parse(BytesIO(response.content))
+        response = self.client.get(content['next'] + '&order_by=price', format='json')
+        self.assertEquals(response.status_code, 404)
+    
+    def testDefaultPagination(self):
+        """Tests that offset pagination is still the default.
+        """
+        response = self.client.get(
+            reverse('api:game-list', args=['v1']), {'limit': 5, 'offset': 20}, format='json')
+        content = self.parser.parse(BytesIO(response.content))
+        self.assertEquals(content['count'], 25)
+        self.assertEquals(len(content['results']), 5)
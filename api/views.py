@@ -1,15 +1,15 @@
 import logging
 
 from django.shortcuts import render, get_object_or_404
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import detail_route
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 
 from game.models import Game, GamePlayed
 
+from .pagination import pagination_class_for
 from .serializers import  UserSerializer, GameSerializer, GamePlayedSerializer, UserGamePlayedSerializer
 
 logger = logging.getLogger(__name__)
@@ -30,7 +30,37 @@ def order_by_filter(request, qset, serializer_class):
     return qset
 
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+def related_filter(qset, serializer_class):
+    """Loads the related objects a serializer needs along with the queryset, so
+    that serializing a page does not query the database once per object.
+    
+    The relations are declared in Meta.select_related and Meta.prefetch_related in
+    the serializer class.
+    """
+    meta = serializer_class.Meta
+    if getattr(meta, 'select_related', None):
+        qset = qset.select_related(*meta.select_related)
+    if getattr(meta, 'prefetch_related', None):
+        qset = qset.prefetch_related(*meta.prefetch_related)
+    return qset
+
+
+class PaginatedViewSet(viewsets.ReadOnlyModelViewSet):
+    """Base class of the viewsets. Paginates both the list view and the detail
+    routes with the pagination the request asks for, see api.pagination.
+    """
+    
+    def get_paginator(self):
+        return pagination_class_for(self.request)()
+    
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = self.get_paginator()
+        return self._paginator
+
+
+class UserViewSet(PaginatedViewSet):
     """Allows for querying users. Based on UserSerializer.
     
     This viewset has a games view which gives the bought games for a player.
@@ -47,20 +77,21 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         return order_by_filter(
             self.request,
-            User.objects.all(),
+            related_filter(User.objects.all(), self.serializer_class),
             self.serializer_class
         )
     
-    def get_paginator(self):
-        return api_settings.DEFAULT_PAGINATION_CLASS()
-    
     @detail_route(methods=['get'])
     def games(self, request, version, username=None):
         """Detail view for querying the games bought by a player. Serialized with
         GamePlayedSerializer
         """
         user = self.get_object()
-        qset = order_by_filter(request, user.gameplayed_set.all(), GamePlayedSerializer)
+        qset = order_by_filter(
+            request,
+            related_filter(user.gameplayed_set.all(), GamePlayedSerializer),
+            GamePlayedSerializer
+        )
         paginator = self.get_paginator()
         page = paginator.paginate_queryset(qset, request)
         serializer = GamePlayedSerializer(
@@ -69,7 +100,7 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         )
         return paginator.get_paginated_response(serializer.data)
 
-class DeveloperViewSet(viewsets.ReadOnlyModelViewSet):
+class DeveloperViewSet(PaginatedViewSet):
     """Same as UserViewSet, with a few notable differences.
     
     This viewset uses a queryset of only developers, as opposed to UserViewSet which
@@ -90,20 +121,24 @@ class DeveloperViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         return order_by_filter(
             self.request,
-            Group.objects.get(name='Developer').user_set.all(),
+            related_filter(
+                User.objects.filter(groups__name='Developer'),
+                self.serializer_class
+            ),
             self.serializer_class
         )
     
-    def get_paginator(self):
-        return api_settings.DEFAULT_PAGINATION_CLASS()
-    
     @detail_route(methods=['get'])
     def games(self, request, version, username=None):
         """Detail view for querying the games developed by a developer, serializer
         with GameSerializer
         """
         user = self.get_object()
-        qset = order_by_filter(request, user.game_set.all(), GameSerializer)
+        qset = order_by_filter(
+            request,
+            related_filter(user.game_set.all(), GameSerializer),
+            GameSerializer
+        )
         paginator = self.get_paginator()
         page = paginator.paginate_queryset(qset, request)
         serializer = GameSerializer(
@@ -112,7 +147,7 @@ class DeveloperViewSet(viewsets.ReadOnlyModelViewSet):
         )
         return paginator.get_paginated_response(serializer.data)
 
-class GameViewSet(viewsets.ReadOnlyModelViewSet):
+class GameViewSet(PaginatedViewSet):
     """Allows for querying the games, with all statistics included.
     
     serializer:
@@ -127,13 +162,10 @@ class GameViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         return order_by_filter(
             self.request,
-            Game.objects.all(),
+            related_filter(Game.objects.all(), self.serializer_class),
             self.serializer_class
         )
     
-    def get_paginator(self):
-        return api_settings.DEFAULT_PAGINATION_CLASS()
-    
     @detail_route(methods=['get'])
     def buyers(self, request, version, title=None):
         """Detail view for querying the users who have bought a game, serialized with
@@ -142,7 +174,10 @@ class GameViewSet(viewsets.ReadOnlyModelViewSet):
         game = self.get_object()
         qset = order_by_filter(
             request,
-            GamePlayed.objects.all().filter(game=game),
+            related_filter(
+                GamePlayed.objects.all().filter(game=game),
+                UserGamePlayedSerializer
+            ),
             UserGamePlayedSerializer
         )
         paginator = self.get_paginator()
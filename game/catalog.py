@@ -0,0 +1,69 @@
+"""Cached views of the game catalog used by the home page.
+
+- The number of games is cached, so paging through the catalog does not count the
+  game table on every request. The count is dropped when a game is created or
+  deleted, by the signal handlers in game.signals.
+- The most popular games are precomputed as a list of ids, refreshed every
+  settings.TOP_GAMES_TIMEOUT seconds.
+"""
+
+import logging
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+
+from .models import Game
+
+logger = logging.getLogger(__name__)
+
+COUNT_KEY = 'game.catalog.count'
+TOP_GAMES_KEY = 'game.catalog.top'
+TOP_GAMES = 20
+
+def game_count():
+    """Returns the number of games, from the cache if possible.
+    """
+    count = cache.get(COUNT_KEY)
+    if count is None:
+        count = Game.objects.count()
+        cache.set(COUNT_KEY, count, settings.GAME_COUNT_TIMEOUT)
+    return count
+
+def invalidate_count():
+    cache.delete(COUNT_KEY)
+
+def top_game_ids():
+    """Returns the ids of the TOP_GAMES most popular games, most popular first.
+    """
+    ids = cache.get(TOP_GAMES_KEY)
+    if ids is None:
+        ids = refresh_top_games()
+    return ids
+
+def refresh_top_games():
+    """Recomputes the list of most popular games and caches it.
+    """
+    ids = list(Game.objects.order_by('-popularity', 'pk')
+        .values_list('pk', flat=True)[:TOP_GAMES])
+    cache.set(TOP_GAMES_KEY, ids, settings.TOP_GAMES_TIMEOUT)
+    return ids
+
+def random_top_games(n):
+    """Returns n games picked at random from the most popular games.
+    """
+    ids = top_game_ids()
+    ids = random.sample(ids, min(n, len(ids)))
+    games = Game.objects.in_bulk(ids)
+    return [games[pk] for pk in ids if pk in games]
+
+class CatalogPaginator(Paginator):
+    """Paginator over the game catalog which takes the number of games from the
+    cache instead of counting them.
+    """
+
+    @cached_property
+    def count(self):
+        return game_count()
@@ -5,16 +5,20 @@ from django.core.exceptions import PermissionDenied
 from django.http import Http404
 
 from .models import Game
+from .ownership import owns_game
 from django.contrib.auth.models import User
 
+from accounts.groups import in_group
+
 # Create your views here.
 
 def group_required(*groups):
-    """Requires user membership in at least one of the groups passed in.
+    """Requires user membership in at least one of the groups passed in. The
+    membership is looked up through accounts.groups, once per request.
     Source: Django Snippets"""
     def in_groups(u):
         if u.is_authenticated:
-            if bool(u.groups.filter(name__in=groups)) | u.is_superuser:
+            if u.is_superuser or in_group(u, *groups):
                 return True
         return False
     return user_passes_test(in_groups)
@@ -25,18 +29,17 @@ def game_player_required(function):
     The game should be passed into the function as a url parameter named 'game'.
     If the game is not found in the database, Http404 is raised. If the user does
     not own the game, PermissionDenied is raised.
+
+    Ownership is checked against game.ownership.owned_game_ids, the game itself is
+    only looked up if the user does not own it.
     """
     def wrap(request, *args, **kwargs):
         """Wrapper returns the decorated function if permitted, else returns PermissionDenied"""
-        games = request.user.gameplayed_set.all() #games played by the user
-        try:
-            game = Game.objects.get(pk=kwargs['game'])
-        except:
-            raise Http404
-        if request.user.is_authenticated and game in [game_played.game for game_played in games]:
+        if owns_game(request.user, kwargs['game']):
             return function(request, *args, **kwargs)
-        else:
-            raise PermissionDenied
+        if not Game.objects.filter(pk=kwargs['game']).exists():
+            raise Http404
+        raise PermissionDenied
     return wrap
 
 def game_developer_required(function):
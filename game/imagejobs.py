@@ -0,0 +1,279 @@
+"""Background processing of uploaded game images.
+
+Uploaded images are stored as they are, in Game.gameoriginal, and an ImageJob row
+is created for them. Once the upload has been committed, the job is handed to a
+pool of settings.IMAGE_WORKERS worker threads, which decodes the image once,
+produces the COVER and THUMBNAIL variants, and fills in Game.gameimage and
+Game.gamethumb. Until then the templates show a placeholder, see
+Game.image_pending.
+
+Uploads identical to one already processed for another game reuse its images,
+see copy_images.
+
+Each size is also saved at the smaller widths in settings.IMAGE_VARIANT_WIDTHS,
+in the format of the upload and in WebP, so the templates can offer browsers the
+smallest file that fits with srcset. The variants are recorded in
+Game.imagevariants as JSON:
+
+    {"COVER": {"image/webp": [[320, "<name in storage>"], ...], ...}, ...}
+
+The job table is the queue, so no broker is needed. Jobs left pending or failed
+are run by the process_image_jobs management command. So are jobs left running
+by a process which died or was restarted, once they have not been updated for
+settings.IMAGE_JOB_TIMEOUT seconds. With IMAGE_WORKERS set to 0 jobs are run in the request, once it has
+been committed.
+"""
+
+import json
+import logging
+import os.path
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from gameHub.settings import ImageSizeEnum
+from .models import Game, ImageJob
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_FORMATS = ('JPEG', 'PNG', 'GIF')
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+VARIANT_PATH = 'user_{0}/game/variants/{1}-{2}w.{3}'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def check_image(image):
+    """Checks that an uploaded image is in a format the jobs can process, reading
+    only its header. Raises ValueError otherwise.
+    """
+    try:
+        image_format = Game.open_image(image).format
+    finally:
+        image.seek(0)
+    if image_format not in SUPPORTED_FORMATS:
+        raise ValueError
+
+def get_executor():
+    """Returns the worker pool, starting it on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS)
+        return _executor
+
+def enqueue(game):
+    """Creates a job for the uploaded image of a game. The job is started when the
+    current transaction commits.
+    """
+    job = ImageJob.objects.create(game=game, source=game.gameoriginal.name)
+    transaction.on_commit(lambda: submit(job.pk))
+    return job
+
+def submit(job_id):
+    """Hands a job to the worker pool.
+    """
+    if settings.IMAGE_WORKERS:
+        get_executor().submit(_run, job_id)
+    else:
+        process(job_id)
+
+def _run(job_id):
+    try:
+        process(job_id)
+    finally:
+        #worker threads get their own connection, which django does not close
+        connection.close()
+
+def process(job_id, stale_before=None):
+    """Runs a job, unless another worker has taken it. Returns True if the job was
+    done.
+
+    A running job is taken over if it has not been updated since stale_before, as
+    its worker is assumed to have died.
+
+    The game is only updated if its uploaded image is still the one the job was
+    created for, so a newer upload is never overwritten by an older job.
+    """
+    claimable = Q(status__in=[ImageJob.PENDING, ImageJob.FAILED])
+    if stale_before is not None:
+        claimable |= Q(status=ImageJob.RUNNING, updated__lt=stale_before)
+    claimed = (ImageJob.objects
+        .filter(claimable, pk=job_id)
+        .update(status=ImageJob.RUNNING, updated=timezone.now()))
+    if not claimed:
+        return False
+    job = ImageJob.objects.select_related('game').get(pk=job_id)
+    game = job.game
+    old_images = (game.gameimage.name, game.gamethumb.name, game.imagevariants)
+    images = (None, None, '')
+    try:
+        images = copy_images(game, job.source) or make_images(game, job.source)
+        updated = Game.objects.filter(pk=game.pk, gameoriginal=job.source).update(
+            gameimage=images[0],
+            gamethumb=images[1],
+            imagevariants=images[2]
+        )
+        if updated:
+            delete_images(*old_images)
+        else:
+            #superseded by a newer upload
+            delete_images(*images)
+    except Exception as error:
+        logger.exception('game.imagejobs: job %d failed', job_id)
+        delete_images(*images)
+        ImageJob.objects.filter(pk=job_id).update(
+            status=ImageJob.FAILED, error=str(error), updated=timezone.now())
+        return False
+    ImageJob.objects.filter(pk=job_id).update(
+        status=ImageJob.DONE, error='', updated=timezone.now())
+    return True
+
+def make_images(game, source_name):
+    """Makes the cover, the thumbnail and their variants from an uploaded image.
+    Returns the names of the cover and the thumbnail, and the variants as JSON.
+    """
+    with default_storage.open(source_name, 'rb') as source:
+        image_pil = Game.open_image(
+            source, [ImageSizeEnum.COVER.value, ImageSizeEnum.THUMBNAIL.value])
+        name, ftype = Game.image_format(image_pil, source_name)
+        image_pil.load()
+    cover = ImageOps.fit(image_pil, ImageSizeEnum.COVER.value, Image.ANTIALIAS)
+    thumb = ImageOps.fit(image_pil, ImageSizeEnum.THUMBNAIL.value, Image.ANTIALIAS)
+    #the names of the images stored so far, deleted if a later one fails
+    cover_name = thumb_name = None
+    variants = {}
+    try:
+        with Game.encode_image(cover, name, ftype) as cover_file:
+            game.gameimage.save(name, cover_file, save=False)
+        cover_name = game.gameimage.name
+        with Game.encode_image(thumb, name, ftype) as thumb_file:
+            game.gamethumb.save(name, thumb_file, save=False)
+        thumb_name = game.gamethumb.name
+        variants[ImageSizeEnum.COVER.name] = save_variants(
+            cover, game.developer_id, name, ftype, ImageSizeEnum.COVER, cover_name)
+        variants[ImageSizeEnum.THUMBNAIL.name] = save_variants(
+            thumb, game.developer_id, name, ftype, ImageSizeEnum.THUMBNAIL, thumb_name)
+    except:
+        delete_images(cover_name, thumb_name, json.dumps(variants))
+        raise
+    return cover_name, thumb_name, json.dumps(variants)
+
+def copy_images(game, source_name):
+    """Returns the images of another game made from the same uploaded image, with a
+    reference added to each, or None if there is no such game. With content
+    addressed storage, identical uploads have the same name, so they are resized
+    only once.
+    """
+    retain = getattr(default_storage, 'retain', None)
+    if retain is None:
+        return None
+    other = (Game.objects
+        .filter(gameoriginal=source_name)
+        .exclude(pk=game.pk)
+        .exclude(gamethumb='')
+        .exclude(gamethumb__isnull=True)
+        .values_list('gameimage', 'gamethumb', 'imagevariants')
+        .first())
+    if other is None:
+        return None
+    for name in [other[0], other[1]] + variant_names(other[2]):
+        if name:
+            retain(name)
+    return other
+
+def delete_images(gameimage, gamethumb, imagevariants):
+    """Deletes a cover, a thumbnail and their variants, given by name.
+    """
+    for name in [gameimage, gamethumb] + variant_names(imagevariants):
+        if name:
+            default_storage.delete(name)
+
+def save_variants(image_pil, developer_id, name, ftype, size, full_name):
+    """Saves the responsive variants of an image already fitted to size. Returns
+    them as a dict from mime type to a list of [width, name in storage], by
+    increasing width. full_name is the stored image of the full size in the format
+    of the upload, which is reused rather than saved again.
+    """
+    full_width, full_height = size.value
+    widths = sorted(w for w in settings.IMAGE_VARIANT_WIDTHS.get(size.name, ()) if w < full_width)
+    widths.append(full_width)
+    ftypes = [ftype, 'WEBP'] if webp_supported() else [ftype]
+    base = os.path.splitext(name)[0]
+    variants = {MIME_TYPES[variant_ftype]: [] for variant_ftype in ftypes}
+    for width in widths:
+        if width == full_width:
+            resized = image_pil
+        else:
+            height = max(1, round(full_height * width / full_width))
+            resized = image_pil.resize((width, height), Image.ANTIALIAS)
+        for variant_ftype in ftypes:
+            if variant_ftype == ftype and width == full_width:
+                variant_name = full_name
+            else:
+                extension = variant_ftype.lower().replace('jpeg', 'jpg')
+                with Game.encode_image(resized, base, variant_ftype) as variant_file:
+                    variant_name = default_storage.save(
+                        VARIANT_PATH.format(developer_id, base, width, extension),
+                        variant_file
+                    )
+            variants[MIME_TYPES[variant_ftype]].append([width, variant_name])
+    return variants
+
+def variant_names(imagevariants):
+    """Returns the names of the variant files recorded in a Game.imagevariants
+    value, except the full size images in the format of the upload, which are
+    Game.gameimage and Game.gamethumb.
+    """
+    try:
+        variants = json.loads(imagevariants)
+    except ValueError:
+        return []
+    names = []
+    for size_name, by_type in variants.items():
+        full_width = ImageSizeEnum[size_name].value[0]
+        for mime_type, entries in by_type.items():
+            for width, name in entries:
+                if width != full_width or mime_type == 'image/webp':
+                    names.append(name)
+    return names
+
+def delete_variants(imagevariants):
+    """Deletes the variant files recorded in a Game.imagevariants value, except the
+    full size images which are deleted with Game.gameimage and Game.gamethumb.
+    """
+    for name in variant_names(imagevariants):
+        default_storage.delete(name)
+
+def webp_supported():
+    """Tells if Pillow was built with WebP support.
+    """
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+def process_pending(retry_failed=False):
+    """Runs the pending jobs, the failed ones if retry_failed is True, and the
+    running ones not updated for settings.IMAGE_JOB_TIMEOUT seconds, in the
+    current thread. Returns the number of jobs done.
+    """
+    statuses = [ImageJob.PENDING, ImageJob.FAILED] if retry_failed else [ImageJob.PENDING]
+    stale_before = timezone.now() - timedelta(seconds=settings.IMAGE_JOB_TIMEOUT)
+    ids = (ImageJob.objects
+        .filter(Q(status__in=statuses) | Q(status=ImageJob.RUNNING, updated__lt=stale_before))
+        .order_by('pk')
+        .values_list('pk', flat=True))
+    return sum(1 for job_id in list(ids) if process(job_id, stale_before))
@@ -0,0 +1,123 @@
+"""Cached per-game leaderboards.
+
+The top settings.LEADERBOARD_SIZE scores of each game are kept in the cache, so
+polling for highscores does not query the database. A leaderboard is loaded from
+the database on the first request after it has expired or been invalidated, and
+is updated in place when game.savequeue writes a new score.
+
+Scores are recorded after they are written to the database, under a lock in the
+cache taken with cache.add, so concurrent scores are never merged into the same
+old leaderboard and lost. A score which cannot take the lock drops the cached
+leaderboard instead, which is then loaded with the score from the database.
+
+The lock only excludes the processes which share the cache. With the default
+local memory cache every process has its own leaderboards and locks, and a
+process does not see the scores recorded by the others until its leaderboard
+expires, so deployments running more than one process must configure a shared
+cache, see CACHES in gameHub.settings.
+
+Each leaderboard carries a version, a digest of its contents, which the views use
+as ETag so that unchanged leaderboards can be answered with 304 Not Modified.
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import GamePlayed
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'game.leaderboard.{0}'
+LOCK_KEY = 'game.leaderboard.{0}.lock'
+
+#seconds a lock is held at most, should its holder die, and the number of times
+#and seconds apart a score tries to take it
+LOCK_TIMEOUT = 5
+LOCK_ATTEMPTS = 20
+LOCK_WAIT = 0.01
+
+def _entry(scores):
+    """Builds the cache entry for a list of (username, score) pairs.
+    """
+    digest = hashlib.md5(json.dumps(scores).encode('utf-8')).hexdigest()
+    return {'version': digest, 'scores': scores}
+
+def load(game_id):
+    """Loads the leaderboard of a game from the database and caches it.
+    """
+    scores = [list(row) for row in GamePlayed.objects
+        .filter(game_id=game_id)
+        .order_by('-gameScore', 'pk')
+        .values_list('user__username', 'gameScore')[:settings.LEADERBOARD_SIZE]]
+    entry = _entry(scores)
+    cache.set(CACHE_KEY.format(game_id), entry, settings.LEADERBOARD_TIMEOUT)
+    return entry
+
+def cached(game_id):
+    """Returns the cached leaderboard of a game, or None if it is not cached.
+    """
+    return cache.get(CACHE_KEY.format(game_id))
+
+def get(game_id):
+    """Returns the leaderboard of a game, as a dict with the keys:
+
+    - version: a digest of the scores.
+    - scores: a list of [username, score] pairs ordered by score, highest first.
+    """
+    entry = cached(game_id)
+    if entry is None:
+        entry = load(game_id)
+    return entry
+
+def invalidate(game_id):
+    """Drops the cached leaderboard of a game.
+    """
+    cache.delete(CACHE_KEY.format(game_id))
+
+def record_score(game_id, username, score):
+    """Updates the cached leaderboard of a game with the score of a player, which
+    has been written to the database.
+
+    A higher score is merged into the cached leaderboard. A lower score may let
+    a player outside the leaderboard in, so the leaderboard is invalidated
+    instead.
+    """
+    lock = LOCK_KEY.format(game_id)
+    for attempt in range(LOCK_ATTEMPTS):
+        if cache.add(lock, True, LOCK_TIMEOUT):
+            break
+        time.sleep(LOCK_WAIT)
+    else:
+        logger.warning('game.leaderboard: leaderboard of game %s is locked, dropped', game_id)
+        invalidate(game_id)
+        return
+    try:
+        _merge_score(game_id, username, score)
+    finally:
+        cache.delete(lock)
+
+def _merge_score(game_id, username, score):
+    key = CACHE_KEY.format(game_id)
+    entry = cache.get(key)
+    if entry is None:
+        return
+    scores = entry['scores']
+    previous = [s for name, s in scores if name == username]
+    if previous and score < previous[0]:
+        invalidate(game_id)
+        return
+    scores = [[name, s] for name, s in scores if name != username]
+    scores.append([username, score])
+    scores.sort(key=lambda pair: pair[1], reverse=True)
+    cache.set(key, _entry(scores[:settings.LEADERBOARD_SIZE]), settings.LEADERBOARD_TIMEOUT)
+
+def highscore(game_id):
+    """Returns the highest score of a game, or None if nobody owns the game.
+    """
+    scores = get(game_id)['scores']
+    return scores[0][1] if scores else None
@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageOps
+
+from gameHub.settings import ImageSizeEnum
+from game.models import Game
+
+SIZES = [ImageSizeEnum.COVER, ImageSizeEnum.THUMBNAIL]
+
+def full_decode(path):
+    """Resizes the way Game.resize_images did before decoding JPEG images at reduced
+    resolution: the image is decoded at full resolution, then fitted and encoded.
+    """
+    with open(path, 'rb') as image:
+        image_pil = Game.open_image(image)
+        image_name, FTYPE = Game.image_format(image_pil, path)
+        image_pil.load()
+        for size in SIZES:
+            image_resize = ImageOps.fit(image_pil, size.value, Image.ANTIALIAS)
+            Game.encode_image(image_resize, image_name, FTYPE).close()
+
+def reduced_decode(path):
+    with open(path, 'rb') as image:
+        for resized in Game.resize_images(image, path, SIZES):
+            resized.close()
+
+def measure(function, path, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    function(path)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, after - before))
+
+def run(function, path):
+    """Runs function(path) in a new process, so the peak memory of each run is
+    measured on its own. Returns the wall time in seconds and the growth of the peak
+    resident set size in kB.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(function, path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+class Command(BaseCommand):
+    help = ('Compares the wall time and peak memory of resizing images to the cover '
+        'and thumbnail sizes with a full decode and with the reduced decode of '
+        'Game.resize_images.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+            help='Images to resize. Defaults to a generated 6000x4000 JPEG.')
+        parser.add_argument('--repeat', type=int, default=3,
+            help='Number of runs of each method per image, the best run is reported.')
+
+    def handle(self, *args, **options):
+        images = options['images']
+        generated = None
+        if not images:
+            fd, generated = tempfile.mkstemp(suffix='.jpg')
+            os.close(fd)
+            self.stdout.write('Generating a 6000x4000 JPEG...')
+            Image.effect_noise((6000, 4000), 64).convert('RGB').save(generated, 'JPEG', quality=90)
+            images = [generated]
+        try:
+            for path in images:
+                self.stdout.write(path)
+                for label, function in [('full decode', full_decode), ('reduced decode', reduced_decode)]:
+                    runs = [run(function, path) for i in range(options['repeat'])]
+                    elapsed = min(result[0] for result in runs)
+                    memory = min(result[1] for result in runs)
+                    self.stdout.write('  {0:<15} {1:8.3f} s {2:10d} kB peak'.format(label, elapsed, memory))
+        finally:
+            if generated:
+                os.remove(generated)
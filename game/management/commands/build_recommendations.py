@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from game import recommendations
+
+class Command(BaseCommand):
+    help = 'Builds the players also bought recommendations of the games.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+            help='Only recompute the games affected by purchases since the last run.')
+
+    def handle(self, *args, **options):
+        if options['incremental']:
+            count = recommendations.refresh()
+        else:
+            count = recommendations.build()
+        self.stdout.write('Computed the recommendations of {0} games.'.format(count))
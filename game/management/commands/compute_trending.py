@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from game import trending
+
+class Command(BaseCommand):
+    help = 'Recomputes the trending scores of all games.'
+
+    def handle(self, *args, **options):
+        updated = trending.update()
+        self.stdout.write('Updated the trending scores of {0} games.'.format(updated))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from game import savequeue
+
+class Command(BaseCommand):
+    help = 'Writes the buffered game saves and scores to the database.'
+
+    def handle(self, *args, **options):
+        total = savequeue.flush_all()
+        self.stdout.write('Flushed {0} saves.'.format(total))
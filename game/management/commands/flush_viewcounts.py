@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from game import viewcount
+
+class Command(BaseCommand):
+    help = 'Writes the buffered game page views to the database.'
+
+    def handle(self, *args, **options):
+        total = viewcount.flush_all()
+        self.stdout.write('Flushed {0} views.'.format(total))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from game import imagejobs
+
+class Command(BaseCommand):
+    help = 'Runs the pending game image jobs, and takes over the stale running ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help='Also run failed jobs again.')
+
+    def handle(self, *args, **options):
+        done = imagejobs.process_pending(retry_failed=options['retry_failed'])
+        self.stdout.write('Processed {0} image jobs.'.format(done))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from game import thumbnails
+
+class Command(BaseCommand):
+    help = ('Deletes the least recently used on demand thumbnails until the cache '
+        'is under settings.THUMBNAIL_CACHE_MAX_SIZE bytes.')
+
+    def handle(self, *args, **options):
+        deleted = thumbnails.prune()
+        self.stdout.write('Pruned {0} thumbnails.'.format(deleted))
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+from game import search_index
+
+def forwards_func(apps, schema_editor):
+    search_index.create_index(schema_editor.connection)
+
+def reverse_func(apps, schema_editor):
+    search_index.drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0034_merge_20180207_2304'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, reverse_func)
+    ]
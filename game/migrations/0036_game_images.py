@@ -0,0 +1,36 @@
+# Generated by Django 2.0 on 2026-10-18 02:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import game.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0035_game_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='gameoriginal',
+            field=models.ImageField(blank=True, null=True, upload_to=game.models.user_directory_path_original),
+        ),
+        migrations.AddField(
+            model_name='imagejob',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='game.Game'),
+        ),
+    ]
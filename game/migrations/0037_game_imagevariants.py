@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2026-10-18 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0036_game_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='imagevariants',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.0 on 2026-10-18 02:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0038_mediafile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyViews',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='trending',
+            field=models.FloatField(db_index=True, default=0.0),
+        ),
+        migrations.AddField(
+            model_name='dailyviews',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='game.Game'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyviews',
+            unique_together={('game', 'day')},
+        ),
+    ]
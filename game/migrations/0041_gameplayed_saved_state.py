@@ -0,0 +1,23 @@
+# Generated by Django 2.0 on 2026-10-18 02:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0040_recommendation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayed',
+            name='savedItems',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='gameplayed',
+            name='savedScore',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
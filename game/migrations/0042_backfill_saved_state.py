@@ -0,0 +1,53 @@
+import ast
+import json
+
+from django.db import migrations
+
+def parse_state(text):
+    """Returns the gameState dict of a stored SAVE message, or None."""
+    try:
+        data = json.loads(text)
+    except ValueError:
+        #states were read with literal_eval before, keep accepting what it did
+        try:
+            data = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return None
+    if not isinstance(data, dict) or not isinstance(data.get('gameState'), dict):
+        return None
+    return data['gameState']
+
+def forwards_func(apps, schema_editor):
+    GamePlayed = apps.get_model('game', 'GamePlayed')
+    db_alias = schema_editor.connection.alias
+    played = GamePlayed.objects.using(db_alias).only('gameState')
+    for game_played in played.iterator():
+        state = parse_state(game_played.gameState)
+        if state is None:
+            continue
+        score = state.get('score')
+        try:
+            score = int(score) if score is not None else None
+        except (TypeError, ValueError):
+            score = None
+        items = state.get('playerItems') or []
+        if not isinstance(items, list):
+            items = [items]
+        GamePlayed.objects.using(db_alias).filter(pk=game_played.pk).update(
+            savedScore=score,
+            savedItems=', '.join(str(item) for item in items)
+        )
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0041_gameplayed_saved_state'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, reverse_func)
+    ]
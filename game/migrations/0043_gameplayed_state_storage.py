@@ -0,0 +1,67 @@
+# Generated by Django 2.0 on 2026-10-18 02:49
+
+import hashlib
+import zlib
+
+from django.db import migrations, models
+
+def forwards_func(apps, schema_editor):
+    """Fills in the hashes and sizes of the states saved before. They stay stored as
+    text until they are saved again.
+    """
+    GamePlayed = apps.get_model('game', 'GamePlayed')
+    db_alias = schema_editor.connection.alias
+    played = GamePlayed.objects.using(db_alias).exclude(gameState="{''}").only('gameState')
+    for game_played in played.iterator():
+        raw = game_played.gameState.encode('utf-8')
+        GamePlayed.objects.using(db_alias).filter(pk=game_played.pk).update(
+            stateHash=hashlib.sha256(raw).hexdigest(),
+            stateSize=len(raw),
+            stateStoredSize=len(raw)
+        )
+
+def reverse_func(apps, schema_editor):
+    """Moves the compressed states back to gameState, as text.
+    """
+    GamePlayed = apps.get_model('game', 'GamePlayed')
+    db_alias = schema_editor.connection.alias
+    played = GamePlayed.objects.using(db_alias).filter(stateEncoding='zlib').only('stateData')
+    for game_played in played.iterator():
+        GamePlayed.objects.using(db_alias).filter(pk=game_played.pk).update(
+            gameState=zlib.decompress(bytes(game_played.stateData)).decode('utf-8')
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0042_backfill_saved_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayed',
+            name='stateData',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gameplayed',
+            name='stateEncoding',
+            field=models.CharField(blank=True, default='', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='gameplayed',
+            name='stateHash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='gameplayed',
+            name='stateSize',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='gameplayed',
+            name='stateStoredSize',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(forwards_func, reverse_func),
+    ]
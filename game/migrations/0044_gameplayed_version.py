@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2026-10-18 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0043_gameplayed_state_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayed',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
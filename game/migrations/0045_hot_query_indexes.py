@@ -0,0 +1,59 @@
+# Generated by Django 2.0 on 2026-10-18 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0044_gameplayed_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='game',
+            name='trending',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AlterField(
+            model_name='paymentdetail',
+            name='selldate',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-popularity', 'id'], name='game_popularity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['-trending', 'id'], name='game_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['viewcount', 'sellcount', 'id'], name='game_viewcount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['sellcount', 'id'], name='game_sellcount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['upload_date', 'id'], name='game_upload_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['revenue', 'id'], name='game_revenue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['price', 'id'], name='game_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['developer', 'viewcount', 'sellcount', 'id'], name='game_developer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gameplayed',
+            index=models.Index(fields=['game', '-gameScore', 'id'], name='gameplayed_score_idx'),
+        ),
+    ]
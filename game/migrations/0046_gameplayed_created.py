@@ -0,0 +1,18 @@
+# Generated by Django 2.0 on 2026-10-18 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0045_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameplayed',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,24 +1,26 @@
+import json
 import logging
-import re
 import pdb
 
 from decimal import Decimal
 
 from django.conf import settings
 from django.core.files import File
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models import Q, F, Sum
+from django.db.models import Q, F, Sum, Case, When, FloatField
+from django.db.models.functions import Cast
 from django.db.models.fields.files import ImageFieldFile, FileField
 from django.utils import timezone
 from PIL import Image, ImageOps
 import os.path
-from io import BytesIO
 from django.core.files.base import ContentFile
 
 from gameHub.settings import ImageSizeEnum
+from . import search_index
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,9 @@ def user_directory_path(instance, filename):
 def user_directory_path_thumb(instance, filename):
     return 'user_{0}/game/thumb/{1}'.format(instance.developer.id, filename)
 
+def user_directory_path_original(instance, filename):
+    return 'user_{0}/game/original/{1}'.format(instance.developer.id, filename)
+
 
 class Game(models.Model):
     """Game model
@@ -50,6 +55,8 @@ class Game(models.Model):
     description   = models.TextField()
     gameimage     = models.ImageField(null=True, blank=True, upload_to=user_directory_path)
     gamethumb     = models.ImageField(null=True, blank=True, upload_to=user_directory_path_thumb)
+    gameoriginal  = models.ImageField(null=True, blank=True, upload_to=user_directory_path_original)
+    imagevariants = models.TextField(blank=True, default='')
     viewcount     = models.PositiveIntegerField(default=0)
     sellcount     = models.PositiveIntegerField(default=0)
     upload_date   = models.DateTimeField(default=timezone.now)
@@ -57,17 +64,38 @@ class Game(models.Model):
     total_rating  = models.PositiveIntegerField(default=0)
     popularity    = models.FloatField(default=0.0)
     revenue       = models.DecimalField(decimal_places=2, max_digits=10, default=Decimal('0.00'))
+    trending      = models.FloatField(default=0.0)
+
+    #orderings the game lists can be sorted by, see search
+    SORT_ORDERS = {
+        'popular': ('-popularity', 'pk'),
+        'trending': ('-trending', 'pk'),
+    }
 
     class Meta:
         ordering = ['viewcount', 'sellcount']
+        #one index for each ordering of the game lists and the api, with the primary
+        #key that breaks ties, so pages are read in index order instead of sorted
+        indexes = [
+            models.Index(fields=['-popularity', 'id'], name='game_popularity_idx'),
+            models.Index(fields=['-trending', 'id'], name='game_trending_idx'),
+            models.Index(fields=['viewcount', 'sellcount', 'id'], name='game_viewcount_idx'),
+            models.Index(fields=['sellcount', 'id'], name='game_sellcount_idx'),
+            models.Index(fields=['upload_date', 'id'], name='game_upload_date_idx'),
+            models.Index(fields=['revenue', 'id'], name='game_revenue_idx'),
+            models.Index(fields=['price', 'id'], name='game_price_idx'),
+            #the games of a developer, in the default ordering
+            models.Index(fields=['developer', 'viewcount', 'sellcount', 'id'], name='game_developer_idx'),
+        ]
 
     def calculate_popularity(self):
         """Calculates the popularity of a game. The popularity is used by the search
         function to order the query results.
 
-        .. note:: This function should be called by the methods which alter the popularity. Do not call it directly.
+        .. note:: The stored popularity is computed in SQL by update_statistics, this
+            function gives the same result from the field values of the instance.
         """
-        if self.ratings is 0:
+        if self.ratings == 0:
             self.popularity = self.sellcount * 1.0
         else:
             self.popularity = self.sellcount * (self.total_rating / self.ratings)
@@ -75,10 +103,44 @@ class Game(models.Model):
     def increment_viewcount(self):
         """Increments the viewcount. This method should be used instead of directly
         modifying model instances to avoid race conditions, and ensure that all the
-        required modifications are made to the instance.
+        required modifications are made to the instance. Only the viewcount column
+        is written.
+
+        .. note:: Page views are counted through game.viewcount.record_view, which
+            batches the increments instead of writing on every view.
         """
         self.viewcount = F('viewcount') + 1
-        self.save()
+        self.save(update_fields=['viewcount'])
+
+    def update_statistics(self, sellcount=0, ratings=0, total_rating=0, **kwargs):
+        """Changes the sell and rating statistics of the game, and recalculates the
+        popularity, in a single UPDATE statement. The popularity is calculated by
+        the database from the new column values, with float arithmetic, so
+        concurrent updates can not leave it stale.
+
+        The fields of the instance are not refreshed.
+
+        Args:
+            sellcount - The change in sellcount
+            ratings - The change in the number of ratings
+            total_rating - The change in total_rating
+            kwargs - Other fields to set in the same statement
+        """
+        new_sellcount = Cast(F('sellcount') + sellcount, FloatField())
+        popularity = Case(
+            When(Q(ratings=-ratings), then=new_sellcount),
+            default=new_sellcount
+                * Cast(F('total_rating') + total_rating, FloatField())
+                / Cast(F('ratings') + ratings, FloatField()),
+            output_field=FloatField()
+        )
+        type(self).objects.filter(pk=self.pk).update(
+            sellcount=F('sellcount') + sellcount,
+            ratings=F('ratings') + ratings,
+            total_rating=F('total_rating') + total_rating,
+            popularity=popularity,
+            **kwargs
+        )
 
     def increment_sellcount(self, **kwargs):
         """Increments the sellcount. This method should be used instead of directly
@@ -91,50 +153,28 @@ class Game(models.Model):
         Args:
             price - The price the game was bought for (optional)
         """
-        self.sellcount = F('sellcount') + 1
-        self.calculate_popularity()
         if 'price' in kwargs:
-            self.revenue = F('revenue') + kwargs['price']
-        self.save()
-
+            self.update_statistics(sellcount=1, revenue=F('revenue') + kwargs['price'])
+        else:
+            self.update_statistics(sellcount=1)
 
     def add_rating(self, rating):
         """
         .. note:: Use GamePlayed.set_rating rather than calling this function directly.
         """
-        self.ratings = F('ratings') + 1
-        self.total_rating = F('total_rating') + rating
-        self.save()
-        #double save here is neccessary since calculate_popularity requires float
-        #arithmetic. F expressions forces it to SQL which does integer arithmetic
-        self.refresh_from_db()
-        self.calculate_popularity()
-        self.save()
+        self.update_statistics(ratings=1, total_rating=rating)
 
     def remove_rating(self, rating):
         """
         .. note:: Use GamePlayed.set_rating rather than calling this function directly.
         """
-        self.ratings = F('ratings') - 1
-        self.total_rating = F('total_rating') + rating
-        self.save()
-        #double save here is neccessary since calculate_popularity requires float
-        #arithmetic. F expressions forces it to SQL which does integer arithmetic
-        self.refresh_from_db()
-        self.calculate_popularity()
-        self.save()
+        self.update_statistics(ratings=-1, total_rating=-rating)
 
     def change_rating(self, change):
         """
         .. note:: Use GamePlayed.set_rating rather than calling this function directly.
         """
-        self.total_rating = F('total_rating') + change
-        self.save()
-        #double save here is neccessary since calculate_popularity requires float
-        #arithmetic. F expressions forces it to SQL which does integer arithmetic
-        self.refresh_from_db()
-        self.calculate_popularity()
-        self.save()
+        self.update_statistics(total_rating=change)
     
     def get_rating(self):
         """Returns the calculated rating. Simply total_rating / ratings, or 0 if no
@@ -160,16 +200,78 @@ class Game(models.Model):
     
     @staticmethod
     def resize_image(image, name, size):
-        if not isinstance(size, ImageSizeEnum):
+        return Game.resize_images(image, name, [size])[0]
+
+    @staticmethod
+    def resize_images(image, name, sizes):
+        """Resizes an image to several sizes, decoding it only once.
+
+        Args:
+            image - The image file
+            name - The file name, its extension gives the format to save in
+            sizes - A list of ImageSizeEnum
+
+        Return:
+            A list with a TemporaryUploadedFile for each size.
+
+        Raises ValueError if a size is not an ImageSizeEnum, or the image format is
+        not supported.
+        """
+        if not all(isinstance(size, ImageSizeEnum) for size in sizes):
             raise ValueError
-        image_name, image_extension = os.path.splitext(name)
         # PIL Python Image Library
-        image_pil = Image.open(image)
+        image_pil = Game.open_image(image, [size.value for size in sizes])
+        image_name, FTYPE = Game.image_format(image_pil, name)
+        image_pil.load()
+        resized = []
+        for size in sizes:
+            image_resize = ImageOps.fit(image_pil, size.value, Image.ANTIALIAS)  # Resize image
+            resized.append(Game.encode_image(image_resize, image_name, FTYPE))
+        return resized
+
+    @staticmethod
+    def open_image(image, sizes=()):
+        """Opens an image, reading only its header.
+
+        JPEG images are decoded at reduced resolution when they are at least twice
+        as large as needed for the largest of sizes in both dimensions, which saves
+        most of the memory and time of decoding large photos. They are still
+        decoded at least twice the size needed, so the result is then downscaled
+        with antialiasing as before.
+
+        Args:
+            image - The image file
+            sizes - The (width, height) sizes the image will be fitted to
+
+        Raises ValueError if the image can not be read, or has more pixels than
+        settings.IMAGE_MAX_PIXELS.
+        """
+        try:
+            image_pil = Image.open(image)
+        except Exception:
+            #IOError, or one of the errors Pillow raises for corrupt or huge images
+            raise ValueError
+        width, height = image_pil.size
+        if width * height > settings.IMAGE_MAX_PIXELS:
+            raise ValueError
+        if sizes and image_pil.format == 'JPEG':
+            needed = (
+                2 * max(size[0] for size in sizes),
+                2 * max(size[1] for size in sizes)
+            )
+            image_pil.draft(image_pil.mode, needed)
+        return image_pil
+
+    @staticmethod
+    def image_format(image_pil, name):
+        """Returns the file name and the format to save an image in, from the name
+        of the upload. Raises ValueError if the format is not supported.
+        """
+        image_name, image_extension = os.path.splitext(os.path.basename(name))
         # Check correct image extension, ex. user renamed .png to .jpg
         if image_extension in ['.jpg', '.jpeg'] and image_pil.mode in ('RGBA', 'LA'):
             image_extension = '.png'
         image_name = image_name + image_extension # Save img with correct extension
-        image_resize = ImageOps.fit(image_pil, size.value, Image.ANTIALIAS)  # Resize image
         if image_extension in ['.jpg', '.jpeg']:
             FTYPE = 'JPEG'
         elif image_extension == '.gif':
@@ -179,11 +281,53 @@ class Game(models.Model):
         else:
             # ToDo Find correct exception
             raise ValueError
-        image_stream = BytesIO()
-        image_resize.save(image_stream, FTYPE)
-        image_stream.seek(0)
-        resize_image = InMemoryUploadedFile(image_stream, None, image_name, FTYPE, image_stream.tell(), None)
-        return resize_image
+        return image_name, FTYPE
+
+    @staticmethod
+    def encode_image(image_pil, name, ftype):
+        """Saves a PIL image in the given format to a temporary file, and returns it
+        as a TemporaryUploadedFile. The file is deleted when closed.
+        """
+        image_file = TemporaryUploadedFile(name, Image.MIME.get(ftype), 0, None)
+        image_pil.save(image_file.file, ftype)
+        image_file.size = image_file.file.tell()
+        image_file.seek(0)
+        return image_file
+
+    @property
+    def image_pending(self):
+        """True while an uploaded image is waiting to be processed into the cover
+        and thumbnail.
+        """
+        return bool(self.gameoriginal) and not self.gamethumb
+
+    def image_sources(self, size):
+        """Returns the responsive variants of an image size, as a list of
+        (mime type, srcset) tuples, WebP first. Empty for games whose image was
+        processed before variants were made.
+
+        Args:
+            size - The name of an ImageSizeEnum, ex. 'COVER'
+        """
+        try:
+            variants = json.loads(self.imagevariants).get(size, {})
+        except ValueError:
+            return []
+        sources = []
+        for mime_type in sorted(variants, key=lambda mime_type: mime_type != 'image/webp'):
+            sources.append((mime_type, ', '.join(
+                '{0} {1}w'.format(default_storage.url(name), width)
+                for width, name in variants[mime_type]
+            )))
+        return sources
+
+    @property
+    def cover_sources(self):
+        return self.image_sources(ImageSizeEnum.COVER.name)
+
+    @property
+    def thumb_sources(self):
+        return self.image_sources(ImageSizeEnum.THUMBNAIL.name)
 
     @classmethod
     def create(cls, title, url, developer, price = 0.0, description='', gameimage=None, gamethumb=None,viewcount=0):
@@ -204,29 +348,41 @@ class Game(models.Model):
         return game
 
     @classmethod
-    def search(cls, q):
+    def search(cls, q, sort='popular'):
         """Searches for games in the database.
 
+        Matching is done against the full-text index in game.search_index, where
+        the database has one. Each word in the query matches words starting with
+        it, and quoted phrases match consecutive words.
+
         Args:
             q (str):
                 The search query string. If None then it fetches all games from database
+            sort (str):
+                A key of SORT_ORDERS, 'popular' for all-time popularity or
+                'trending' for the time decayed score of game.trending. Unknown
+                keys sort by popularity.
 
         Return:
             A queryset containing all the found games.
         """
 
+        ordering = cls.SORT_ORDERS.get(sort, cls.SORT_ORDERS['popular'])
         if q is None:
-            return cls.objects.all().order_by('-popularity')
+            return cls.objects.all().order_by(*ordering)
         else:
-            qwords = map(lambda m: m[0] if len(m[0]) > 0 else m[1],
-                re.findall(r'"(.+)"|(\S+)', q))
-            query = Q()
-            for word in qwords:
-                query = query & (
-                    Q(title__contains=word) |
-                    Q(description__contains=word))
-
-            return cls.objects.all().filter(query).order_by('-popularity')
+            qwords = search_index.parse_query(q)
+            qset = search_index.filter_queryset(cls.objects.all(), qwords)
+            if qset is None:
+                #no full-text index on this database, fall back to substring search
+                query = Q()
+                for word in qwords:
+                    query = query & (
+                        Q(title__contains=word) |
+                        Q(description__contains=word))
+                qset = cls.objects.all().filter(query)
+
+            return qset.order_by(*ordering)
 
     def __str__(self):
         return 'Game {0}, title: {1}, url: {2}'.format(
@@ -246,28 +402,74 @@ class GamePlayed(models.Model):
     a middle model could be used in many to many relationship
     as referred to README.md for database schema.
 
-    :members: game, gameScore, gameState, users, rating
+    :members: game, gameScore, gameState, users, rating, savedScore, savedItems,
+        stateData, stateEncoding, stateHash, stateSize, stateStoredSize, version,
+        created
+    -savedScore and savedItems summarize the last saved gameState, so it does not
+     have to be parsed to show them. savedItems are the player items, joined with
+     commas.
+    -large states are stored compressed in stateData instead of gameState, with
+     their hash and sizes, see game.savestate.
+    -version is incremented by every save of a changed state, see game.savequeue.
+    -created is the time the game was bought, or uploaded by its developer, unknown
+     for games owned before it was added. Used by game.recommendations.refresh.
 
     """
 
-    game      = models.ForeignKey(Game, null=True, on_delete=models.SET_NULL)
-    gameScore = models.IntegerField()
-    gameState = models.TextField(default="{''}")
+    game       = models.ForeignKey(Game, null=True, on_delete=models.SET_NULL)
+    gameScore  = models.IntegerField()
+    gameState  = models.TextField(default="{''}")
     user     = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
-    rating    = models.IntegerField(default=0)
+    rating     = models.IntegerField(default=0)
+    savedScore = models.IntegerField(null=True, blank=True)
+    savedItems = models.TextField(blank=True, default='')
+    stateData  = models.BinaryField(null=True, blank=True)
+    stateEncoding = models.CharField(max_length=8, blank=True, default='')
+    stateHash  = models.CharField(max_length=64, blank=True, default='')
+    stateSize  = models.PositiveIntegerField(default=0)
+    stateStoredSize = models.PositiveIntegerField(default=0)
+    version    = models.PositiveIntegerField(default=0)
+    created    = models.DateTimeField(auto_now_add=True, null=True, db_index=True)
 
     class Meta:
         unique_together = ("game", "user")
+        #the leaderboards and highscores of the games
+        indexes = [
+            models.Index(fields=['game', '-gameScore', 'id'], name='gameplayed_score_idx'),
+        ]
+
+    @staticmethod
+    def summarize_state(state):
+        """Returns the score and the player items of a game state, as stored in
+        savedScore and savedItems.
+
+        Args:
+            state - The gameState dict of a SAVE message
+        """
+        score = state.get('score')
+        if score is not None:
+            score = int(score)
+        items = state.get('playerItems') or []
+        if not isinstance(items, list):
+            items = [items]
+        return score, ', '.join(str(item) for item in items)
 
     def set_rating(self, rating):
         """Gives a rating from a user to a game.
+
+        The rating is swapped in with a conditional UPDATE on the previous rating,
+        and the game statistics are updated in the same transaction, so that
+        concurrent ratings by the same user are counted once.
         """
-        if self.rating == 0:
-            self.game.add_rating(rating)
-        else:
-            self.game.change_rating(rating - self.rating)
-        self.rating = rating
-        self.save()
+        with transaction.atomic():
+            while not GamePlayed.objects.filter(pk=self.pk, rating=self.rating).update(rating=rating):
+                #rated concurrently, retry against the stored rating
+                self.refresh_from_db(fields=['rating'])
+            if self.rating == 0:
+                self.game.add_rating(rating)
+            else:
+                self.game.change_rating(rating - self.rating)
+            self.rating = rating
 
     def __str__(self):
         if (self.game):
@@ -293,7 +495,7 @@ class PaymentDetail(models.Model):
     game_played = models.OneToOneField(GamePlayed, null=True, on_delete=models.SET_NULL)
     cost = models.DecimalField(decimal_places=2, max_digits=10, validators=[MinValueValidator(Decimal('0.01'))])
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
-    selldate = models.DateTimeField(auto_now=False, auto_now_add=True)
+    selldate = models.DateTimeField(auto_now=False, auto_now_add=True, db_index=True)
 
     def __str__(self):
         if (self.user):
@@ -308,3 +510,97 @@ class PaymentDetail(models.Model):
             user,
             game
         )
+
+class ImageJob(models.Model):
+    """ImageJob model - a request to produce the cover and thumbnail of a game from
+    its uploaded image. The jobs are run by the worker pool in game.imagejobs.
+
+    :members: game, source, status, error, created, updated
+    -source is the name of the uploaded image in storage, as it was when the job
+     was created
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    game    = models.ForeignKey(Game, on_delete=models.CASCADE)
+    source  = models.CharField(max_length=255)
+    status  = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    error   = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return 'ImageJob {0}, game: {1}, status: {2}'.format(
+            self.pk,
+            self.game_id,
+            self.status
+        )
+
+class MediaFile(models.Model):
+    """MediaFile model - the number of references to a file stored by
+    game.storage.ContentAddressedStorage. The file is deleted with its row, when no
+    reference is left.
+
+    :members: name, references
+    """
+    name       = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{0}, references: {1}'.format(
+            self.name,
+            self.references
+        )
+
+class DailyViews(models.Model):
+    """DailyViews model - the number of views of a game on one day, written by
+    game.viewcount. Used for the trending score, see game.trending.
+
+    :members: game, day, views
+    """
+    game  = models.ForeignKey(Game, on_delete=models.CASCADE)
+    day   = models.DateField()
+    views = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("game", "day")
+
+    def __str__(self):
+        return 'Game {0}, day: {1}, views: {2}'.format(
+            self.game_id,
+            self.day,
+            self.views
+        )
+
+class Recommendation(models.Model):
+    """Recommendation model - one of the games most often bought by the players of
+    a game, built by game.recommendations.
+
+    :members: game, recommended, rank, score, updated
+    -rank is the position of the recommendation, from 0 for the best
+    -score is the cosine similarity of the sets of owners of the two games
+    -updated is the time the recommendations of the game were computed
+    """
+    game        = models.ForeignKey(Game, on_delete=models.CASCADE)
+    recommended = models.ForeignKey(Game, on_delete=models.CASCADE, related_name='+')
+    rank        = models.PositiveSmallIntegerField()
+    score       = models.FloatField()
+    updated     = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ("game", "rank")
+
+    def __str__(self):
+        return 'Game {0}, recommended: {1}, rank: {2}'.format(
+            self.game_id,
+            self.recommended_id,
+            self.rank
+        )
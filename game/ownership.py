@@ -0,0 +1,36 @@
+"""Lookup of the games a user owns.
+
+The ids of the games a user owns are loaded with one query the first time they
+are needed in a request, and kept on the user instance for the rest of the
+request. This is shared by game_player_required, the purchase view and the
+owns_game template filter, so a page listing many games costs one ownership
+query.
+
+The ids are not cached across requests, a purchase by the user is seen by the
+next request in every process.
+"""
+
+import logging
+
+from .models import GamePlayed
+
+logger = logging.getLogger(__name__)
+
+def owned_game_ids(user):
+    """Returns a frozenset with the ids of the games a user owns. Anonymous users
+    own no games.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    ids = getattr(user, '_owned_game_ids', None)
+    if ids is None:
+        ids = frozenset(GamePlayed.objects
+            .filter(user=user, game__isnull=False)
+            .values_list('game_id', flat=True))
+        user._owned_game_ids = ids
+    return ids
+
+def owns_game(user, game_id):
+    """Tells if a user owns the game with the given id.
+    """
+    return game_id in owned_game_ids(user)
@@ -0,0 +1,176 @@
+"""Players also bought recommendations.
+
+Games are recommended by item to item cosine similarity over the games the
+players own, from GamePlayed. With M the sparse players by games matrix, with 1
+where a player owns a game, the co-occurrence matrix C = M^T M counts the
+players who own both of two games, and the similarity of games i and j is
+
+    C[i, j] / sqrt(C[i, i] * C[j, j])
+
+The settings.RECOMMENDATIONS most similar games of each game are stored in the
+Recommendation table, so the detail page reads them with one indexed lookup.
+
+build() recomputes every game, and refresh() only the games whose similarities
+have changed through the games players have come to own since the last build or
+refresh, bought or uploaded by their developer, found from GamePlayed.created and
+Recommendation.updated. Both are run by the build_recommendations management
+command. Ownership lost other than through deleted games is only picked up by
+build().
+"""
+
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .models import GamePlayed, Recommendation
+
+logger = logging.getLogger(__name__)
+
+def ownership_matrix(played):
+    """Returns the sparse players by games matrix of (user id, game id) pairs, and
+    the game ids of its columns.
+    """
+    played = np.array(played, dtype=np.int64).reshape(-1, 2)
+    user_ids, rows = np.unique(played[:, 0], return_inverse=True)
+    game_ids, columns = np.unique(played[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(played)), (rows, columns)),
+        shape=(len(user_ids), len(game_ids))
+    )
+    #pairs owned twice count once
+    matrix.data[:] = 1
+    return matrix, game_ids
+
+def top_neighbours(similarity, row_ids, column_ids, k):
+    """Returns the k most similar games of each row of a sparse similarity matrix,
+    as a dict from game id to a list of (game id, score), best first. Ties are
+    broken by game id. A game is not its own neighbour.
+    """
+    similarity = similarity.tocsr()
+    neighbours = {}
+    for row, game_id in enumerate(row_ids):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        ids = column_ids[similarity.indices[start:end]]
+        scores = similarity.data[start:end]
+        keep = ids != game_id
+        ids, scores = ids[keep], scores[keep]
+        order = np.lexsort((ids, -scores))[:k]
+        neighbours[int(game_id)] = list(zip(ids[order].tolist(), scores[order].tolist()))
+    return neighbours
+
+def similarities(rows, matrix, counts):
+    """Returns the cosine similarities of the games selected by rows, a sparse
+    indicator matrix of games by players, to all games.
+
+    Args:
+        rows - sparse (selected games, players) matrix, 1 where a player owns a
+            selected game
+        matrix - sparse (players, games) ownership matrix
+        counts - numbers of owners of the selected games, and of all games
+    """
+    row_counts, column_counts = counts
+    cooccurrence = (rows @ matrix).tocoo()
+    norms = np.sqrt(row_counts[cooccurrence.row] * column_counts[cooccurrence.col])
+    return sparse.csr_matrix(
+        (cooccurrence.data / norms, (cooccurrence.row, cooccurrence.col)),
+        shape=cooccurrence.shape
+    )
+
+def store(neighbours, updated):
+    """Replaces the recommendations of the games in neighbours.
+    """
+    with transaction.atomic():
+        Recommendation.objects.filter(game_id__in=list(neighbours)).delete()
+        Recommendation.objects.bulk_create([
+            Recommendation(
+                game_id=game_id,
+                recommended_id=other,
+                rank=rank,
+                score=score,
+                updated=updated
+            )
+            for game_id, others in neighbours.items()
+            for rank, (other, score) in enumerate(others)
+        ], batch_size=500)
+
+def played_pairs(**filters):
+    return list(GamePlayed.objects
+        .filter(game__isnull=False, user__isnull=False, **filters)
+        .values_list('user_id', 'game_id'))
+
+def build():
+    """Recomputes the recommendations of every game. Returns the number of games
+    with recommendations.
+    """
+    started = timezone.now()
+    matrix, game_ids = ownership_matrix(played_pairs())
+    counts = np.asarray(matrix.sum(axis=0)).ravel()
+    neighbours = top_neighbours(
+        similarities(matrix.T.tocsr(), matrix, (counts, counts)),
+        game_ids, game_ids, settings.RECOMMENDATIONS
+    )
+    with transaction.atomic():
+        Recommendation.objects.all().delete()
+        store(neighbours, started)
+    logger.info('game.recommendations.build: %d games', len(neighbours))
+    return len(neighbours)
+
+def refresh():
+    """Recomputes the recommendations of the games affected by the games owned
+    since the last build or refresh, or builds them all if there was none. Returns
+    the number of games recomputed.
+
+    A purchase of game g, or any other new owner of it, changes the number of owners of g, so the similarity of g
+    to every game sharing an owner with it, and the co-occurrences of g with the
+    other games of the buyer. The affected games are g and all games sharing an
+    owner with g.
+    """
+    since = Recommendation.objects.aggregate(since=Max('updated'))['since']
+    if since is None:
+        return build()
+    started = timezone.now()
+    bought = set(GamePlayed.objects
+        .filter(created__gte=since, game__isnull=False, user__isnull=False)
+        .values_list('game_id', flat=True))
+    if not bought:
+        return 0
+    owners = GamePlayed.objects.filter(game_id__in=bought).values('user_id')
+    affected = set(GamePlayed.objects
+        .filter(user_id__in=owners, game__isnull=False)
+        .values_list('game_id', flat=True))
+
+    #the players owning an affected game, and everything they own
+    players = GamePlayed.objects.filter(game_id__in=affected).values('user_id')
+    matrix, game_ids = ownership_matrix(played_pairs(user_id__in=players))
+    all_counts = dict(GamePlayed.objects
+        .filter(game_id__in=game_ids.tolist(), user__isnull=False)
+        .values_list('game_id')
+        .annotate(owners=Count('user_id', distinct=True)))
+    counts = np.array([all_counts.get(game_id, 0) for game_id in game_ids.tolist()], dtype=float)
+    selected = np.isin(game_ids, list(affected))
+    rows = matrix.T.tocsr()[selected]
+    neighbours = top_neighbours(
+        similarities(rows, matrix, (counts[selected], counts)),
+        game_ids[selected], game_ids, settings.RECOMMENDATIONS
+    )
+    for game_id in affected - set(neighbours):
+        neighbours[game_id] = []
+    store(neighbours, started)
+    logger.info('game.recommendations.refresh: %d games', len(neighbours))
+    return len(neighbours)
+
+def recommended_games(game, exclude=()):
+    """Returns the games recommended for the players of a game, best first,
+    leaving out the games with ids in exclude.
+    """
+    recommendations = (Recommendation.objects
+        .filter(game=game)
+        .select_related('recommended')
+        .order_by('rank'))
+    return [r.recommended for r in recommendations if r.recommended_id not in exclude]
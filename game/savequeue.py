@@ -0,0 +1,367 @@
+"""Write-behind queue for the SAVE, SAVE_PATCH and SCORE messages of games.
+
+Games may send SAVE and SCORE messages as often as they like, see
+game.views.update_played_game and update_played_game_batch. The messages do not
+write to the GamePlayed row of the player one by one. The columns they change
+are merged into a pending write for the player and game in the cache instead,
+where a later message replaces what an earlier one set. The pending write is
+written with one UPDATE of just the changed columns by the first request of the
+player after settings.SAVE_QUEUE_FLUSH_INTERVAL seconds have passed since its
+first change, so a game writes at most once per interval for each player.
+LOAD_REQUEST messages are answered from the pending state if there is one.
+
+The pending writes are kept in the cache shared by the processes, see CACHES in
+gameHub.settings, so the next message of a player is applied to the newest
+pending state by whichever process handles it. A request holds a lock on the
+pending write, taken with cache.add, while it applies its messages, so the
+requests of a player are applied one after the other.
+
+Each process also remembers the players and games it has queued writes for, and
+flushes those which are still pending at the end of its first request after the
+interval has passed since its last flush, for players who stopped sending. The
+flush_saves management command, run from cron, flushes the pending writes of
+every player, like those of a process which has been stopped. Pending writes are
+only kept in the cache, so restarting the cache loses the saves made since the
+last flush.
+
+Saved states are versioned. Each save of a changed state increments
+GamePlayed.version, and a SAVE carrying the version it was based on is refused
+with Conflict if the state has been saved since, by another tab for example.
+The check is made against the pending state, and again when flushing, with an
+UPDATE ... WHERE version = n of the version the pending state was based on, so
+no rows are locked. A pending state losing that race is dropped. SAVE messages
+without a version, sent by games which do not know about versions, save over
+any version as they always have, so a pending write made only of them is
+written without the check, and adds its saves to the stored version.
+
+A SAVE_PATCH message saves a change of the newest state as JSON Patch
+operations against its version, instead of the full state. The operations are
+applied to the newest state and the merged state is saved like a SAVE. A patch
+against another version, or which does not apply, is refused with PatchFailed,
+and the game saves the full state instead.
+
+Scores are recorded in the cached leaderboard of the game when they are
+written, see game.leaderboard, so the leaderboard never shows a score which is
+not stored.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from . import leaderboard, savestate, statepatch
+from .models import GamePlayed
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'game.savequeue.{0}.{1}'
+LOCK_KEY = 'game.savequeue.{0}.{1}.lock'
+
+#seconds a lock is held at most, should its holder die, and the number of times
+#and seconds apart a request tries to take it
+LOCK_TIMEOUT = 5
+LOCK_ATTEMPTS = 100
+LOCK_WAIT = 0.01
+
+class Conflict(Exception):
+    """Raised for a SAVE based on a version of the state which is not the newest.
+    """
+
+    def __init__(self, version):
+        super().__init__('the game was saved elsewhere, load it first')
+        self.version = version
+
+class PatchFailed(Exception):
+    """Raised for a SAVE_PATCH which cannot be applied, the full state has to be
+    saved instead.
+    """
+
+    def __init__(self, version, reason):
+        super().__init__('the patch cannot be applied: {0}'.format(reason))
+        self.version = version
+
+class Busy(Exception):
+    """Raised when the pending write of a player's game stays locked by another
+    request.
+    """
+
+    def __init__(self):
+        super().__init__('the game is being saved, try again')
+
+_lock = threading.Lock()
+_pending = set()
+_last_flush = time.monotonic()
+
+def pending(user_id, game_id):
+    """Returns the pending write of a player's game, as a dict with the keys:
+
+    - columns: the GamePlayed column values to write.
+    - stored: the stateHash, gameScore and version stored in the database, when
+      they have been read.
+    - queued: the time of the first change of the pending write.
+    - versioned: True if a save of the pending write was based on a version.
+
+    The dict is empty if nothing is pending.
+    """
+    return cache.get(CACHE_KEY.format(user_id, game_id)) or {}
+
+def version(game_played):
+    """Returns the newest version of the saved state of a GamePlayed, pending or
+    stored.
+    """
+    columns = pending(game_played.user_id, game_played.game_id).get('columns', {})
+    return columns.get('version', game_played.version)
+
+class Writes:
+    """The pending write of a player's game, as changed by the messages of one
+    request. Used as a context manager, which holds the lock of the pending write:
+
+        with Writes(user_id, game_id) as writes:
+            writes.save(data, state)
+            writes.flush()
+
+    The changes are only kept by flush().
+    """
+
+    def __init__(self, user_id, game_id):
+        self.user_id = user_id
+        self.game_id = game_id
+        self.entry = None
+
+    def __enter__(self):
+        lock = LOCK_KEY.format(self.user_id, self.game_id)
+        for attempt in range(LOCK_ATTEMPTS):
+            if cache.add(lock, True, LOCK_TIMEOUT):
+                break
+            time.sleep(LOCK_WAIT)
+        else:
+            raise Busy()
+        self.entry = pending(self.user_id, self.game_id)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.entry = None
+        cache.delete(LOCK_KEY.format(self.user_id, self.game_id))
+        if time.monotonic() - _last_flush >= settings.SAVE_QUEUE_FLUSH_INTERVAL:
+            try:
+                flush()
+            except Exception:
+                logger.exception('game.savequeue: flush failed')
+
+    @property
+    def columns(self):
+        """The GamePlayed column values to write.
+        """
+        return self.entry.setdefault('columns', {})
+
+    def current(self, field):
+        """Returns the newest value of the stateHash, gameScore or version of the
+        game, pending or stored. The stored values are read once.
+        """
+        if field in self.columns:
+            return self.columns[field]
+        if 'stored' not in self.entry:
+            stored = (GamePlayed.objects
+                .filter(user_id=self.user_id, game_id=self.game_id)
+                .values('stateHash', 'gameScore', 'version')
+                .first())
+            self.entry['stored'] = stored or {'stateHash': '', 'gameScore': 0, 'version': 0}
+        return self.entry['stored'][field]
+
+    def _queue(self, columns):
+        self.columns.update(columns)
+        self.entry.setdefault('queued', time.time())
+
+    def save(self, data, state, version=None):
+        """Applies a SAVE message. A message equal to the newest state is ignored.
+
+        Args:
+            version - The version of the state the message is based on, or None to
+                save over any version.
+
+        Raises ValueError if the message is larger than
+        settings.SAVE_STATE_MAX_SIZE, and Conflict if version is not the newest
+        version.
+
+        Return:
+            The version of the state after the save.
+        """
+        columns = savestate.columns(data, state)
+        score = state['score']
+        current = self.current('version')
+        if version is not None and version != current:
+            raise Conflict(current)
+        if columns['stateHash'] == self.current('stateHash'):
+            return current
+        if score > self.current('gameScore'):
+            columns['gameScore'] = score
+        columns['version'] = current + 1
+        self._queue(columns)
+        if version is not None:
+            self.entry['versioned'] = True
+        return current + 1
+
+    def patch(self, operations, version):
+        """Applies a SAVE_PATCH message, which saves the newest state with a list
+        of JSON Patch operations applied to its gameState, see game.statepatch.
+
+        Args:
+            version - The version of the state the operations apply to.
+
+        Raises PatchFailed if version is not the newest version, or the operations
+        cannot be applied, and otherwise as save().
+
+        Return:
+            As save().
+        """
+        try:
+            data, current = self.load()
+            message = json.loads(data)
+            state = message['gameState']
+        except (ValueError, TypeError, KeyError):
+            raise PatchFailed(version, 'no saved state')
+        if current != version:
+            raise PatchFailed(current, 'the state has version {0}'.format(current))
+        try:
+            message['gameState'] = statepatch.apply(state, operations)
+        except ValueError as error:
+            raise PatchFailed(current, error)
+        #saved over the version patched, a save made meanwhile conflicts
+        return self.save(json.dumps(message), message['gameState'], version)
+
+    def score(self, score):
+        """Applies a SCORE message, which replaces the score of the player.
+        """
+        self._queue({'gameScore': score})
+
+    def load(self):
+        """Returns the newest SAVE message of the game, pending or stored, as text,
+        and its version.
+
+        Raises GamePlayed.DoesNotExist if the player does not own the game.
+        """
+        if 'stateHash' in self.columns:
+            game_played = GamePlayed(**self.columns)
+        else:
+            game_played = (GamePlayed.objects
+                .only('stateEncoding', 'version', *savestate.STATE_FIELDS)
+                .get(user_id=self.user_id, game_id=self.game_id))
+        return savestate.load(game_played), game_played.version
+
+    def flush(self, force=False):
+        """Keeps the changes in the cache, and writes them to the database if
+        settings.SAVE_QUEUE_FLUSH_INTERVAL seconds have passed since the first
+        change, or force is True.
+
+        Raises Conflict if a save of the pending write was based on a version, and
+        the state has been saved since the pending state was read, by something
+        else than the queue. Only a higher score is written then, and the pending
+        write is dropped.
+
+        Return:
+            The number of rows written.
+        """
+        if not self.entry.get('columns'):
+            return 0
+        key = CACHE_KEY.format(self.user_id, self.game_id)
+        #kept until written, a write failing in the database is tried again
+        cache.set(key, self.entry, None)
+        if not force and time.time() - self.entry['queued'] < settings.SAVE_QUEUE_FLUSH_INTERVAL:
+            with _lock:
+                _pending.add((self.user_id, self.game_id))
+            return 0
+        entry, self.entry = self.entry, {}
+        try:
+            written = _write(self.user_id, self.game_id, entry)
+        except Conflict:
+            cache.delete(key)
+            raise
+        except:
+            self.entry = entry
+            raise
+        cache.delete(key)
+        return written
+
+def _write(user_id, game_id, entry):
+    columns = entry['columns']
+    rows = GamePlayed.objects.filter(user_id=user_id, game_id=game_id)
+    #a write failing in the database leaves the transaction of the caller usable
+    with transaction.atomic():
+        if 'version' not in columns:
+            written = rows.update(**columns)
+        elif not entry.get('versioned'):
+            #saved over any version, moved on by the number of saves
+            saves = columns['version'] - entry['stored']['version']
+            written = rows.update(**dict(columns, version=F('version') + saves))
+        else:
+            #saved over the version the pending state was based on
+            written = rows.filter(version=entry['stored']['version']).update(**columns)
+            if not written:
+                #a higher score is kept, it does not depend on the state
+                if 'gameScore' in columns:
+                    rows.filter(gameScore__lt=columns['gameScore']).update(gameScore=columns['gameScore'])
+                version = rows.values_list('version', flat=True).first() or 0
+    if 'version' in columns and entry.get('versioned') and not written:
+        logger.warning('game.savequeue: save of game %s by user %s conflicts, dropped',
+            game_id, user_id)
+        leaderboard.invalidate(game_id)
+        raise Conflict(version)
+    if written and 'gameScore' in columns:
+        username = User.objects.filter(pk=user_id).values_list('username', flat=True).first()
+        leaderboard.record_score(game_id, username, columns['gameScore'])
+    logger.debug('game.savequeue: wrote game %s of user %s', game_id, user_id)
+    return written
+
+def flush(keys=None):
+    """Writes pending writes to the database.
+
+    Args:
+        keys - The (user id, game id) pairs to write. Defaults to the pairs this
+            process has queued writes for since its last flush.
+
+    Return:
+        The number of rows written.
+    """
+    global _last_flush, _pending
+    if keys is None:
+        with _lock:
+            keys, _pending = _pending, set()
+            _last_flush = time.monotonic()
+    keys = list(keys)
+    queued = cache.get_many([CACHE_KEY.format(*key) for key in keys])
+    written = 0
+    for user_id, game_id in keys:
+        if CACHE_KEY.format(user_id, game_id) not in queued:
+            continue
+        try:
+            with Writes(user_id, game_id) as writes:
+                written += writes.flush(force=True)
+        except Conflict:
+            pass
+        except Busy:
+            #flushed by the request holding it, or by the next flush
+            logger.warning('game.savequeue: game %s of user %s is locked, not flushed',
+                game_id, user_id)
+    logger.debug('game.savequeue.flush: %d rows', written)
+    return written
+
+def flush_all(batch_size=1000):
+    """Writes the pending writes of every player to the database.
+
+    Return:
+        The number of rows written.
+    """
+    total = flush()
+    keys = list(GamePlayed.objects
+        .filter(user__isnull=False, game__isnull=False)
+        .values_list('user_id', 'game_id'))
+    for i in range(0, len(keys), batch_size):
+        total += flush(keys[i:i + batch_size])
+    return total
@@ -0,0 +1,91 @@
+"""Storage of saved game states.
+
+Games save their state with SAVE messages, see game.views.update_played_game,
+and the message is stored in the GamePlayed of the player. Messages up to
+settings.SAVE_STATE_COMPRESS_THRESHOLD bytes are stored as text in gameState,
+as before. Larger ones are compressed with zlib and stored in the binary
+stateData column, with stateEncoding telling how, and gameState left empty.
+
+Messages larger than settings.SAVE_STATE_MAX_SIZE bytes are rejected. The
+SHA-256 hash of the stored message is kept in stateHash, so that game.savequeue
+can skip saves of the message already stored without writing to the database.
+
+The sizes of the messages and of what is stored for them are kept in stateSize
+and stateStoredSize, and summed up for each game by metrics().
+"""
+
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.db.models import Count, Max, Q, Sum
+
+from .models import GamePlayed
+
+ZLIB = 'zlib'
+
+#the columns of the stored state, deferred where the state is not needed
+STATE_FIELDS = ('gameState', 'stateData')
+
+def columns(data, state):
+    """Returns the values of the GamePlayed columns storing a SAVE message, as a
+    dict.
+
+    Raises ValueError if the message is larger than settings.SAVE_STATE_MAX_SIZE.
+
+    Args:
+        data - The SAVE message, as sent by the game
+        state - The gameState dict of the message
+    """
+    raw = data.encode('utf-8')
+    if len(raw) > settings.SAVE_STATE_MAX_SIZE:
+        raise ValueError('game state of {0} bytes is larger than the maximum of {1} bytes'.format(
+            len(raw), settings.SAVE_STATE_MAX_SIZE))
+    savedScore, savedItems = GamePlayed.summarize_state(state)
+    values = {
+        'gameState': data,
+        'stateData': None,
+        'stateEncoding': '',
+        'stateHash': hashlib.sha256(raw).hexdigest(),
+        'stateSize': len(raw),
+        'stateStoredSize': len(raw),
+        'savedScore': savedScore,
+        'savedItems': savedItems,
+    }
+    if len(raw) > settings.SAVE_STATE_COMPRESS_THRESHOLD:
+        compressed = zlib.compress(raw)
+        #states which do not compress are kept as text
+        if len(compressed) < len(raw):
+            values.update(
+                gameState='',
+                stateData=compressed,
+                stateEncoding=ZLIB,
+                stateStoredSize=len(compressed)
+            )
+    return values
+
+def load(game_played):
+    """Returns the saved SAVE message of a GamePlayed, as text. Only the STATE_FIELDS
+    and stateEncoding of game_played are read.
+    """
+    if game_played.stateEncoding == ZLIB:
+        return zlib.decompress(bytes(game_played.stateData)).decode('utf-8')
+    return game_played.gameState
+
+def metrics(game):
+    """Returns the size metrics of the saved states of a game, as a dict of:
+
+        saves - number of players with a saved state
+        size - total size of the saved states, in bytes
+        stored_size - total size stored for them, in bytes
+        max_size - size of the largest saved state, in bytes
+        compressed - number of saved states stored compressed
+    """
+    result = GamePlayed.objects.filter(game=game, stateSize__gt=0).aggregate(
+        saves=Count('pk'),
+        size=Sum('stateSize'),
+        stored_size=Sum('stateStoredSize'),
+        max_size=Max('stateSize'),
+        compressed=Count('pk', filter=Q(stateEncoding=ZLIB))
+    )
+    return {key: value or 0 for key, value in result.items()}
@@ -0,0 +1,182 @@
+"""Full-text search index for games.
+
+The index covers the title and description of every game and is kept in a side
+table next to game_game:
+
+- SQLite: an FTS5 virtual table, game_game_fts, keyed by the game id as rowid.
+- PostgreSQL: a table game_game_search holding a tsvector per game, with a GIN
+  index on it.
+
+The tables are created by migration 0035_game_search_index and kept in sync by
+the Game post_save and post_delete signal handlers in game.signals. On any other
+database backend, or if SQLite was compiled without FTS5, the index is disabled
+and Game.search falls back to substring matching.
+
+Search terms match on word prefixes, so 'gam' finds 'game' and 'games'. Quoted
+phrases must appear as consecutive words.
+"""
+
+import logging
+import re
+
+from django.db import connection as default_connection
+from django.db.utils import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+SQLITE_TABLE = 'game_game_fts'
+POSTGRES_TABLE = 'game_game_search'
+
+# The same parser Game.search has always used: quoted phrases or single words.
+QUERY_RE = re.compile(r'"(.+)"|(\S+)')
+WORD_RE = re.compile(r'\w+')
+
+_enabled = {}
+
+def parse_query(q):
+    """Splits a search query string into terms. A term is either a quoted phrase
+    or a single word.
+    """
+    return [m[0] if len(m[0]) > 0 else m[1] for m in QUERY_RE.findall(q)]
+
+def create_index(connection):
+    """Creates the index table for the database behind connection, and fills it
+    with the games already in the database.
+
+    Returns False if the backend does not support full-text indexing.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'CREATE VIRTUAL TABLE {0} USING fts5(title, description)'
+                    .format(SQLITE_TABLE))
+            except DatabaseError:
+                logger.warning('SQLite has no FTS5 support, search index disabled')
+                return False
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                'CREATE TABLE {0} ('
+                'game_id integer PRIMARY KEY REFERENCES game_game (id) '
+                'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, '
+                'document tsvector NOT NULL)'.format(POSTGRES_TABLE))
+            cursor.execute(
+                'CREATE INDEX {0}_document_gin ON {0} USING gin (document)'
+                .format(POSTGRES_TABLE))
+        else:
+            return False
+    _enabled[connection.alias] = True
+    rebuild_index(connection)
+    return True
+
+def drop_index(connection):
+    """Drops the index table, if there is one."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('DROP TABLE IF EXISTS {0}'.format(SQLITE_TABLE))
+        elif connection.vendor == 'postgresql':
+            cursor.execute('DROP TABLE IF EXISTS {0}'.format(POSTGRES_TABLE))
+    _enabled.pop(connection.alias, None)
+
+def is_enabled(connection=default_connection):
+    """Tells if the database behind connection has a search index. The result is
+    cached per database alias.
+    """
+    if connection.alias not in _enabled:
+        if connection.vendor == 'sqlite':
+            table = SQLITE_TABLE
+        elif connection.vendor == 'postgresql':
+            table = POSTGRES_TABLE
+        else:
+            table = None
+        _enabled[connection.alias] = (table is not None
+            and table in connection.introspection.table_names())
+    return _enabled[connection.alias]
+
+def rebuild_index(connection=default_connection):
+    """Replaces the contents of the index with the current games."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM {0}'.format(SQLITE_TABLE))
+            cursor.execute(
+                'INSERT INTO {0} (rowid, title, description) '
+                'SELECT id, title, description FROM game_game'
+                .format(SQLITE_TABLE))
+        elif connection.vendor == 'postgresql':
+            cursor.execute('DELETE FROM {0}'.format(POSTGRES_TABLE))
+            cursor.execute(
+                "INSERT INTO {0} (game_id, document) "
+                "SELECT id, to_tsvector('simple', title || ' ' || description) "
+                "FROM game_game".format(POSTGRES_TABLE))
+
+def index_game(game_id, connection=default_connection):
+    """Adds a game to the index, or updates its entry."""
+    if not is_enabled(connection):
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                'DELETE FROM {0} WHERE rowid = %s'.format(SQLITE_TABLE),
+                [game_id])
+            cursor.execute(
+                'INSERT INTO {0} (rowid, title, description) '
+                'SELECT id, title, description FROM game_game WHERE id = %s'
+                .format(SQLITE_TABLE), [game_id])
+        else:
+            cursor.execute(
+                "INSERT INTO {0} (game_id, document) "
+                "SELECT id, to_tsvector('simple', title || ' ' || description) "
+                "FROM game_game WHERE id = %s "
+                "ON CONFLICT (game_id) DO UPDATE SET document = EXCLUDED.document"
+                .format(POSTGRES_TABLE), [game_id])
+
+def unindex_game(game_id, connection=default_connection):
+    """Removes a game from the index."""
+    if not is_enabled(connection):
+        return
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(
+                'DELETE FROM {0} WHERE rowid = %s'.format(SQLITE_TABLE),
+                [game_id])
+        else:
+            cursor.execute(
+                'DELETE FROM {0} WHERE game_id = %s'.format(POSTGRES_TABLE),
+                [game_id])
+
+def match_expression(terms, vendor):
+    """Builds the full-text query for a list of terms, as returned by parse_query.
+    All terms must match. Terms without any word characters are ignored, and None
+    is returned if no term is left.
+    """
+    clauses = []
+    for term in terms:
+        words = WORD_RE.findall(term.lower())
+        if not words:
+            continue
+        if vendor == 'sqlite':
+            clauses.append('"{0}"*'.format(' '.join(words)))
+        else:
+            lexemes = ["'{0}'".format(word) for word in words]
+            lexemes[-1] += ':*'
+            clauses.append('(' + ' <-> '.join(lexemes) + ')')
+    if not clauses:
+        return None
+    return (' ' if vendor == 'sqlite' else ' & ').join(clauses)
+
+def filter_queryset(qset, terms, connection=default_connection):
+    """Restricts a Game queryset to the games matching all terms. Returns None if
+    the index is not enabled, in which case the caller should do the filtering.
+    """
+    if not is_enabled(connection):
+        return None
+    expression = match_expression(terms, connection.vendor)
+    if expression is None:
+        return qset
+    if connection.vendor == 'sqlite':
+        where = ('game_game.id IN (SELECT rowid FROM {0} WHERE {0} MATCH %s)'
+            .format(SQLITE_TABLE))
+    else:
+        where = ("game_game.id IN (SELECT game_id FROM {0} "
+            "WHERE document @@ to_tsquery('simple', %s))".format(POSTGRES_TABLE))
+    return qset.extra(where=[where], params=[expression])
@@ -1,9 +1,11 @@
 import logging
 
-from django.db.models.signals import pre_delete, post_save
+from django.db import connections
+from django.db.models.signals import pre_delete, post_delete, post_save
 from django.dispatch import receiver
 
-from .models import Game, PaymentDetail
+from . import catalog, imagejobs, leaderboard, search_index, thumbnails
+from .models import Game, GamePlayed, PaymentDetail
 
 logger = logging.getLogger(__name__)
 
@@ -11,15 +13,72 @@ logger = logging.getLogger(__name__)
 def gameDeleteHandler(sender, instance, **kwargs):
     """Signal handler for game.models.Game pre_delete.
     
-    This signal handler removes the gameimage file from the filesystem.
+    This signal handler removes the gameimage, the gamethumb, their responsive
+    variants, the uploaded original file and its cached thumbnails from the
+    filesystem. Files shared with other games are kept until no game references
+    them, see game.storage.
     """
-    instance.gameimage.delete(save=False)
+    imagejobs.delete_images(
+        instance.gameimage.name,
+        instance.gamethumb.name,
+        instance.imagevariants
+    )
+    if instance.gameoriginal:
+        thumbnails.purge(instance.gameoriginal.name)
+        instance.gameoriginal.delete(save=False)
+
+@receiver(post_save, sender=Game, dispatch_uid='game_save_search_receiver')
+def gameSaveSearchHandler(sender, instance, update_fields, using, **kwargs):
+    """Signal handler for game.models.Game post_save.
+
+    This handler updates the search index entry of the game. Saves restricted to
+    fields other than title and description leave the index alone.
+    """
+    if update_fields is not None and not {'title', 'description'} & set(update_fields):
+        return
+    search_index.index_game(instance.pk, connections[using])
+
+@receiver(post_delete, sender=Game, dispatch_uid='game_delete_search_receiver')
+def gameDeleteSearchHandler(sender, instance, using, **kwargs):
+    """Signal handler for game.models.Game post_delete.
+
+    This handler removes the game from the search index.
+    """
+    search_index.unindex_game(instance.pk, connections[using])
+
+@receiver(post_save, sender=Game, dispatch_uid='game_save_count_receiver')
+def gameSaveCountHandler(sender, instance, created, **kwargs):
+    """Signal handler for game.models.Game post_save.
+
+    This handler drops the cached number of games when a game is created.
+    """
+    if created:
+        catalog.invalidate_count()
+
+@receiver(post_delete, sender=Game, dispatch_uid='game_delete_count_receiver')
+def gameDeleteCountHandler(sender, instance, **kwargs):
+    """Signal handler for game.models.Game post_delete.
+
+    This handler drops the cached number of games.
+    """
+    catalog.invalidate_count()
 
 @receiver(post_save, sender=PaymentDetail, dispatch_uid='payment_deatil_save_receiver')
 def paymentDetailSaveHandler(sender, instance, created, **kwargs):
-    """Signal handler for game.models.PaymentDetail post_delete.
+    """Signal handler for game.models.PaymentDetail post_save.
     
-    This handler increases the sellcount and revenue of the game.
+    This handler increases the sellcount and revenue of the game, and drops the
+    cached leaderboard of the game so that the buyer is included.
     """
     if created:
-        instance.game_played.game.increment_sellcount(price=instance.cost)
\ No newline at end of file
+        instance.game_played.game.increment_sellcount(price=instance.cost)
+        leaderboard.invalidate(instance.game_played.game_id)
+
+@receiver(post_delete, sender=GamePlayed, dispatch_uid='game_played_delete_receiver')
+def gamePlayedDeleteHandler(sender, instance, **kwargs):
+    """Signal handler for game.models.GamePlayed post_delete.
+
+    This handler drops the cached leaderboard of the game.
+    """
+    if instance.game_id is not None:
+        leaderboard.invalidate(instance.game_id)
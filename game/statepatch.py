@@ -0,0 +1,140 @@
+"""JSON Patch, RFC 6902, for game states.
+
+Games save incremental changes to their state as a list of JSON Patch operations
+against the state saved before, instead of the full state, see SAVE_PATCH in
+game.savequeue. apply() applies such a list to a document decoded from JSON.
+
+All the operations of the RFC are supported: add, remove, replace, move, copy
+and test. Paths are JSON Pointers, RFC 6901, where '-' as the last token of an
+add appends to an array.
+"""
+
+import copy
+
+def parse_pointer(pointer):
+    """Returns the reference tokens of a JSON Pointer.
+    """
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith('/')):
+        raise ValueError('invalid pointer {0!r}'.format(pointer))
+    if not pointer:
+        return []
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def _index(container, token, append=False):
+    if append and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise ValueError('invalid array index {0!r}'.format(token))
+    index = int(token)
+    if index > len(container) or (index == len(container) and not append):
+        raise ValueError('array index {0} out of range'.format(index))
+    return index
+
+def _resolve(document, tokens):
+    for token in tokens:
+        if isinstance(document, dict):
+            if token not in document:
+                raise ValueError('no member {0!r}'.format(token))
+            document = document[token]
+        elif isinstance(document, list):
+            document = document[_index(document, token)]
+        else:
+            raise ValueError('cannot reference into {0!r}'.format(document))
+    return document
+
+def _add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, tokens[-1], append=True), value)
+    else:
+        raise ValueError('cannot add into {0!r}'.format(parent))
+    return document
+
+def _remove(document, tokens):
+    if not tokens:
+        raise ValueError('cannot remove the whole document')
+    parent = _resolve(document, tokens[:-1])
+    if isinstance(parent, dict):
+        if tokens[-1] not in parent:
+            raise ValueError('no member {0!r}'.format(tokens[-1]))
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, tokens[-1]))
+    raise ValueError('cannot remove from {0!r}'.format(parent))
+
+def _json_type(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, dict):
+        return 'object'
+    return 'null'
+
+def equal(a, b):
+    """Tells if two JSON values are equal as the test operation compares them: of
+    the same JSON type, numbers numerically equal, and arrays and objects with
+    equal members. Unlike Python ==, true is not equal to 1.
+    """
+    if _json_type(a) != _json_type(b):
+        return False
+    if isinstance(a, list):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(equal(a[key], b[key]) for key in a)
+    return a == b
+
+def apply(document, patch):
+    """Returns the document patched with a list of JSON Patch operations. The
+    document given is not changed.
+
+    Raises ValueError if the patch is not valid, cannot be applied to the
+    document, or a test operation fails.
+    """
+    if not isinstance(patch, list):
+        raise ValueError('a patch is a list of operations')
+    document = copy.deepcopy(document)
+    for operation in patch:
+        if not isinstance(operation, dict) or 'op' not in operation or 'path' not in operation:
+            raise ValueError('invalid operation {0!r}'.format(operation))
+        op = operation['op']
+        path = parse_pointer(operation['path'])
+        if op in ('add', 'replace', 'test') and 'value' not in operation:
+            raise ValueError('{0} operation without a value'.format(op))
+        if op in ('move', 'copy'):
+            if 'from' not in operation:
+                raise ValueError('{0} operation without from'.format(op))
+            source = parse_pointer(operation['from'])
+        if op == 'add':
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove(document, path)
+        elif op == 'replace':
+            _resolve(document, path)
+            if path:
+                _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            if path[:len(source)] == source and path != source:
+                raise ValueError('cannot move a value into itself')
+            if source:
+                value = _remove(document, source)
+            else:
+                value = document
+            document = _add(document, path, value)
+        elif op == 'copy':
+            document = _add(document, path, copy.deepcopy(_resolve(document, source)))
+        elif op == 'test':
+            if not equal(_resolve(document, path), operation['value']):
+                raise ValueError('test of {0!r} failed'.format(operation['path']))
+        else:
+            raise ValueError('unknown operation {0!r}'.format(op))
+    return document
@@ -5,11 +5,52 @@ $(document).ready(function () {
 
     //Game id and user_id from the hidden field to post the data
     var game_update_url = $("#game_update_url").val();
-    var game_highscore_url = $("#game_highscore_url").val();
-    //updates the highscore
-    setInterval(function () {
-        $("#gameresult").load(game_highscore_url);
-    }, 10000);
+    var game_leaderboard_url = $("#game_leaderboard_url").val();
+    //updates the highscore and the leaderboard. ifModified sends the ETag of the
+    //last response, unchanged leaderboards are answered with an empty 304
+    function updateLeaderboard() {
+        $.ajax({
+            url: game_leaderboard_url,
+            dataType: "json",
+            ifModified: true
+        }).done(function (data, status) {
+            if (status === "notmodified" || !data) {
+                return;
+            }
+            $("#gameresult").text(data.scores.length > 0 ? data.scores[0].score : "");
+            $("#leaderboard").empty();
+            $.each(data.scores, function (i, entry) {
+                $("<li>").text(entry.user + ": " + entry.score).appendTo("#leaderboard");
+            });
+        });
+    }
+    updateLeaderboard();
+
+    //falls back to polling if the browser has no EventSource, or the stream
+    //can not be kept open
+    var polling = null;
+    function startPolling() {
+        if (polling === null) {
+            polling = setInterval(updateLeaderboard, 10000);
+        }
+    }
+
+    //the highscore stream gives an event whenever the leaderboard changes. The
+    //server closes it after a while, and the browser reconnects
+    var game_highscore_stream_url = $("#game_highscore_stream_url").val();
+    if (window.EventSource && game_highscore_stream_url) {
+        var stream = new EventSource(game_highscore_stream_url);
+        stream.addEventListener("highscore", function () {
+            updateLeaderboard();
+        });
+        stream.onerror = function () {
+            if (stream.readyState === EventSource.CLOSED) {
+                startPolling();
+            }
+        };
+    } else {
+        startPolling();
+    }
 
     var csrftoken = getCookie("csrftoken");
     $.ajaxSetup({
@@ -18,27 +59,171 @@ $(document).ready(function () {
         }
     });
 
+    //messages of the game are buffered, and posted together to the batch url at
+    //most every message_delay milliseconds. A batch is only posted once the
+    //previous one is answered, so the messages are applied in the order sent
+    var game_update_batch_url = $("#game_update_batch_url").val();
+    var message_delay = 200;
+    var message_batch_size = 50;
+    var outgoing = [];
+    var flush_timer = null;
+    var posting = false;
+    //version of the saved state this page is based on, saves over a newer
+    //version, made in another tab, are answered with CONFLICT until the game loads
+    var state_version = parseInt($("#game_state_version").val(), 10);
+    //gameState saved at state_version, while it is known saves are sent as JSON
+    //Patch operations against it
+    var saved_state = null;
+
+    function answerGame(data) {
+        if (data.messageType === "LOAD" || data.messageType === "SAVED") {
+            state_version = data.version;
+        }
+        //sends event to the iframe if error or to be load the new data
+        if (data.messageType === "LOAD" || data.messageType === "ERROR" || data.messageType === "CONFLICT") {
+            var iframe_window = $("#game_iframe")[0].contentWindow;
+            iframe_window.postMessage(data, "*");
+        }
+    }
+
+    function isObject(value) {
+        return value !== null && typeof value === "object" && !Array.isArray(value);
+    }
+
+    function escapePointer(key) {
+        return key.replace(/~/g, "~0").replace(/\//g, "~1");
+    }
+
+    //returns the JSON Patch operations turning one object into another, arrays are
+    //replaced whole
+    function diffState(from, to, path, operations) {
+        Object.keys(from).forEach(function (key) {
+            if (!Object.prototype.hasOwnProperty.call(to, key)) {
+                operations.push({op: "remove", path: path + "/" + escapePointer(key)});
+            }
+        });
+        Object.keys(to).forEach(function (key) {
+            var child = path + "/" + escapePointer(key);
+            if (!Object.prototype.hasOwnProperty.call(from, key)) {
+                operations.push({op: "add", path: child, value: to[key]});
+            } else if (isObject(from[key]) && isObject(to[key])) {
+                diffState(from[key], to[key], child, operations);
+            } else if (JSON.stringify(from[key]) !== JSON.stringify(to[key])) {
+                operations.push({op: "replace", path: child, value: to[key]});
+            }
+        });
+        return operations;
+    }
+
+    //turns the saves of a batch into patches against the state saved before them,
+    //where that is shorter. Returns the gameState of each save by its index
+    function prepareBatch(batch) {
+        var base = saved_state;
+        var first = true;
+        var states = {};
+        $.each(batch, function (i, message) {
+            if (message.messageType === "LOAD_REQUEST") {
+                base = null;
+                first = false;
+            }
+            if (message.messageType !== "SAVE") {
+                return;
+            }
+            //the saves after the first follow on from it on the server
+            var versioned = first && !isNaN(state_version) ? {version: state_version} : {};
+            var full = $.extend({}, message, versioned);
+            batch[i] = full;
+            if (base !== null && isObject(base) && isObject(message.gameState)) {
+                var patch = $.extend({
+                    messageType: "SAVE_PATCH",
+                    patch: diffState(base, message.gameState, "", [])
+                }, versioned);
+                if (JSON.stringify(patch).length < JSON.stringify(full).length) {
+                    batch[i] = patch;
+                }
+            }
+            states[i] = message.gameState;
+            base = message.gameState;
+            first = false;
+        });
+        return states;
+    }
+
+    function postMessages() {
+        flush_timer = null;
+        if (posting || outgoing.length === 0) {
+            return;
+        }
+        posting = true;
+        var batch = outgoing.splice(0, message_batch_size);
+        var sent = batch.slice();
+        var states = prepareBatch(batch);
+        $.post(game_update_batch_url, {data: JSON.stringify(batch)})
+            .done(function (data) {
+                var fallback = null;
+                $.each(data.results, function (i, result) {
+                    if (result.messageType === "LOAD") {
+                        saved_state = result.gameState;
+                    } else if (result.messageType === "SAVED") {
+                        saved_state = states[i];
+                    } else if (result.messageType === "PATCH_FAILED" || result.messageType === "CONFLICT") {
+                        saved_state = null;
+                    }
+                    if (result.messageType === "PATCH_FAILED" && fallback === null) {
+                        //the newest state of the batch is saved in full instead, the
+                        //saves refused after the patch are not reported
+                        fallback = sent.filter(function (message) {
+                            return message.messageType === "SAVE";
+                        }).pop();
+                    }
+                    if (fallback === null || result.messageType !== "CONFLICT") {
+                        answerGame(result);
+                    }
+                });
+                if (fallback) {
+                    outgoing.unshift(fallback);
+                }
+            })
+            .fail(function () {
+                answerGame({messageType: "ERROR", info: "Error: the messages could not be sent"});
+            })
+            .always(function () {
+                posting = false;
+                if (outgoing.length > 0) {
+                    scheduleMessages();
+                }
+            });
+    }
+
+    function scheduleMessages() {
+        if (flush_timer === null) {
+            flush_timer = setTimeout(postMessages, message_delay);
+        }
+    }
+
+    //buffered messages are sent right away when the page is left, unless a batch
+    //is still being posted
+    $(window).on("pagehide", function () {
+        if (flush_timer !== null) {
+            clearTimeout(flush_timer);
+        }
+        postMessages();
+    });
+
     $(window).on("message", function (evt) {
         //Note that messages from all origins are accepted
         //Get data from sent message
         var data = evt.originalEvent.data;
 
         if (data.messageType) {
-            var posting;
             switch (data.messageType) {
             case "SETTING":
                 $("#game_iframe").attr("width", data.options.width);
                 $("#game_iframe").attr("height", data.options.height);
                 break;
             default:
-                posting = $.post(game_update_url, {data: JSON.stringify(data)});
-                posting.done(function (data) {
-                    //sends event to the iframe if error or to be load the new data
-                    if (data.messageType === "LOAD" || data.messageType === "ERROR") {
-                        var iframe_window = $("#game_iframe")[0].contentWindow;
-                        iframe_window.postMessage(data, "*");
-                    }
-                });
+                outgoing.push(data);
+                scheduleMessages();
             }
         }
     });
@@ -0,0 +1,114 @@
+"""Content addressed storage for uploaded media.
+
+Files are named after the SHA-256 hash of their content, as
+
+    content/<first two digits of the hash>/<hash><extension>
+
+so identical uploads, and identical images made from them, are stored once. The
+name given by upload_to is only used for its extension.
+
+Every save of a file counts as a reference to it, kept in the MediaFile table,
+and every delete drops one. The file itself is only deleted once no reference is
+left, after the transaction commits. Files saved under other names, before this
+storage was used, are not counted and are deleted right away, as before.
+
+This is the DEFAULT_FILE_STORAGE in settings.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import MediaFile
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'content/'
+
+def content_hash(content):
+    """Returns the SHA-256 hex digest of a django File.
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage which names files by the hash of their content and counts
+    the references to them.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        #the name is decided by _save, from the content
+        return name
+
+    def _save(self, name, content):
+        digest = content_hash(content)
+        extension = os.path.splitext(name)[1].lower()
+        name = '{0}{1}/{2}{3}'.format(PREFIX, digest[:2], digest, extension)
+        self.retain(name)
+        if not self.exists(name):
+            self._write(name, content)
+        return name
+
+    def _write(self, name, content):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        #concurrent saves of the same content each write their own temporary file,
+        #and replace the file with identical content
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in content.chunks():
+                    temp.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def retain(self, name):
+        """Adds a reference to a stored file. Used when a name is copied from one
+        record to another, since that does not go through save.
+        """
+        if not name.startswith(PREFIX):
+            return
+        if MediaFile.objects.filter(name=name).update(references=F('references') + 1):
+            return
+        try:
+            with transaction.atomic():
+                MediaFile.objects.create(name=name, references=1)
+        except IntegrityError:
+            #created concurrently
+            MediaFile.objects.filter(name=name).update(references=F('references') + 1)
+
+    def references(self, name):
+        """Returns the number of references to a stored file, None if it is not
+        counted.
+        """
+        return (MediaFile.objects.filter(name=name)
+            .values_list('references', flat=True).first())
+
+    def delete(self, name):
+        """Drops a reference to a file, and deletes it once the transaction commits
+        if no reference is left.
+        """
+        if not name.startswith(PREFIX):
+            super().delete(name)
+            return
+        MediaFile.objects.filter(name=name, references__gt=0).update(
+            references=F('references') - 1)
+        deleted, _ = MediaFile.objects.filter(name=name, references=0).delete()
+        if deleted:
+            transaction.on_commit(lambda: self._delete_unreferenced(name))
+
+    def _delete_unreferenced(self, name):
+        if not MediaFile.objects.filter(name=name).exists():
+            super().delete(name)
@@ -1,10 +1,13 @@
 from django import template
 
+from game import ownership
+
 register = template.Library()
 
 @register.filter(name='owns_game')
-def range_from(user, game):
-    """Tells if a user owns a game
+def owns_game(user, game):
+    """Tells if a user owns a game. The owned games are looked up once per request,
+    see game.ownership.
     """
-    return user.gameplayed_set.filter(game=game).exists()
+    return ownership.owns_game(user, game.pk)
     
\ No newline at end of file
@@ -0,0 +1,16 @@
+from django import template
+
+from game import thumbnails
+
+register = template.Library()
+
+@register.filter(name='thumbnail')
+def thumbnail(game, size):
+    """Returns the url of a thumbnail of the uploaded image of a game, in a size
+    given as '<width>x<height>', see game.thumbnails. Falls back on the stored
+    thumbnail for games uploaded without an original.
+    """
+    if not game.gameoriginal:
+        return game.gamethumb.url if game.gamethumb else ''
+    width, height = (int(value) for value in size.split('x'))
+    return thumbnails.url(width, height, game.gameoriginal.name)
@@ -1,15 +1,40 @@
 import pdb
 import logging
+import json
+import itertools
+import os
+import tracemalloc
 
+from datetime import datetime, time, timedelta
 from functools import reduce
+from importlib import import_module
+from io import BytesIO, StringIO
+from threading import Barrier, Thread
+from unittest import skipIf
+from tempfile import mkdtemp, TemporaryFile
+from shutil import copyfileobj, rmtree
+
+from PIL import Image
 from decimal import Decimal
 
-from django.test import TestCase, Client
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User, Group
 
-from game.models import Game, GamePlayed, PaymentDetail
+from game.models import Game, GamePlayed, PaymentDetail, ImageJob, MediaFile, DailyViews, Recommendation
+from gameHub.settings import ImageSizeEnum
 from game.models_helper import buy_game_for_user, rate_game_for_user
+from game import imagejobs, leaderboard, ownership, recommendations, savequeue, savestate, statepatch, thumbnails, trending, viewcount
 
 logger = logging.getLogger(__name__)
 
@@ -143,6 +168,34 @@ class GameSearchTest(TestCase):
         self.assertEquals(qset[2].pk, games[1].pk)
         self.assertEquals(qset[3].pk, games[0].pk)
 
+    def testIndexSync(self):
+        """Tests that the search index follows games being renamed and deleted.
+        """
+
+        game = Game.objects.get(title='game1')
+        game.title = 'renamed'
+        game.save()
+        self.assertEquals(len(Game.search('renamed')), 1)
+        self.assertEquals(len(Game.search('game')), 3)
+
+        game.delete()
+        self.assertEquals(len(Game.search('renamed')), 0)
+        self.assertEquals(len(Game.search('some')), 1)
+
+    def testPrefixSearch(self):
+        """Tests that words match on prefixes, and that quoted phrases match
+        consecutive words only.
+        """
+
+        qset = Game.search('descr')
+        self.assertEquals(len(qset), 2)
+        qset = Game.search('"has a"')
+        self.assertEquals(len(qset), 2)
+        qset = Game.search('"game has"')
+        self.assertEquals(len(qset), 1)
+        qset = Game.search('"has title"')
+        self.assertEquals(len(qset), 0)
+
 class SearchViewTest(TestCase):
     """Tests for the search view.
 
@@ -185,6 +238,17 @@ class SearchViewTest(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.content.count(b'game title'), 0)
 
+    def testSortLinks(self):
+        """Tests that the sort and page links keep the query, and leave it out when
+        listing all games."""
+
+        response = self.client.get(reverse('game:search'))
+        self.assertFalse(b'q=None' in response.content)
+        self.assertTrue(b'?sort=trending' in response.content)
+
+        response = self.client.get(reverse('game:search'), {'q': 'game title'})
+        self.assertTrue(b'?q=game%20title&sort=trending' in response.content)
+
     def testFailResponses(self):
         """Tests the fail conditions."""
 
@@ -345,6 +409,85 @@ class GameRatingTest(TestCase):
         game.refresh_from_db()
         self.assertEqual(game.get_rating_cleaned(), 5)
 
+class ConcurrentRatingTest(TransactionTestCase):
+    """Tests that the popularity stays correct when several users rate a game at
+    the same time.
+    """
+
+    def setUp(self):
+        logger.debug('game.ConcurrentRatingTest.setUp')
+        developer = get_user('dev')
+        self.game = Game.create(title='game', url='http://foobar.fi', developer=developer)
+        self.game.save()
+        self.users = [get_user('ply{}'.format(i)) for i in range(8)]
+        for user in self.users:
+            buy_game_for_user(user, self.game)
+
+    def assertStatistics(self):
+        """Checks the statistics of the game against the stored ratings.
+        """
+        self.game.refresh_from_db()
+        ratings = [gameplayed.rating for gameplayed in
+            GamePlayed.objects.filter(game=self.game).exclude(rating=0)]
+        self.assertEquals(self.game.ratings, len(ratings))
+        self.assertEquals(self.game.total_rating, sum(ratings))
+        self.assertEquals(self.game.sellcount, len(self.users))
+        self.assertAlmostEqual(
+            self.game.popularity,
+            len(self.users) * sum(ratings) / len(ratings)
+        )
+
+    def testStaleInstances(self):
+        """Rates through copies of the game and of the ratings loaded before any of
+        the ratings were given, as concurrent requests would have.
+        """
+        stale = list(GamePlayed.objects.filter(game=self.game).select_related('game'))
+        also_stale = list(GamePlayed.objects.filter(game=self.game).select_related('game'))
+        for i, gameplayed in enumerate(stale):
+            gameplayed.set_rating(i % 5 + 1)
+        self.assertStatistics()
+        for i, gameplayed in enumerate(also_stale):
+            gameplayed.set_rating((i + 2) % 5 + 1)
+        self.assertStatistics()
+
+    def testConcurrentRatings(self):
+        """Rates the game from several threads at once. The threads are started
+        together at a barrier, and a rating refused because SQLite has locked the
+        database for another writer is given again, as a request would be retried.
+        """
+        gameplayeds = list(GamePlayed.objects.filter(game=self.game))
+        barrier = Barrier(len(gameplayeds))
+        errors = []
+
+        def set_rating(gameplayed, rating):
+            while True:
+                try:
+                    return gameplayed.set_rating(rating)
+                except OperationalError as error:
+                    if 'locked' not in str(error):
+                        raise
+
+        def rate(gameplayed, rating):
+            try:
+                barrier.wait()
+                set_rating(gameplayed, rating)
+                set_rating(gameplayed, rating % 5 + 1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [
+            Thread(target=rate, args=(gameplayed, i % 5 + 1))
+            for i, gameplayed in enumerate(gameplayeds)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertStatistics()
+
 class StatisticsTest(TestCase):
     """Tests the statistics methods of the Game model.
     """
@@ -407,3 +550,1347 @@ class StatisticsTest(TestCase):
         self.assertEquals(games[0].revenue, Decimal(1.5))
         self.assertEquals(games[1].revenue, Decimal(4.5))
         self.assertEquals(games[2].revenue, Decimal(12.5))
+
+
+class ViewCountTest(TestCase):
+    """Tests the buffered view counter of the game detail page.
+    """
+
+    def setUp(self):
+        logger.debug('ViewCountTest.setUp')
+        cache.clear()
+        viewcount.flush()
+        self.client = Client()
+        user = get_user()
+        self.games = []
+        for i in range(3):
+            game = Game.create(title='game{}'.format(i), url='', developer=user)
+            game.save()
+            self.games.append(game)
+
+    @override_settings(VIEWCOUNT_FLUSH_INTERVAL=3600)
+    def testBuffering(self):
+        """Tests that views are not written until flushed, and that flushing
+        writes all of them.
+        """
+        for i, game in enumerate(self.games):
+            for j in range(i + 1):
+                response = self.client.get(reverse('game:detail', args=[game.pk]))
+                self.assertEquals(response.status_code, 200)
+        for i, game in enumerate(self.games):
+            game.refresh_from_db()
+            self.assertEquals(game.viewcount, 0)
+            self.assertEquals(viewcount.pending_views(game.pk), i + 1)
+
+        self.assertEquals(viewcount.flush(), 6)
+        for i, game in enumerate(self.games):
+            game.refresh_from_db()
+            self.assertEquals(game.viewcount, i + 1)
+            self.assertEquals(viewcount.pending_views(game.pk), 0)
+        self.assertEquals(viewcount.flush(), 0)
+
+    @override_settings(VIEWCOUNT_FLUSH_INTERVAL=0)
+    def testFlushInterval(self):
+        """Tests that views are written once the flush interval has passed.
+        """
+        self.client.get(reverse('game:detail', args=[self.games[0].pk]))
+        self.client.get(reverse('game:detail', args=[self.games[0].pk]))
+        self.games[0].refresh_from_db()
+        self.assertEquals(self.games[0].viewcount, 2)
+
+    @override_settings(VIEWCOUNT_FLUSH_INTERVAL=3600, VIEWCOUNT_FLUSH_THRESHOLD=3)
+    def testFlushThreshold(self):
+        """Tests that views are written once the process has counted the threshold.
+        """
+        for i in range(3):
+            self.client.get(reverse('game:detail', args=[self.games[i % 2].pk]))
+        self.games[0].refresh_from_db()
+        self.games[1].refresh_from_db()
+        self.assertEquals((self.games[0].viewcount, self.games[1].viewcount), (2, 1))
+        views = dict(DailyViews.objects.filter(day=timezone.now().date()).values_list('game', 'views'))
+        self.assertEquals(views, {self.games[0].pk: 2, self.games[1].pk: 1})
+
+    @override_settings(VIEWCOUNT_FLUSH_INTERVAL=3600)
+    def testFlushCommand(self):
+        """Tests that the flush_viewcounts command writes the views of all games,
+        including those not counted by this process.
+        """
+        viewcount.record_view(self.games[0].pk)
+        cache.set(viewcount.CACHE_KEY.format(self.games[1].pk), 4, timeout=None)
+        call_command('flush_viewcounts', stdout=StringIO())
+        self.games[0].refresh_from_db()
+        self.games[1].refresh_from_db()
+        self.assertEquals(self.games[0].viewcount, 1)
+        self.assertEquals(self.games[1].viewcount, 4)
+
+
+@override_settings(LEADERBOARD_SIZE=3)
+@override_settings(SAVE_QUEUE_FLUSH_INTERVAL=0)
+class LeaderboardTest(TestCase):
+    """Tests the cached leaderboard and its views.
+    """
+
+    def setUp(self):
+        logger.debug('LeaderboardTest.setUp')
+        cache.clear()
+        self.client = Client()
+        developer = get_user('dev')
+        self.game = Game.create(title='game', url='http://foobar.fi', developer=developer)
+        self.game.save()
+        self.users = [get_user('ply{}'.format(i)) for i in range(5)]
+        for i, user in enumerate(self.users):
+            buy_game_for_user(user, self.game)
+            GamePlayed.objects.filter(user=user, game=self.game).update(gameScore=i * 10)
+
+    def getLeaderboard(self, **kwargs):
+        return self.client.get(reverse('game:leaderboard', args=[self.game.pk]), **kwargs)
+
+    def sendScore(self, user, score):
+        self.client.force_login(user)
+        return self.client.post(reverse('game:update', args=[self.game.pk]), {
+            'data': json.dumps({'messageType': 'SCORE', 'score': score})
+        }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def testTopScores(self):
+        """Tests that the leaderboard gives the top scores, highest first.
+        """
+        response = self.getLeaderboard()
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content.decode())['scores'], [
+            {'user': 'ply4', 'score': 40},
+            {'user': 'ply3', 'score': 30},
+            {'user': 'ply2', 'score': 20},
+        ])
+        response = self.client.get(
+            reverse('game:leaderboard', args=[self.game.pk]), {'n': 1})
+        self.assertEquals(len(json.loads(response.content.decode())['scores']), 1)
+        response = self.client.get(reverse('game:leaderboard', args=[self.game.pk + 1]))
+        self.assertEquals(response.status_code, 404)
+
+    def testNotModified(self):
+        """Tests that polls with the current ETag are answered with 304 without
+        querying the database.
+        """
+        etag = self.getLeaderboard()['ETag']
+        with self.assertNumQueries(0):
+            response = self.getLeaderboard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        self.sendScore(self.users[0], 100)
+        self.client.logout()
+        response = self.getLeaderboard(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+
+    def testScoreUpdates(self):
+        """Tests that new scores are merged into the cached leaderboard, and that
+        lowered scores are reloaded from the database.
+        """
+        self.getLeaderboard()
+        self.sendScore(self.users[1], 35)
+        self.assertEquals(leaderboard.cached(self.game.pk)['scores'],
+            [['ply4', 40], ['ply1', 35], ['ply3', 30]])
+        self.sendScore(self.users[4], 5)
+        self.assertEquals(leaderboard.get(self.game.pk)['scores'],
+            [['ply1', 35], ['ply3', 30], ['ply2', 20]])
+
+    def testConcurrentScores(self):
+        """Tests that scores recorded at the same time are all kept.
+        """
+        leaderboard.get(self.game.pk)
+        threads = [Thread(target=leaderboard.record_score, args=(self.game.pk, 'new{}'.format(i), 100 + i))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(leaderboard.cached(self.game.pk)['scores'],
+            [['new2', 102], ['new1', 101], ['new0', 100]])
+
+    def testLocked(self):
+        """Tests that a score which cannot take the lock drops the leaderboard.
+        """
+        leaderboard.get(self.game.pk)
+        cache.add(leaderboard.LOCK_KEY.format(self.game.pk), True)
+        leaderboard.LOCK_WAIT, wait = 0, leaderboard.LOCK_WAIT
+        try:
+            leaderboard.record_score(self.game.pk, 'ply0', 100)
+        finally:
+            leaderboard.LOCK_WAIT = wait
+        self.assertEquals(leaderboard.cached(self.game.pk), None)
+
+    def testHighscore(self):
+        """Tests the highscore view.
+        """
+        response = self.client.get(
+            reverse('game:highscore', args=[self.game.pk]),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, b'40')
+
+
+@override_settings(HIGHSCORE_STREAM_INTERVAL=0.01, HIGHSCORE_STREAM_DURATION=60, SAVE_QUEUE_FLUSH_INTERVAL=0)
+class HighscoreStreamTest(TestCase):
+    """Tests the server-sent event stream of highscores.
+    """
+
+    def setUp(self):
+        logger.debug('HighscoreStreamTest.setUp')
+        cache.clear()
+        self.client = Client()
+        developer = get_user('dev')
+        self.game = Game.create(title='game', url='http://foobar.fi', developer=developer)
+        self.game.save()
+        self.user = get_user('ply')
+        buy_game_for_user(self.user, self.game)
+
+    def sendScore(self, score):
+        self.client.force_login(self.user)
+        self.client.post(reverse('game:update', args=[self.game.pk]), {
+            'data': json.dumps({'messageType': 'SCORE', 'score': score})
+        }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def readEvent(self, stream):
+        """Returns the data of the next event in the stream, skipping keepalives.
+        """
+        for chunk in stream:
+            chunk = chunk.decode()
+            if chunk.startswith('event: highscore'):
+                return json.loads(chunk.split('data: ')[1])
+
+    def testStream(self):
+        """Tests that the stream gives the current highscore, and then the new
+        highscores as they are recorded.
+        """
+        response = self.client.get(reverse('game:highscore_stream', args=[self.game.pk]))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertEquals(self.readEvent(stream)['score'], 0)
+        self.sendScore(10)
+        self.assertEquals(self.readEvent(stream)['score'], 10)
+        self.sendScore(20)
+        self.assertEquals(self.readEvent(stream)['score'], 20)
+        response.close()
+
+    def testUncached(self):
+        """Tests that a score is seen when the leaderboard has been dropped from the
+        cache, as when another process records it.
+        """
+        response = self.client.get(reverse('game:highscore_stream', args=[self.game.pk]))
+        stream = iter(response.streaming_content)
+        self.readEvent(stream)
+        GamePlayed.objects.filter(game=self.game).update(gameScore=30)
+        leaderboard.invalidate(self.game.pk)
+        self.assertEquals(self.readEvent(stream)['score'], 30)
+        response.close()
+
+    @override_settings(HIGHSCORE_STREAM_DURATION=0.1)
+    def testDuration(self):
+        """Tests that the stream ends after settings.HIGHSCORE_STREAM_DURATION.
+        """
+        response = self.client.get(reverse('game:highscore_stream', args=[self.game.pk]))
+        chunks = [chunk.decode() for chunk in response.streaming_content]
+        self.assertEquals(chunks[0], 'retry: {0}\n\n'.format(settings.HIGHSCORE_STREAM_RETRY))
+        self.assertEquals(sum(chunk.startswith('event: highscore') for chunk in chunks), 1)
+
+    def testNotFound(self):
+        response = self.client.get(reverse('game:highscore_stream', args=[self.game.pk + 1]))
+        self.assertEquals(response.status_code, 404)
+
+
+class OwnershipTest(TestCase):
+    """Tests the lookup of owned games shared by the views and templates.
+    """
+
+    def setUp(self):
+        logger.debug('OwnershipTest.setUp')
+        cache.clear()
+        self.client = Client()
+        developer = get_user('dev')
+        self.user = get_user('ply')
+        for i in range(20):
+            game = Game.create(title='game{}'.format(i), url='http://foobar.fi', developer=developer)
+            game.save()
+            if i % 2 == 0:
+                buy_game_for_user(self.user, game)
+        self.client.force_login(self.user)
+
+    def ownershipQueries(self, queries):
+        return [q for q in queries if 'game_gameplayed' in q['sql']]
+
+    def testSearchPage(self):
+        """Tests that a search page checks ownership with a single query.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('game:search'), {'q': 'game'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content.count(b'Play Game!'), 10)
+        self.assertEquals(response.content.count(b'Buy Game!'), 10)
+        self.assertEquals(len(self.ownershipQueries(queries)), 1)
+
+    def testPurchaseInvalidates(self):
+        """Tests that buying a game updates the owned games.
+        """
+        game = Game.objects.get(title='game1')
+        self.assertFalse(game.pk in ownership.owned_game_ids(get_user('other')))
+        response = self.client.get(reverse('game:purchase', args=[game.pk]))
+        self.assertEquals(response.status_code, 200)
+        buy_game_for_user(self.user, game)
+        response = self.client.get(reverse('game:purchase', args=[game.pk]))
+        self.assertEquals(response.status_code, 302)
+
+    def testPlayerRequired(self):
+        """Tests the responses of game_player_required.
+        """
+        owned = Game.objects.get(title='game0')
+        other = Game.objects.get(title='game1')
+        url = lambda pk: reverse('game:rate', args=[pk])
+        headers = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+        self.assertEquals(self.client.post(url(owned.pk), {'rating': 3}, **headers).status_code, 200)
+        self.assertEquals(self.client.post(url(other.pk), {'rating': 3}, **headers).status_code, 403)
+        self.assertEquals(self.client.post(url(other.pk + 100), {'rating': 3}, **headers).status_code, 404)
+        self.client.logout()
+        self.assertEquals(self.client.post(url(owned.pk), {'rating': 3}, **headers).status_code, 403)
+
+
+def make_image(name='image.png', size=(1600, 1200), fmt='PNG', color=(200, 100, 50)):
+    """Creates an uploadable image file.
+    """
+    stream = BytesIO()
+    Image.new('RGB', size, color).save(stream, fmt)
+    return SimpleUploadedFile(name, stream.getvalue())
+
+class ImageJobTest(TestCase):
+    """Tests the background processing of uploaded images.
+    """
+
+    def setUp(self):
+        logger.debug('ImageJobTest.setUp')
+        self.media_root = mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.client = Client()
+        group = Group.objects.get(name='Developer')
+        self.user = get_user('dev')
+        group.user_set.add(self.user)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.settings.disable()
+        rmtree(self.media_root)
+
+    def upload(self, title, image):
+        return self.client.post(reverse('game:upload'), {
+            'title': title,
+            'url': 'http://google.com',
+            'price': '0.50',
+            'description': 'This here is a game',
+            'gameimage': image,
+        })
+
+    def upload_streamed(self, title, path):
+        """Uploads an image from a file, streaming the request body from a temporary
+        file rather than building it in memory like Client.post does.
+        """
+        boundary = 'BoUnDaRyStRiNg'
+        body = TemporaryFile()
+        fields = {
+            'title': title,
+            'url': 'http://google.com',
+            'price': '0.50',
+            'description': 'This here is a game',
+        }
+        for key, value in fields.items():
+            body.write('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'
+                .format(boundary, key, value).encode())
+        body.write('--{0}\r\nContent-Disposition: form-data; name="gameimage"; filename="{1}"\r\n'
+            'Content-Type: image/jpeg\r\n\r\n'.format(boundary, os.path.basename(path)).encode())
+        with open(path, 'rb') as image:
+            copyfileobj(image, body)
+        body.write('\r\n--{0}--\r\n'.format(boundary).encode())
+        length = body.tell()
+        body.seek(0)
+        environ = self.client._base_environ(**{
+            'PATH_INFO': reverse('game:upload'),
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': 'multipart/form-data; boundary=' + boundary,
+            'CONTENT_LENGTH': str(length),
+            'wsgi.input': body,
+        })
+        try:
+            return self.client.handler(environ)
+        finally:
+            body.close()
+
+    def testUpload(self):
+        """Tests that uploads are stored as is, and the job fills in the cover and
+        thumbnail.
+        """
+        response = self.upload('somegame', make_image())
+        self.assertEquals(response.status_code, 302)
+        game = Game.objects.get(title='somegame')
+        self.assertTrue(game.gameoriginal)
+        self.assertFalse(game.gameimage)
+        self.assertTrue(game.image_pending)
+        response = self.client.get(reverse('game:detail', args=[game.pk]))
+        self.assertTrue(b'being processed' in response.content)
+
+        job = ImageJob.objects.get(game=game)
+        self.assertEquals(job.status, ImageJob.PENDING)
+        self.assertTrue(imagejobs.process(job.pk))
+        self.assertFalse(imagejobs.process(job.pk))
+        job.refresh_from_db()
+        self.assertEquals(job.status, ImageJob.DONE)
+
+        game.refresh_from_db()
+        self.assertFalse(game.image_pending)
+        self.assertEquals(Image.open(game.gameimage).size, (1280, 720))
+        self.assertEquals(Image.open(game.gamethumb).size, (500, 400))
+        self.assertEquals(Image.open(game.gameoriginal).size, (1600, 1200))
+
+    @override_settings(IMAGE_VARIANT_WIDTHS={'COVER': (320, 640), 'THUMBNAIL': (250,)})
+    def testVariants(self):
+        """Tests that the responsive variants are made, offered to the templates and
+        deleted with the game.
+        """
+        self.upload('somegame', make_image('image.jpg', fmt='JPEG'))
+        game = Game.objects.get(title='somegame')
+        imagejobs.process(ImageJob.objects.get(game=game).pk)
+        game.refresh_from_db()
+        variants = json.loads(game.imagevariants)
+        names = []
+        for size, widths in [('COVER', [320, 640, 1280]), ('THUMBNAIL', [250, 500])]:
+            for mime_type in ['image/webp', 'image/jpeg']:
+                entries = variants[size][mime_type]
+                self.assertEquals([width for width, name in entries], widths)
+                for width, name in entries:
+                    self.assertEquals(Image.open(default_storage.open(name)).size[0], width)
+                    names.append(name)
+        self.assertTrue(game.gameimage.name in names)
+        sources = game.cover_sources
+        self.assertEquals([mime_type for mime_type, srcset in sources], ['image/webp', 'image/jpeg'])
+        self.assertTrue(sources[0][1].endswith(' 1280w'))
+
+        response = self.client.get(reverse('game:search') + '?q=somegame')
+        self.assertTrue(b'<source type="image/webp"' in response.content)
+        game.delete()
+        self.assertFalse(MediaFile.objects.filter(name__in=names).exists())
+
+    def testInvalidImage(self):
+        """Tests that images in unsupported formats are rejected up front.
+        """
+        response = self.upload('somegame', make_image('image.bmp', fmt='BMP'))
+        self.assertEquals(response['location'], reverse('game:upload'))
+        self.assertFalse(Game.objects.filter(title='somegame').exists())
+
+    def testReducedDecode(self):
+        """Tests that large JPEG images are decoded at reduced resolution, still
+        at least twice the size needed.
+        """
+        image = Game.open_image(make_image('image.jpg', (4000, 3000), 'JPEG'), [(500, 400)])
+        image.load()
+        self.assertEquals(image.size, (2000, 1500))
+        cover, = Game.resize_images(make_image('image.jpg', (4000, 3000), 'JPEG'),
+            'image.jpg', [ImageSizeEnum.COVER])
+        self.assertEquals(Image.open(cover).size, (1280, 720))
+
+    def testLargeImage(self):
+        """Tests that uploading and processing a large image never holds the file in
+        memory. Memory allocated by Python is traced, which excludes the decoded
+        pixels, bounded by IMAGE_MAX_PIXELS and reduced decoding, but includes the
+        encoded variants, bounded by their size.
+        """
+        path = os.path.join(self.media_root, 'large.jpg')
+        Image.effect_noise((6000, 4000), 64).convert('RGB').save(path, 'JPEG', quality=95)
+        size = os.path.getsize(path)
+        self.assertGreater(size, 16 * 1024 * 1024)
+        tracemalloc.start()
+        try:
+            response = self.upload_streamed('somegame', path)
+            self.assertEquals(response.status_code, 302)
+            game = Game.objects.get(title='somegame')
+            self.assertTrue(imagejobs.process(ImageJob.objects.get(game=game).pk))
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, size / 2)
+        game.refresh_from_db()
+        self.assertEquals(Image.open(game.gameimage).size, (1280, 720))
+
+    @override_settings(IMAGE_MAX_PIXELS=1000 * 1000)
+    def testPixelLimit(self):
+        """Tests that images with too many pixels are rejected before decoding.
+        """
+        with self.assertRaises(ValueError):
+            Game.open_image(make_image(size=(1001, 1000)))
+        response = self.upload('somegame', make_image(size=(1001, 1000)))
+        self.assertEquals(response['location'], reverse('game:upload'))
+        self.assertFalse(Game.objects.filter(title='somegame').exists())
+
+    def testSuperseded(self):
+        """Tests that a job for an older upload does not overwrite a newer one.
+        """
+        self.upload('somegame', make_image('first.png'))
+        game = Game.objects.get(title='somegame')
+        response = self.client.post(reverse('game:game_update', args=[game.pk]), {
+            'title': 'somegame',
+            'url': 'http://google.com',
+            'price': '0.50',
+            'description': 'This here is a game',
+            'gameimage': make_image('second.png', size=(800, 600), color=(0, 0, 255)),
+        })
+        self.assertEquals(response.status_code, 302)
+        first, second = ImageJob.objects.filter(game=game).order_by('pk')
+        self.assertTrue(imagejobs.process(second.pk))
+        self.assertTrue(imagejobs.process(first.pk))
+        game.refresh_from_db()
+        self.assertEquals(Image.open(game.gameimage).getpixel((0, 0)), (0, 0, 255))
+
+    def testCommand(self):
+        """Tests that the management command runs the pending jobs.
+        """
+        self.upload('somegame', make_image())
+        call_command('process_image_jobs', stdout=StringIO())
+        self.assertEquals(ImageJob.objects.get().status, ImageJob.DONE)
+
+    def testStaleJobs(self):
+        """Tests that running jobs are taken over once they have not been updated for
+        settings.IMAGE_JOB_TIMEOUT seconds.
+        """
+        self.upload('somegame', make_image())
+        job = ImageJob.objects.get()
+        ImageJob.objects.filter(pk=job.pk).update(status=ImageJob.RUNNING, updated=timezone.now())
+        self.assertEquals(imagejobs.process_pending(), 0)
+        stale = timezone.now() - timedelta(seconds=settings.IMAGE_JOB_TIMEOUT + 1)
+        ImageJob.objects.filter(pk=job.pk).update(updated=stale)
+        self.assertEquals(imagejobs.process_pending(), 1)
+        job.refresh_from_db()
+        self.assertEquals(job.status, ImageJob.DONE)
+        self.assertGreater(job.updated, stale)
+
+    @override_settings(IMAGE_VARIANT_WIDTHS={'COVER': ('invalid',)})
+    def testFailedJob(self):
+        """Tests that the images stored by a failed job are deleted.
+        """
+        self.upload('somegame', make_image())
+        job = ImageJob.objects.get()
+        self.assertFalse(imagejobs.process(job.pk))
+        job.refresh_from_db()
+        self.assertEquals(job.status, ImageJob.FAILED)
+        game = Game.objects.get(title='somegame')
+        #files are deleted once the transaction commits, their references right away
+        self.assertEquals(list(MediaFile.objects.values_list('name', flat=True)),
+            [game.gameoriginal.name])
+
+
+class ThumbnailTest(TestCase):
+    """Tests the on demand thumbnails.
+    """
+
+    def setUp(self):
+        logger.debug('ThumbnailTest.setUp')
+        self.media_root = mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.client = Client()
+        self.name = default_storage.save(
+            'user_1/game/original/image.png', make_image(size=(800, 600)))
+        Game.objects.create(
+            title='somegame',
+            url='http://google.com',
+            developer=get_user('dev'),
+            price=Decimal('0.50'),
+            description='This here is a game',
+            gameoriginal=self.name
+        )
+
+    def tearDown(self):
+        self.settings.disable()
+        rmtree(self.media_root)
+
+    def get(self, size, name=None):
+        return self.client.get(thumbnails.url(size[0], size[1], name or self.name))
+
+    def testThumbnail(self):
+        """Tests that thumbnails are made once, and served from the cache after.
+        """
+        response = self.get((250, 200))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'image/png')
+        self.assertTrue('max-age=31536000' in response['Cache-Control'])
+        image = Image.open(BytesIO(b''.join(response.streaming_content)))
+        self.assertEquals(image.size, (250, 200))
+        path = thumbnails.cache_path(250, 200, self.name)
+        self.assertTrue(os.path.exists(path))
+
+        default_storage.delete(self.name)
+        self.assertEquals(self.get((250, 200)).status_code, 200)
+
+    def testNotAllowed(self):
+        """Tests that sizes not in the whitelist, and missing images, are not found.
+        """
+        self.assertEquals(self.get((251, 200)).status_code, 404)
+        self.assertEquals(self.get((250, 200), 'user_1/game/original/none.png').status_code, 404)
+        response = self.client.get('/media/thumbs/250x200/user_1/game/../../secret.png')
+        self.assertEquals(response.status_code, 404)
+        #as made by a thumbnail of an image in user_1/game/original
+        os.makedirs(os.path.dirname(thumbnails.cache_path(250, 200, 'user_1/game/original/image.png')))
+        for name in ['.', '..']:
+            response = self.client.get('/media/thumbs/250x200/user_1/game/original/' + name)
+            self.assertEquals(response.status_code, 404)
+        self.assertIsNone(thumbnails.get(250, 200, 'user_1/game/original/..'))
+
+    def testPrune(self):
+        """Tests that the least recently used thumbnails are pruned first.
+        """
+        self.get((250, 200))
+        self.get((500, 400))
+        old = thumbnails.cache_path(250, 200, self.name)
+        new = thumbnails.cache_path(500, 400, self.name)
+        os.utime(old, (0, 0))
+        self.assertEquals(thumbnails.prune(os.path.getsize(new)), 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    @override_settings(THUMBNAIL_CACHE_MAX_SIZE=0, THUMBNAIL_PRUNE_INTERVAL=2)
+    def testPruneInterval(self):
+        """Tests that the cache is pruned only after every interval thumbnails made.
+        """
+        thumbnails._made = itertools.count(1)
+        self.get((250, 200))
+        self.assertTrue(os.path.exists(thumbnails.cache_path(250, 200, self.name)))
+        self.get((500, 400))
+        self.assertFalse(os.path.exists(thumbnails.cache_path(250, 200, self.name)))
+        self.assertTrue(os.path.exists(thumbnails.cache_path(500, 400, self.name)))
+
+
+class ContentAddressedStorageTest(TransactionTestCase):
+    """Tests that identical files are stored once, and deleted when no longer
+    referenced.
+    """
+
+    def setUp(self):
+        logger.debug('ContentAddressedStorageTest.setUp')
+        self.media_root = mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.user = User.objects.create(username='dev')
+
+    def tearDown(self):
+        self.settings.disable()
+        rmtree(self.media_root)
+
+    def create(self, title):
+        return Game.objects.create(
+            title=title,
+            url='http://google.com',
+            developer=self.user,
+            price=Decimal('0.50'),
+            description='This here is a game',
+            gameoriginal=make_image()
+        )
+
+    def testReferences(self):
+        """Tests that files are deleted with their last reference.
+        """
+        first = default_storage.save('first.png', make_image())
+        second = default_storage.save('user_1/second.png', make_image())
+        self.assertEquals(first, second)
+        self.assertTrue(first.startswith('content/'))
+        self.assertEquals(default_storage.references(first), 2)
+        default_storage.delete(first)
+        self.assertTrue(default_storage.exists(first))
+        default_storage.delete(first)
+        self.assertEquals(default_storage.references(first), None)
+        self.assertFalse(default_storage.exists(first))
+
+    def testGameImages(self):
+        """Tests that games uploaded with the same image share every image file,
+        and that deleting the games deletes all of them.
+        """
+        first = self.create('first')
+        second = self.create('second')
+        imagejobs.process(ImageJob.objects.create(game=first, source=first.gameoriginal.name).pk)
+        imagejobs.process(ImageJob.objects.create(game=second, source=second.gameoriginal.name).pk)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEquals(first.gamethumb.name, second.gamethumb.name)
+        self.assertEquals(first.imagevariants, second.imagevariants)
+        for name in [first.gameoriginal.name, first.gameimage.name, first.gamethumb.name]:
+            self.assertEquals(default_storage.references(name), 2)
+
+        names = [name for name, in MediaFile.objects.values_list('name')]
+        first.delete()
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+        second.delete()
+        self.assertFalse(MediaFile.objects.exists())
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+class TrendingTest(TestCase):
+    """Tests the time decayed trending score of games.
+    """
+
+    def setUp(self):
+        logger.debug('TrendingTest.setUp')
+        self.developer = get_user('dev')
+        self.old = Game.create(title='old hit', url='', developer=self.developer)
+        self.old.save()
+        self.new = Game.create(title='new hit', url='', developer=self.developer)
+        self.new.save()
+        Game.objects.filter(pk=self.old.pk).update(popularity=10)
+        Game.objects.filter(pk=self.new.pk).update(popularity=2)
+        self.now = timezone.now()
+
+    def sell(self, game, count, age):
+        for i in range(count):
+            buy_game_for_user(get_user('buyer{0}-{1}'.format(game.pk, i)), game)
+        PaymentDetail.objects.filter(
+            game_played__game=game
+        ).update(selldate=self.now - age)
+
+    @override_settings(TRENDING_HALF_LIFE=24, TRENDING_VIEW_WEIGHT=0.5)
+    def testScores(self):
+        """Tests that sales and views are weighted by their age.
+        """
+        self.sell(self.old, 10, timedelta(days=5))
+        self.sell(self.new, 2, timedelta(days=1))
+        viewcount.add_daily_views([self.new.pk], 4, day=(self.now - timedelta(days=2)).date())
+        ids, scores = trending.compute(self.now)
+        scores = dict(zip(ids.tolist(), scores.tolist()))
+        self.assertAlmostEqual(scores[self.old.pk], 10 * 0.5 ** 5)
+        noon = datetime.combine((self.now - timedelta(days=2)).date(), time(12, tzinfo=timezone.utc))
+        views = 0.5 * 4 * 0.5 ** ((self.now - noon).total_seconds() / (24 * 3600))
+        self.assertAlmostEqual(scores[self.new.pk], 2 * 0.5 + views)
+
+    @override_settings(TRENDING_HALF_LIFE=24, TRENDING_HORIZON=8)
+    def testSort(self):
+        """Tests that recent sales rank above old ones once the scores are updated,
+        and that sales beyond the horizon are left out.
+        """
+        self.sell(self.old, 10, timedelta(days=9))
+        self.sell(self.new, 2, timedelta(hours=1))
+        self.assertEquals(trending.update(self.now), 1)
+        self.assertEquals(trending.update(self.now), 0)
+        self.old.refresh_from_db()
+        self.assertEquals(self.old.trending, 0)
+        self.assertEquals(list(Game.search(None, 'trending')), [self.new, self.old])
+        self.assertEquals(list(Game.search(None)), [self.old, self.new])
+
+        response = Client().get(reverse('game:search') + '?sort=trending')
+        self.assertEquals(list(response.context['hits']), [self.new, self.old])
+        response = Client().get(reverse('accounts:home') + '?sort=trending')
+        self.assertEquals(list(response.context['games']), [self.new, self.old])
+
+    def testViews(self):
+        """Tests that flushed views are added to the views of the day.
+        """
+        cache.clear()
+        viewcount.flush()
+        for i in range(3):
+            viewcount.record_view(self.new.pk)
+        viewcount.record_view(self.old.pk)
+        viewcount.flush([self.new.pk, self.old.pk])
+        viewcount.record_view(self.new.pk)
+        viewcount.flush([self.new.pk])
+        views = dict(DailyViews.objects.filter(day=timezone.now().date()).values_list('game', 'views'))
+        self.assertEquals(views, {self.new.pk: 4, self.old.pk: 1})
+
+    def testCommand(self):
+        """Tests the compute_trending management command.
+        """
+        self.sell(self.new, 1, timedelta(0))
+        out = StringIO()
+        call_command('compute_trending', stdout=out)
+        self.assertTrue('1 games' in out.getvalue())
+
+@override_settings(RECOMMENDATIONS=2)
+class RecommendationTest(TestCase):
+    """Tests the players also bought recommendations.
+    """
+
+    def setUp(self):
+        logger.debug('RecommendationTest.setUp')
+        developer = get_user('dev')
+        self.games = {}
+        for title in 'ABCD':
+            game = Game.create(title=title, url='', developer=developer)
+            game.save()
+            self.games[title] = game
+        self.users = {}
+        for name, titles in [('u1', 'AB'), ('u2', 'ABC'), ('u3', 'CD')]:
+            self.buy(name, titles)
+
+    def buy(self, name, titles):
+        if name not in self.users:
+            self.users[name] = get_user(name)
+        for title in titles:
+            buy_game_for_user(self.users[name], self.games[title])
+
+    def stored(self):
+        return sorted(Recommendation.objects.values_list('game__title', 'rank', 'recommended__title', 'score'))
+
+    def titles(self, title):
+        return [game.title for game in recommendations.recommended_games(self.games[title])]
+
+    def testBuild(self):
+        """Tests the similarities, their order and the number kept.
+        """
+        self.assertEquals(recommendations.build(), 4)
+        self.assertEquals(self.titles('A'), ['B', 'C'])
+        self.assertEquals(self.titles('C'), ['D', 'A'])
+        self.assertEquals(self.titles('D'), ['C'])
+        scores = {(game, other): score for game, rank, other, score in self.stored()}
+        self.assertAlmostEqual(scores[('A', 'B')], 1.0)
+        self.assertAlmostEqual(scores[('A', 'C')], 0.5)
+        self.assertAlmostEqual(scores[('C', 'D')], 0.5 ** 0.5)
+
+    def testRefresh(self):
+        """Tests that refreshing after purchases gives the same recommendations as
+        building them all again.
+        """
+        recommendations.build()
+        Recommendation.objects.update(updated=timezone.now() - timedelta(minutes=1))
+        self.buy('u4', 'BD')
+        self.buy('u1', 'D')
+        self.assertEquals(recommendations.refresh(), 4)
+        refreshed = self.stored()
+        recommendations.build()
+        self.assertEquals(len(refreshed), len(self.stored()))
+        for row, expected in zip(refreshed, self.stored()):
+            self.assertEquals(row[:3], expected[:3])
+            self.assertAlmostEqual(row[3], expected[3])
+        self.assertEquals(recommendations.refresh(), 0)
+
+    def testRefreshUpload(self):
+        """Tests that refreshing picks up the games owned without a purchase, by the
+        developer who uploaded them.
+        """
+        recommendations.build()
+        Recommendation.objects.update(updated=timezone.now() - timedelta(minutes=1))
+        GamePlayed.objects.update(created=timezone.now() - timedelta(minutes=2))
+        game = Game.create(title='E', url='', developer=self.users['u3'])
+        game.save()
+        GamePlayed.objects.create(game=game, user=self.users['u3'], gameScore=0)
+        self.assertEquals(recommendations.refresh(), 3)
+        self.assertEquals(self.titles('D'), ['E', 'C'])
+
+    def testDetails(self):
+        """Tests that the detail page shows the recommendations, without the games
+        the user owns.
+        """
+        call_command('build_recommendations', stdout=StringIO())
+        client = Client()
+        client.force_login(self.users['u1'])
+        response = client.get(reverse('game:detail', args=[self.games['A'].pk]))
+        self.assertEquals(response.context['recommended_games'], [self.games['C']])
+        self.assertTrue(b'Players also bought' in response.content)
+
+@override_settings(SAVE_QUEUE_FLUSH_INTERVAL=0)
+class SavedStateTest(TestCase):
+    """Tests the score and items summary of saved game states.
+    """
+
+    def setUp(self):
+        logger.debug('SavedStateTest.setUp')
+        cache.clear()
+        self.user = get_user('player')
+        self.game = Game.create(title='somegame', url='', developer=get_user('dev'))
+        self.game.save()
+        buy_game_for_user(self.user, self.game)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def save(self, state):
+        data = json.dumps({'messageType': 'SAVE', 'gameState': state})
+        return self.client.post(
+            reverse('game:update', args=[self.game.pk]),
+            {'data': data},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    def load(self):
+        data = json.dumps({'messageType': 'LOAD_REQUEST'})
+        response = self.client.post(
+            reverse('game:update', args=[self.game.pk]),
+            {'data': data},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        return json.loads(response.content.decode('utf-8'))
+
+    def testCompression(self):
+        """Tests that large states are stored compressed, and loaded back.
+        """
+        self.save({'score': 1, 'playerItems': ['small']})
+        game_played = GamePlayed.objects.get(user=self.user, game=self.game)
+        self.assertEquals(game_played.stateEncoding, '')
+        self.assertEquals(game_played.stateStoredSize, game_played.stateSize)
+        self.assertEquals(self.load()['gameState']['playerItems'], ['small'])
+
+        items = ['item{0}'.format(i) for i in range(2000)]
+        self.save({'score': 2, 'playerItems': items})
+        game_played = GamePlayed.objects.get(user=self.user, game=self.game)
+        self.assertEquals(game_played.stateEncoding, savestate.ZLIB)
+        self.assertEquals(game_played.gameState, '')
+        self.assertTrue(game_played.stateSize > settings.SAVE_STATE_COMPRESS_THRESHOLD)
+        self.assertTrue(game_played.stateStoredSize < game_played.stateSize / 2)
+        state = self.load()
+        self.assertEquals(state['messageType'], 'LOAD')
+        self.assertEquals(state['gameState'], {'score': 2, 'playerItems': items})
+
+        metrics = savestate.metrics(self.game)
+        self.assertEquals(metrics['saves'], 1)
+        self.assertEquals(metrics['compressed'], 1)
+        self.assertEquals(metrics['size'], game_played.stateSize)
+        self.assertEquals(metrics['stored_size'], game_played.stateStoredSize)
+
+        self.client.force_login(self.game.developer)
+        response = self.client.get(reverse('accounts:statistics', args=[self.game.developer.pk, self.game.pk]))
+        self.assertEquals(response.context['save_metrics'], metrics)
+
+    def testUnchanged(self):
+        """Tests that saving the state already stored does not write it again.
+        """
+        self.save({'score': 3, 'playerItems': ['a']})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.save({'score': 3, 'playerItems': ['a']})
+        self.assertEquals(response.content, b'success')
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in queries.captured_queries))
+        with CaptureQueriesContext(connection) as queries:
+            self.save({'score': 3, 'playerItems': ['b']})
+        self.assertTrue(any(query['sql'].startswith('UPDATE') for query in queries.captured_queries))
+
+    @override_settings(SAVE_STATE_MAX_SIZE=200)
+    def testMaxSize(self):
+        """Tests that states larger than the maximum size are rejected.
+        """
+        self.save({'score': 3, 'playerItems': ['a']})
+        response = json.loads(self.save({'score': 4, 'playerItems': ['x' * 200]}).content.decode('utf-8'))
+        self.assertEquals(response['messageType'], 'ERROR')
+        game_played = GamePlayed.objects.get(user=self.user, game=self.game)
+        self.assertEquals(game_played.savedScore, 3)
+
+    def testSave(self):
+        """Tests that saving writes the summary, and the profile page shows it.
+        """
+        response = self.save({'score': 12, 'playerItems': ['sword', 'shield']})
+        self.assertEquals(response.content, b'success')
+        game_played = GamePlayed.objects.get(user=self.user, game=self.game)
+        self.assertEquals(game_played.savedScore, 12)
+        self.assertEquals(game_played.savedItems, 'sword, shield')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('accounts:detail', args=[self.user.pk]))
+        self.assertTrue(b'sword, shield' in response.content)
+        self.assertFalse(any('gameState' in query['sql'] for query in queries.captured_queries))
+
+    def testBackfill(self):
+        """Tests that the data migration fills in the summary of stored states.
+        """
+        migration = import_module('game.migrations.0042_backfill_saved_state')
+        GamePlayed.objects.filter(user=self.user).update(gameState=json.dumps({
+            'messageType': 'SAVE',
+            'gameState': {'score': 7, 'playerItems': ['key']}
+        }))
+        other = get_user('other')
+        buy_game_for_user(other, self.game)
+        GamePlayed.objects.filter(user=other).update(gameState="{''}")
+        migration.forwards_func(apps, connection.schema_editor())
+        game_played = GamePlayed.objects.get(user=self.user)
+        self.assertEquals((game_played.savedScore, game_played.savedItems), (7, 'key'))
+        game_played = GamePlayed.objects.get(user=other)
+        self.assertEquals((game_played.savedScore, game_played.savedItems), (None, ''))
+
+@override_settings(SAVE_QUEUE_FLUSH_INTERVAL=3600)
+class SaveQueueTest(TestCase):
+    """Tests the coalescing of saves and scores by game.savequeue.
+    """
+
+    def setUp(self):
+        logger.debug('SaveQueueTest.setUp')
+        cache.clear()
+        self.user = get_user('player')
+        self.game = Game.create(title='somegame', url='', developer=get_user('dev'))
+        self.game.save()
+        buy_game_for_user(self.user, self.game)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def post(self, message):
+        response = self.client.post(
+            reverse('game:update', args=[self.game.pk]),
+            {'data': json.dumps(message)},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        if response['Content-Type'] == 'application/json':
+            return json.loads(response.content.decode('utf-8'))
+        return response.content
+
+    def stored(self):
+        return GamePlayed.objects.get(user=self.user, game=self.game)
+
+    def postBatch(self, batch):
+        response = self.client.post(
+            reverse('game:update_batch', args=[self.game.pk]),
+            {'data': json.dumps(batch)},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        return json.loads(response.content.decode('utf-8'))['results']
+
+    def testCoalescing(self):
+        """Tests that saves are buffered in the cache, loaded back from it, and
+        written with one UPDATE of the changed columns.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            for score in range(1, 11):
+                self.post({'messageType': 'SAVE', 'gameState': {'score': score, 'playerItems': [str(score)]}})
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in queries.captured_queries))
+        self.assertEquals(self.stored().savedScore, None)
+
+        #answered from the cache, whichever process queued the saves
+        savequeue._pending.clear()
+        state = self.post({'messageType': 'LOAD_REQUEST'})
+        self.assertEquals(state['gameState'], {'score': 10, 'playerItems': ['10']})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(savequeue.flush([(self.user.pk, self.game.pk)]), 1)
+        updates = [query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE "game_gameplayed"')]
+        self.assertEquals(len(updates), 1)
+        self.assertFalse('"rating"' in updates[0])
+        game_played = self.stored()
+        self.assertEquals((game_played.savedScore, game_played.savedItems, game_played.gameScore), (10, '10', 10))
+        self.assertEquals(savequeue.pending(self.user.pk, self.game.pk), {})
+        state = self.post({'messageType': 'LOAD_REQUEST'})
+        self.assertEquals(state['gameState'], {'score': 10, 'playerItems': ['10']})
+
+    def testFlushInterval(self):
+        """Tests that a pending write is written by the first message of the player
+        after the interval, and by the process which queued it.
+        """
+        self.post({'messageType': 'SCORE', 'score': 5})
+        key = savequeue.CACHE_KEY.format(self.user.pk, self.game.pk)
+        entry = cache.get(key)
+        entry['queued'] -= 3600
+        cache.set(key, entry, None)
+        self.post({'messageType': 'SCORE', 'score': 6})
+        self.assertEquals(self.stored().gameScore, 6)
+        self.assertEquals(savequeue.pending(self.user.pk, self.game.pk), {})
+
+        self.post({'messageType': 'SCORE', 'score': 7})
+        self.assertEquals(self.stored().gameScore, 6)
+        with override_settings(SAVE_QUEUE_FLUSH_INTERVAL=0):
+            self.assertEquals(savequeue.flush(), 1)
+        self.assertEquals(self.stored().gameScore, 7)
+
+    def testScores(self):
+        """Tests that SCORE messages replace the score, and SAVE messages only raise
+        it. Scores reach the leaderboard once written.
+        """
+        self.post({'messageType': 'SCORE', 'score': 50})
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 20, 'playerItems': []}})
+        self.assertEquals(self.stored().gameScore, 0)
+        self.assertEquals(leaderboard.get(self.game.pk)['scores'], [['player', 0]])
+        savequeue.flush_all()
+        self.assertEquals(self.stored().gameScore, 50)
+        self.assertEquals(leaderboard.get(self.game.pk)['scores'], [['player', 50]])
+
+        self.post({'messageType': 'SCORE', 'score': 30})
+        savequeue.flush_all()
+        game_played = self.stored()
+        self.assertEquals((game_played.gameScore, game_played.savedScore), (30, 20))
+        self.assertEquals(leaderboard.get(self.game.pk)['scores'], [['player', 30]])
+
+        self.post({'messageType': 'SCORE', 'score': 60})
+        self.assertEquals(self.stored().gameScore, 30)
+        call_command('flush_saves', stdout=StringIO())
+        self.assertEquals(self.stored().gameScore, 60)
+
+    def testBatch(self):
+        """Tests that the messages of a batch are applied in order, with a result
+        for each.
+        """
+        batch = [
+            {'messageType': 'SCORE', 'score': 5},
+            {'messageType': 'SAVE', 'gameState': {'score': 8, 'playerItems': ['a']}},
+            {'messageType': 'SAVE'},
+            {'messageType': 'LOAD_REQUEST'},
+        ]
+        results = self.postBatch(batch)
+        self.assertEquals(results[:2], ['success', 'success'])
+        self.assertEquals(results[2]['messageType'], 'ERROR')
+        self.assertEquals(results[3]['messageType'], 'LOAD')
+        self.assertEquals(results[3]['gameState'], {'score': 8, 'playerItems': ['a']})
+        savequeue.flush_all()
+        self.assertEquals(self.stored().gameScore, 8)
+
+        with override_settings(GAME_MESSAGE_BATCH_SIZE=3):
+            response = self.client.post(
+                reverse('game:update_batch', args=[self.game.pk]),
+                {'data': json.dumps(batch)},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+        self.assertEquals(response.status_code, 400)
+
+    def testBatchConflict(self):
+        """Tests that every save of a batch is answered with CONFLICT when the write
+        conflicts, with or without a version.
+        """
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 1, 'playerItems': []}, 'version': 0})
+        #saved meanwhile without going through the queue
+        GamePlayed.objects.filter(user=self.user, game=self.game).update(version=5)
+        with override_settings(SAVE_QUEUE_FLUSH_INTERVAL=0):
+            results = self.postBatch([
+                {'messageType': 'SAVE', 'gameState': {'score': 2, 'playerItems': []}, 'version': 1},
+                {'messageType': 'SCORE', 'score': 9},
+                {'messageType': 'SAVE', 'gameState': {'score': 3, 'playerItems': []}},
+                {'messageType': 'SAVE', 'gameState': {'score': 4, 'playerItems': []}, 'version': None},
+            ])
+        self.assertEquals([result if result == 'success' else result['messageType'] for result in results],
+            ['CONFLICT', 'success', 'CONFLICT', 'CONFLICT'])
+        game_played = self.stored()
+        self.assertEquals((game_played.version, game_played.savedScore, game_played.gameScore), (5, None, 9))
+
+    @skipIf(connection.vendor != 'sqlite', 'the write is failed with an SQLite trigger')
+    def testBatchWriteError(self):
+        """Tests that the saves and scores of a batch are answered with ERROR when
+        the write fails in the database, and the other messages keep their results.
+        """
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 1, 'playerItems': []}})
+        savequeue.flush_all()
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TRIGGER fail_update BEFORE UPDATE ON game_gameplayed '
+                "BEGIN SELECT RAISE(ABORT, 'write failed'); END")
+        try:
+            with override_settings(SAVE_QUEUE_FLUSH_INTERVAL=0):
+                results = self.postBatch([
+                    {'messageType': 'SCORE', 'score': 9},
+                    {'messageType': 'SAVE', 'gameState': {'score': 2, 'playerItems': []}},
+                    {'messageType': 'LOAD_REQUEST'},
+                    {'messageType': 'SCORE', 'score': 'high'},
+                ])
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TRIGGER fail_update')
+        self.assertEquals([result['messageType'] for result in results], ['ERROR', 'ERROR', 'LOAD', 'ERROR'])
+        self.assertEquals(results[2]['gameState'], {'score': 2, 'playerItems': []})
+        self.assertEquals(self.stored().savedScore, 1)
+
+    def testLocked(self):
+        """Tests that messages are refused while another request holds the pending
+        write.
+        """
+        cache.add(savequeue.LOCK_KEY.format(self.user.pk, self.game.pk), True)
+        savequeue.LOCK_WAIT, wait = 0, savequeue.LOCK_WAIT
+        try:
+            results = self.postBatch([{'messageType': 'SCORE', 'score': 5}, {'messageType': 'LOAD_REQUEST'}])
+            result = self.post({'messageType': 'SCORE', 'score': 5})
+        finally:
+            savequeue.LOCK_WAIT = wait
+        self.assertEquals([result['messageType'] for result in results], ['ERROR', 'ERROR'])
+        self.assertEquals(result['messageType'], 'ERROR')
+        self.assertEquals(savequeue.pending(self.user.pk, self.game.pk), {})
+
+    def testConflict(self):
+        """Tests that saves based on an old version of the state are refused, also
+        when the state is saved by something else than the queue before the flush.
+        """
+        state = {'score': 1, 'playerItems': ['a']}
+        result = self.post({'messageType': 'SAVE', 'gameState': state, 'version': 0})
+        self.assertEquals(result, {'messageType': 'SAVED', 'version': 1})
+        result = self.post({'messageType': 'SAVE', 'gameState': {'score': 2, 'playerItems': []}, 'version': 0})
+        self.assertEquals((result['messageType'], result['version']), ('CONFLICT', 1))
+        result = self.post({'messageType': 'LOAD_REQUEST'})
+        self.assertEquals((result['gameState'], result['version']), (state, 1))
+        savequeue.flush_all()
+        self.assertEquals(self.stored().version, 1)
+
+        #saves of a batch follow on from the first
+        batch = [
+            {'messageType': 'SAVE', 'gameState': {'score': 3, 'playerItems': []}, 'version': 1},
+            {'messageType': 'SAVE', 'gameState': {'score': 4, 'playerItems': []}},
+        ]
+        results = self.postBatch(batch)
+        self.assertEquals([result['version'] for result in results], [2, 3])
+        batch[0]['gameState']['score'] = 5
+        results = self.postBatch(batch)
+        self.assertEquals([result['messageType'] for result in results], ['CONFLICT', 'CONFLICT'])
+        savequeue.flush_all()
+
+        #saved meanwhile without going through the queue
+        state = {'score': 6, 'playerItems': []}
+        with savequeue.Writes(self.user.pk, self.game.pk) as writes:
+            writes.save(json.dumps({'messageType': 'SAVE', 'gameState': state}), state, 3)
+            GamePlayed.objects.filter(user=self.user, game=self.game).update(version=7)
+            with self.assertRaises(savequeue.Conflict) as conflict:
+                writes.flush(force=True)
+        self.assertEquals(conflict.exception.version, 7)
+        game_played = self.stored()
+        self.assertEquals((game_played.version, game_played.savedScore, game_played.gameScore), (7, 4, 6))
+        self.assertEquals(savequeue.pending(self.user.pk, self.game.pk), {})
+        result = self.post({'messageType': 'SAVE', 'gameState': {'score': 6, 'playerItems': []}, 'version': 3})
+        self.assertEquals((result['messageType'], result['version']), ('CONFLICT', 7))
+
+    def testUnversioned(self):
+        """Tests that saves without a version are written over any version, and
+        move the stored version on.
+        """
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 1, 'playerItems': []}})
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 2, 'playerItems': []}})
+        self.assertEquals(self.post({'messageType': 'LOAD_REQUEST'})['version'], 2)
+        #saved meanwhile without going through the queue
+        GamePlayed.objects.filter(user=self.user, game=self.game).update(version=5)
+        self.assertEquals(savequeue.flush_all(), 1)
+        game_played = self.stored()
+        self.assertEquals((game_played.version, game_played.savedScore), (7, 2))
+
+        #saves based on a version are checked against it, with the ones before them
+        self.post({'messageType': 'SAVE', 'gameState': {'score': 3, 'playerItems': []}})
+        result = self.post({'messageType': 'SAVE', 'gameState': {'score': 4, 'playerItems': []}, 'version': 8})
+        self.assertEquals(result, {'messageType': 'SAVED', 'version': 9})
+        GamePlayed.objects.filter(user=self.user, game=self.game).update(version=10)
+        self.assertEquals(savequeue.flush_all(), 0)
+        self.assertEquals(self.stored().savedScore, 2)
+
+    def testPatch(self):
+        """Tests that patches are applied to the newest state, and refused against
+        other versions.
+        """
+        state = {'score': 1, 'playerItems': ['a'], 'level': {'name': 'one', 'time': 10}}
+        self.post({'messageType': 'SAVE', 'gameState': state, 'version': 0})
+        result = self.post({'messageType': 'SAVE_PATCH', 'version': 1, 'patch': [
+            {'op': 'replace', 'path': '/score', 'value': 9},
+            {'op': 'add', 'path': '/playerItems/-', 'value': 'b'},
+            {'op': 'remove', 'path': '/level/time'},
+        ]})
+        self.assertEquals(result, {'messageType': 'SAVED', 'version': 2})
+        merged = {'score': 9, 'playerItems': ['a', 'b'], 'level': {'name': 'one'}}
+        self.assertEquals(self.post({'messageType': 'LOAD_REQUEST'})['gameState'], merged)
+
+        result = self.post({'messageType': 'SAVE_PATCH', 'version': 1, 'patch': []})
+        self.assertEquals((result['messageType'], result['version']), ('PATCH_FAILED', 2))
+        result = self.post({'messageType': 'SAVE_PATCH', 'version': 2, 'patch': [
+            {'op': 'remove', 'path': '/level/time'}]})
+        self.assertEquals(result['messageType'], 'PATCH_FAILED')
+
+        savequeue.flush_all()
+        game_played = self.stored()
+        self.assertEquals((game_played.version, game_played.savedScore, game_played.gameScore), (2, 9, 9))
+        self.assertEquals(json.loads(game_played.gameState)['gameState'], merged)
+
+
+class StatePatchTest(TestCase):
+    """Tests JSON Patch against the examples of RFC 6902.
+    """
+
+    def testOperations(self):
+        """Tests each operation.
+        """
+        self.assertEquals(statepatch.apply({'foo': 'bar'}, [{'op': 'add', 'path': '/baz', 'value': 'qux'}]),
+            {'foo': 'bar', 'baz': 'qux'})
+        self.assertEquals(statepatch.apply({'foo': ['bar', 'baz']}, [{'op': 'add', 'path': '/foo/1', 'value': 'qux'}]),
+            {'foo': ['bar', 'qux', 'baz']})
+        self.assertEquals(statepatch.apply({'baz': 'qux', 'foo': 'bar'}, [{'op': 'remove', 'path': '/baz'}]),
+            {'foo': 'bar'})
+        self.assertEquals(statepatch.apply({'baz': 'qux'}, [{'op': 'replace', 'path': '/baz', 'value': 'boo'}]),
+            {'baz': 'boo'})
+        self.assertEquals(statepatch.apply(
+            {'foo': {'bar': 'baz', 'waldo': 'fred'}, 'qux': {'corge': 'grault'}},
+            [{'op': 'move', 'from': '/foo/waldo', 'path': '/qux/thud'}]),
+            {'foo': {'bar': 'baz'}, 'qux': {'corge': 'grault', 'thud': 'fred'}})
+        self.assertEquals(statepatch.apply({'foo': ['all', 'grass', 'cows', 'eat']},
+            [{'op': 'move', 'from': '/foo/1', 'path': '/foo/3'}]),
+            {'foo': ['all', 'cows', 'eat', 'grass']})
+        self.assertEquals(statepatch.apply({'foo': ['bar']}, [{'op': 'add', 'path': '/foo/-', 'value': ['abc']}]),
+            {'foo': ['bar', ['abc']]})
+        self.assertEquals(statepatch.apply({'/': 9, '~1': 10}, [{'op': 'test', 'path': '/~01', 'value': 10}]),
+            {'/': 9, '~1': 10})
+        self.assertEquals(statepatch.apply({'a': 1}, [{'op': 'copy', 'from': '/a', 'path': '/b'}]),
+            {'a': 1, 'b': 1})
+        self.assertEquals(statepatch.apply({'a': [1, {'b': None}]}, [{'op': 'test', 'path': '/a', 'value': [1.0, {'b': None}]}]),
+            {'a': [1, {'b': None}]})
+
+    def testErrors(self):
+        """Tests that patches which do not apply raise ValueError, and leave the
+        document unchanged.
+        """
+        document = {'foo': 'bar', 'list': [1]}
+        for patch in [
+            [{'op': 'add', 'path': '/baz/bat', 'value': 'qux'}],
+            [{'op': 'remove', 'path': '/missing'}],
+            [{'op': 'add', 'path': '/list/2', 'value': 1}],
+            [{'op': 'test', 'path': '/foo', 'value': 'baz'}],
+            [{'op': 'test', 'path': '/list/0', 'value': True}],
+            [{'op': 'test', 'path': '/list', 'value': [True]}],
+            [{'op': 'test', 'path': '/list', 'value': {'0': 1}}],
+            [{'op': 'replace', 'path': '/foo', 'value': 1}, {'op': 'unknown', 'path': '/foo'}],
+            [{'op': 'move', 'from': '/list', 'path': '/list/0'}],
+            {'op': 'remove', 'path': '/foo'},
+        ]:
+            with self.assertRaises(ValueError):
+                statepatch.apply(document, patch)
+        self.assertEquals(document, {'foo': 'bar', 'list': [1]})
+
+@skipIf(connection.vendor != 'sqlite', 'query plans are checked on SQLite')
+class QueryPlanTest(TestCase):
+    """Tests that the frequent queries read through an index, with EXPLAIN QUERY
+    PLAN, instead of scanning or sorting the whole table.
+    """
+
+    def setUp(self):
+        logger.debug('QueryPlanTest.setUp')
+        developer = get_user('dev')
+        for i in range(20):
+            game = Game.create(title='game{}'.format(i), url='', developer=developer)
+            game.save()
+            buy_game_for_user(get_user('player{}'.format(i)), game)
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, queryset):
+        plan = self.plan(queryset)
+        for detail in plan:
+            #a scan without an index reads the whole table, a temporary b-tree for
+            #the whole order by sorts it
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                self.fail('full scan in {0} for {1}'.format(plan, queryset.query))
+            if 'TEMP B-TREE FOR ORDER BY' in detail:
+                self.fail('sort in {0} for {1}'.format(plan, queryset.query))
+
+    def testGames(self):
+        """Tests the game lists, and the orderings of the api with its pagination.
+        """
+        for sort in Game.SORT_ORDERS:
+            self.assertIndexed(Game.search(None, sort)[:12])
+        self.assertIndexed(Game.objects.order_by('viewcount', 'sellcount', 'pk')[:12])
+        self.assertIndexed(Game.objects.filter(developer_id=1))
+        for field in ('popularity', 'sellcount', 'upload_date', 'revenue', 'price', 'viewcount'):
+            self.assertIndexed(Game.objects.order_by(field)[:10])
+            self.assertIndexed(Game.objects.order_by('-' + field)[:10])
+            self.assertIndexed(Game.objects.order_by(field, 'pk')[:10])
+            self.assertIndexed(Game.objects.order_by('-' + field, '-pk')[:10])
+
+    def testScores(self):
+        """Tests the leaderboard and highscore of a game.
+        """
+        game = Game.objects.first()
+        self.assertIndexed(GamePlayed.objects
+            .filter(game=game)
+            .order_by('-gameScore', 'pk')
+            .values_list('user__username', 'gameScore')[:10])
+        self.assertIndexed(GamePlayed.objects
+            .filter(game=game)
+            .values('game')
+            .annotate(best=Max('gameScore')))
+
+    def testSales(self):
+        """Tests the sales read by game.trending and game.recommendations.
+        """
+        since = timezone.now() - timedelta(days=1)
+        self.assertIndexed(PaymentDetail.objects
+            .filter(selldate__gte=since, game_played__game__isnull=False)
+            .values_list('game_played__game_id', 'selldate'))
@@ -0,0 +1,141 @@
+"""Thumbnails of uploaded images made on demand.
+
+A thumbnail of the uploaded image of a game is requested with:
+
+    <MEDIA_URL>thumbs/<width>x<height>/<name of Game.gameoriginal in storage>
+
+The first request fits the original to the size and writes the result to the
+disk cache, under thumbs/ in settings.MEDIA_ROOT at the same path as the url, so
+a front end server serving MEDIA_ROOT directly can answer later requests itself.
+Otherwise they are served from the cache by game.views.thumbnail. The names of
+uploads are never reused, so thumbnails are served with long cache headers.
+
+Only the sizes in settings.THUMBNAIL_SIZES are made. The cache is kept under
+settings.THUMBNAIL_CACHE_MAX_SIZE bytes by deleting the least recently used
+thumbnails, which is tracked with the modification time of the files. Pruning
+walks the whole cache, so each process prunes only after making
+settings.THUMBNAIL_PRUNE_INTERVAL thumbnails, and the prune_thumbnails
+management command prunes it from cron.
+"""
+
+import itertools
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .models import Game
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = 'thumbs'
+
+#number of thumbnails made by this process
+_made = itertools.count(1)
+
+def cache_root():
+    return os.path.join(settings.MEDIA_ROOT, CACHE_DIR)
+
+def allowed(width, height):
+    """Tells if thumbnails of the given size may be made.
+    """
+    return '{0}x{1}'.format(width, height) in settings.THUMBNAIL_SIZES
+
+def cache_path(width, height, name):
+    return os.path.join(cache_root(), '{0}x{1}'.format(width, height), name)
+
+def url(width, height, name):
+    """Returns the url of a thumbnail of the stored image with the given name.
+    """
+    return '{0}{1}/{2}x{3}/{4}'.format(settings.MEDIA_URL, CACHE_DIR, width, height, name)
+
+def get(width, height, name):
+    """Returns the path of the cached thumbnail of a stored image, making it if it
+    is not in the cache. Returns None if the image does not exist.
+
+    Raises ValueError if the size is not allowed, or the image is too large or in
+    a format that is not supported.
+    """
+    if not allowed(width, height):
+        raise ValueError
+    if any(part in ('', '.', '..') for part in name.split('/')):
+        #would name a directory, or a file outside the uploaded images
+        return None
+    path = cache_path(width, height, name)
+    if os.path.isfile(path):
+        try:
+            #touched to mark it as recently used
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            #pruned meanwhile
+            pass
+    if not default_storage.exists(name):
+        return None
+    if not Game.objects.filter(gameoriginal=name).exists():
+        #content addressed names do not tell what the file is
+        return None
+    with default_storage.open(name, 'rb') as source:
+        image_pil = Game.open_image(source, [(width, height)])
+        image_name, ftype = Game.image_format(image_pil, name)
+        image_pil = ImageOps.fit(image_pil, (width, height), Image.ANTIALIAS)
+    #pruned before writing, so the thumbnail made is never pruned
+    if next(_made) % settings.THUMBNAIL_PRUNE_INTERVAL == 0:
+        prune()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    #written to a temporary file first, so concurrent requests never see half of it
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            image_pil.save(temp, ftype)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    return path
+
+def prune(max_size=None):
+    """Deletes the least recently used thumbnails until the cache takes at most
+    max_size bytes, settings.THUMBNAIL_CACHE_MAX_SIZE by default. Returns the number
+    of thumbnails deleted.
+    """
+    if max_size is None:
+        max_size = settings.THUMBNAIL_CACHE_MAX_SIZE
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(cache_root()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_size:
+        return 0
+    entries.sort()
+    deleted = 0
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    logger.info('game.thumbnails: pruned %d thumbnails', deleted)
+    return deleted
+
+def purge(name):
+    """Deletes the cached thumbnails of a stored image, in every size.
+    """
+    for size in settings.THUMBNAIL_SIZES:
+        try:
+            os.remove(os.path.join(cache_root(), size, name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,105 @@
+"""Trending score of games.
+
+The trending score of a game is the number of its sales, plus
+settings.TRENDING_VIEW_WEIGHT times the number of its views, each weighted by
+how long ago it happened. The weight halves every settings.TRENDING_HALF_LIFE
+hours, so games selling well now rank above games that sold well long ago. Sales
+are taken from PaymentDetail.selldate, views from the DailyViews written by
+game.viewcount. Sales and views older than settings.TRENDING_HORIZON half-lives
+weigh next to nothing and are not read.
+
+The scores of all games are computed together with NumPy and stored in the
+indexed Game.trending column, which game lists are sorted by with
+sort=trending. They are recomputed by the compute_trending management command,
+which should be run periodically.
+"""
+
+import logging
+
+from datetime import datetime, time, timedelta
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Game, PaymentDetail, DailyViews
+
+logger = logging.getLogger(__name__)
+
+def decay(ages, half_life):
+    """Returns the weights of events of the given ages, in seconds.
+    """
+    return np.exp2(-np.maximum(ages, 0) / half_life)
+
+def add_events(scores, ids, game_ids, ages, counts, half_life):
+    """Adds the decayed counts of events to the scores of the games they belong
+    to. ids are the sorted ids of the games the scores are for, events of other
+    games are ignored.
+    """
+    if not len(game_ids) or not len(ids):
+        return
+    index = np.searchsorted(ids, game_ids)
+    index = np.minimum(index, len(ids) - 1)
+    known = ids[index] == game_ids
+    scores += np.bincount(
+        index[known],
+        weights=counts[known] * decay(ages[known], half_life),
+        minlength=len(ids)
+    )
+
+def compute(now=None):
+    """Returns the ids of all games, and their trending scores at the time now, as
+    NumPy arrays.
+    """
+    now = now or timezone.now()
+    half_life = settings.TRENDING_HALF_LIFE * 3600.0
+    since = now - timedelta(seconds=half_life * settings.TRENDING_HORIZON)
+    ids = np.fromiter(Game.objects.order_by('pk').values_list('pk', flat=True), dtype=np.int64)
+    scores = np.zeros(len(ids))
+
+    sales = list(PaymentDetail.objects
+        .filter(selldate__gte=since, game_played__game__isnull=False)
+        .values_list('game_played__game_id', 'selldate'))
+    add_events(
+        scores, ids,
+        np.array([game_id for game_id, selldate in sales], dtype=np.int64),
+        np.array([(now - selldate).total_seconds() for game_id, selldate in sales]),
+        np.ones(len(sales)),
+        half_life
+    )
+
+    #the views of a day are counted at its middle
+    views = list(DailyViews.objects
+        .filter(day__gte=since.date())
+        .values_list('game_id', 'day', 'views'))
+    noon = time(12, tzinfo=timezone.utc)
+    add_events(
+        scores, ids,
+        np.array([game_id for game_id, day, count in views], dtype=np.int64),
+        np.array([(now - datetime.combine(day, noon)).total_seconds() for game_id, day, count in views]),
+        settings.TRENDING_VIEW_WEIGHT * np.array([count for game_id, day, count in views], dtype=float),
+        half_life
+    )
+    return ids, scores
+
+def update(now=None):
+    """Recomputes the trending scores and stores those that changed. Returns the
+    number of games updated.
+    """
+    ids, scores = compute(now)
+    stored = dict(Game.objects.values_list('pk', 'trending'))
+    old = np.array([stored.get(game_id, 0.0) for game_id in ids.tolist()])
+    changed = ~np.isclose(scores, old, rtol=1e-6, atol=1e-9)
+    params = list(zip(scores[changed].tolist(), ids[changed].tolist()))
+    if params:
+        sql = 'UPDATE {0} SET {1} = %s WHERE {2} = %s'.format(
+            connection.ops.quote_name(Game._meta.db_table),
+            connection.ops.quote_name('trending'),
+            connection.ops.quote_name(Game._meta.pk.column)
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+    logger.debug('game.trending.update: %d games updated', len(params))
+    return len(params)
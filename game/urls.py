@@ -16,7 +16,8 @@ Examples:
         1. Import the include() function: from django.urls import include, path
         2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.urls import path
+from django.conf import settings
+from django.urls import path, re_path
 import game.views as views
 from .decorators import game_developer_required
 
@@ -27,11 +28,20 @@ urlpatterns = [
     path('games/<int:game>/', views.details, name='detail'),
     path('games/<int:game>/purchase', views.purchase, name='purchase'),
     path('games/<int:game>/highscore', views.highscore, name='highscore'),
+    path('games/<int:game>/highscore/stream', views.highscore_stream, name='highscore_stream'),
+    path('games/<int:game>/leaderboard', views.leaderboard_view, name='leaderboard'),
     path('games/<int:game>/delete', game_developer_required(views.GameDeleteView.as_view()), name='delete'),
     path('games/search/', views.search, name='search'),
     path('games/<int:game>/update', game_developer_required(views.GameUpdateView.as_view()), name='game_update'),
     path('games/<int:game>/update_playedgame', views.update_played_game, name='update'),
+    path('games/<int:game>/update_playedgame/batch', views.update_played_game_batch, name='update_batch'),
     path('games/process_purchase', views.process, name='process'),
     path('games/upload/', views.upload, name='upload'),
     path('games/<int:game>/rate', views.rate, name='rate'),
+    re_path(
+        r'^{0}thumbs/(?P<width>\d+)x(?P<height>\d+)/(?P<name>content/[0-9a-f]{{2}}/[0-9a-f]{{64}}\.\w+|user_\d+/game/original/[^/]+)$'.format(
+            settings.MEDIA_URL.lstrip('/')),
+        views.thumbnail,
+        name='thumbnail'
+    ),
 ]
@@ -0,0 +1,138 @@
+"""Write-behind buffer for game view counts.
+
+Viewing a game page does not write to the game row. Views are counted in the cache
+instead, and written to the database in batches, as one
+UPDATE ... SET viewcount = viewcount + n statement per distinct increment n. The
+views are also added to the DailyViews of the day they are written on, which the
+trending score in game.trending is computed from.
+
+Each process remembers which games it has counted views for, and writes them out
+on the first view recorded after settings.VIEWCOUNT_FLUSH_INTERVAL seconds have
+passed since its last flush, or once it has counted
+settings.VIEWCOUNT_FLUSH_THRESHOLD views since, whichever comes first. A busy
+process so writes at most once per interval, and never holds more than the
+threshold of views. The flush_viewcounts management command writes out the
+pending views of every game, counted by any process, and should be run every
+minute or so from cron, which bounds how long the views of a process which
+stops counting are pending.
+
+The counts are kept in the cache, which has to be shared by the processes, see
+CACHES in the settings. Views pending in a cache that is restarted are lost.
+"""
+
+import logging
+import threading
+import time
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Game, DailyViews
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'game.viewcount.{0}'
+
+_lock = threading.Lock()
+_pending = set()
+_counted = 0
+_last_flush = time.monotonic()
+
+def record_view(game_id):
+    """Counts a view for a game. The database is updated by a later flush.
+    """
+    global _counted
+    key = CACHE_KEY.format(game_id)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        #evicted between add and incr
+        cache.set(key, 1, timeout=None)
+    with _lock:
+        _pending.add(game_id)
+        _counted += 1
+        due = (_counted >= settings.VIEWCOUNT_FLUSH_THRESHOLD
+            or time.monotonic() - _last_flush >= settings.VIEWCOUNT_FLUSH_INTERVAL)
+    if due:
+        flush()
+
+def pending_views(game_id):
+    """Returns the number of views counted for a game but not yet written to the
+    database.
+    """
+    return cache.get(CACHE_KEY.format(game_id), 0)
+
+def flush(game_ids=None):
+    """Writes counted views to the database.
+
+    Args:
+        game_ids - The games to write the views of. Defaults to the games this
+            process has counted views for since its last flush.
+
+    Return:
+        The number of views written.
+    """
+    global _counted, _last_flush, _pending
+    if game_ids is None:
+        with _lock:
+            game_ids, _pending = _pending, set()
+            _counted = 0
+            _last_flush = time.monotonic()
+    keys = {CACHE_KEY.format(game_id): game_id for game_id in game_ids}
+    if not keys:
+        return 0
+    increments = defaultdict(list)
+    for key, count in cache.get_many(list(keys)).items():
+        if count:
+            #decrement rather than delete, views counted meanwhile are kept
+            cache.decr(key, count)
+            increments[count].append(keys[key])
+    total = 0
+    for count, ids in increments.items():
+        Game.objects.filter(pk__in=ids).update(viewcount=F('viewcount') + count)
+        add_daily_views(ids, count)
+        total += count * len(ids)
+    logger.debug('game.viewcount.flush: %d views', total)
+    return total
+
+def add_daily_views(game_ids, count, day=None):
+    """Adds count views to the DailyViews of each game for a day, today by default.
+    """
+    day = day or timezone.now().date()
+    existing = set(DailyViews.objects
+        .filter(game_id__in=game_ids, day=day)
+        .values_list('game_id', flat=True))
+    if existing:
+        DailyViews.objects.filter(game_id__in=existing, day=day).update(views=F('views') + count)
+    missing = set(game_ids) - existing
+    if not missing:
+        return
+    #games deleted since the views were counted are skipped
+    missing = list(Game.objects.filter(pk__in=missing).values_list('pk', flat=True))
+    try:
+        with transaction.atomic():
+            DailyViews.objects.bulk_create(
+                DailyViews(game_id=game_id, day=day, views=count) for game_id in missing)
+    except IntegrityError:
+        #created concurrently
+        for game_id in missing:
+            if not DailyViews.objects.filter(game_id=game_id, day=day).update(views=F('views') + count):
+                DailyViews.objects.create(game_id=game_id, day=day, views=count)
+
+def flush_all(batch_size=1000):
+    """Writes the counted views of every game to the database.
+
+    Return:
+        The number of views written.
+    """
+    total = flush()
+    ids = list(Game.objects.values_list('pk', flat=True))
+    for i in range(0, len(ids), batch_size):
+        total += flush(ids[i:i + batch_size])
+    return total
@@ -2,23 +2,26 @@ import pdb
 
 import logging
 import json
+import mimetypes
+import time
 
-from django.db.models import Max
 from django.conf import settings
 from django.shortcuts import render, redirect
 from django.urls import reverse
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseBadRequest, HttpResponseRedirect
-from django.views.decorators.http import require_http_methods
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotFound, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.core.files.storage import default_storage
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_http_methods, condition
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.views.generic.edit import DeleteView, UpdateView
 from django.urls import reverse_lazy
 
-from gameHub.settings import ImageSizeEnum
 from .models import Game, GamePlayed, PaymentDetail
 from .utils import get_checksum
 from .forms import UploadGameForm
+from . import imagejobs, leaderboard, ownership, recommendations, savequeue, savestate, thumbnails, viewcount
 from .decorators import group_required, game_player_required
 
 import accounts.urls
@@ -41,19 +44,22 @@ def details(request, game):
     """
 
     game = get_object_or_404(Game, pk=game)
-    game.increment_viewcount()
+    viewcount.record_view(game.pk)
 
     context = {
         'game': game,
         'game_owner': False,
-        'rating': game.get_rating_cleaned()
+        'rating': game.get_rating_cleaned(),
+        'recommended_games': recommendations.recommended_games(
+            game, exclude=ownership.owned_game_ids(request.user))
     }
 
-    if request.user.is_authenticated:
-        gp = request.user.gameplayed_set.all().filter(game=game)
+    if ownership.owns_game(request.user, game.pk):
+        gp = request.user.gameplayed_set.all().filter(game=game).defer(*savestate.STATE_FIELDS)
         if len(gp) == 1:
             context['game_owner'] = True
             context['rating'] = gp[0].rating * 2
+            context['state_version'] = savequeue.version(gp[0])
 
     return render(request, template_name='game/game.html', context=context)
 
@@ -68,11 +74,14 @@ def search(request):
     - numpages: the total number of pages found in the query.
     - pagelist: this is an iterable producing the indexes of pages for the pagination thingy.
     - query: the original query string.
+    - sort: the order of the results.
 
     GET Params:
 
     - q: The search query string. If not provided it finds all games.
     - p: The page number.
+    - sort: 'popular' to sort by all-time popularity, the default, or 'trending'
+      to sort by the trending score, see game.trending.
 
     The number of games in a response is limited by a maximum page size. Page numbers
     start from 1. If not provided it defaults to 1.
@@ -88,11 +97,14 @@ def search(request):
 
     q = request.GET.get('q', default=None)
     p = int(request.GET.get('p', default=1))
+    sort = request.GET.get('sort', default='popular')
+    if sort not in Game.SORT_ORDERS:
+        sort = 'popular'
 
     if p <= 0:
         return HttpResponseBadRequest()
 
-    qset = Game.search(q)
+    qset = Game.search(q, sort)
     qlen = len(qset)
     numpages = (qlen + pagelen - 1) // pagelen
     qset = qset[(p - 1) * pagelen : p * pagelen]
@@ -114,6 +126,7 @@ def search(request):
             'page': p,
             'numpages': numpages,
             'query': q,
+            'sort': sort,
             'pagelist': pagelist
         })
 
@@ -155,14 +168,18 @@ def upload(request):
             new_game.developer = request.user
             try:
                 if new_game.gameimage:
-                    new_game.gameimage = Game.resize_image(new_game.gameimage, new_game.gameimage.name, ImageSizeEnum.COVER)
-                    new_game.gamethumb = Game.resize_image(new_game.gameimage, new_game.gameimage.name, ImageSizeEnum.THUMBNAIL)
+                    #stored as is, the cover and thumbnail are made by game.imagejobs
+                    imagejobs.check_image(new_game.gameimage)
+                    new_game.gameoriginal = new_game.gameimage
+                    new_game.gameimage = None
             except ValueError:
                 request.session['errors'] = {'imageError': 'Image not valid'}
                 form = UploadGameForm()
                 return HttpResponseRedirect(reverse('game:upload'))
             #adds the developer as a player allowing to play game without buying
             new_game.save()
+            if new_game.gameoriginal:
+                imagejobs.enqueue(new_game)
             played_game = GamePlayed.objects.create(gameScore=0)
             played_game.game = new_game
             played_game.user = request.user
@@ -180,8 +197,7 @@ def upload(request):
 @login_required
 def purchase(request, game):
     game = get_object_or_404(Game, pk=game)
-    games = request.user.gameplayed_set.all()
-    if game in [game_owned.game for game_owned in games]:
+    if ownership.owns_game(request.user, game.pk):
         messages.add_message(request, messages.INFO, 'You have already purchased the game!')
         return redirect(reverse('game:detail', kwargs={'game':game.id}))
     message = "pid={}&sid={}&amount={}&token={}".format(game.id, settings.SELLER_ID, game.price, settings.PAYMENT_KEY)
@@ -230,15 +246,175 @@ def process(request):
     else:
         return HttpResponse('Checksum must match')
 
+def leaderboard_or_404(game):
+    """Returns the leaderboard of a game. Raises Http404 if the leaderboard is not
+    cached and the game does not exist.
+    """
+    entry = leaderboard.cached(game)
+    if entry is None:
+        get_object_or_404(Game, pk=game)
+        entry = leaderboard.load(game)
+    return entry
+
+def leaderboard_etag(request, game):
+    """ETag of the leaderboard views, the version of the leaderboard and its length.
+    """
+    return '{0}-{1}'.format(leaderboard_or_404(game)['version'], leaderboard_length(request))
+
+def leaderboard_length(request):
+    """The number of scores asked for with the GET parameter 'n', capped to
+    settings.LEADERBOARD_SIZE.
+    """
+    try:
+        n = int(request.GET.get('n', settings.LEADERBOARD_SIZE))
+    except ValueError:
+        n = settings.LEADERBOARD_SIZE
+    return max(0, min(n, settings.LEADERBOARD_SIZE))
+
 @require_http_methods(('GET', 'HEAD'))
+@condition(etag_func=leaderboard_etag)
 def highscore(request, game):
+    """Gives the highest score of a game, through ajax.
+
+    :statuscode 200: Success.
+    :statuscode 304: The leaderboard has not changed since the ETag given in If-None-Match.
+    :statuscode 400: Not an ajax request.
+    """
     if request.is_ajax():
-        game = get_object_or_404(Game, pk=game)
-        highscore = GamePlayed.objects.filter(game=game).aggregate(Max('gameScore'))
-        return HttpResponse(highscore['gameScore__max'])
+        scores = leaderboard_or_404(game)['scores']
+        return HttpResponse(scores[0][1] if scores else None)
     else:
         return HttpResponseBadRequest('Only ajax')
 
+@require_http_methods(('GET', 'HEAD'))
+@condition(etag_func=leaderboard_etag)
+def leaderboard_view(request, game):
+    """Gives the top scores of a game as JSON, highest first.
+
+    GET Params:
+
+    - n: The number of scores, at most settings.LEADERBOARD_SIZE, which is the default.
+
+    Response::
+
+        {"game": 1, "scores": [{"user": "player", "score": 100}, ...]}
+
+    The response has an ETag header, and requests with a matching If-None-Match
+    header are answered with 304 without touching the database.
+
+    :statuscode 200: Success.
+    :statuscode 304: Not modified.
+    :statuscode 404: Game not found.
+    """
+    scores = leaderboard_or_404(game)['scores'][:leaderboard_length(request)]
+    return JsonResponse({
+        'game': game,
+        'scores': [{'user': user, 'score': score} for user, score in scores]
+    })
+
+def server_sent_event(event, data):
+    """Formats a server-sent event with JSON data.
+    """
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+def highscore_events(game):
+    """Generates the server-sent events of a highscore stream.
+
+    The stream starts with the current highscore, and then checks the version of
+    the leaderboard every settings.HIGHSCORE_STREAM_INTERVAL seconds, giving a
+    highscore event when it has changed. The leaderboard is read from the cache,
+    or from the database when it is not cached, so scores recorded by any process
+    are seen. The stream ends after settings.HIGHSCORE_STREAM_DURATION seconds to
+    free the worker serving it, and the browser reconnects.
+    """
+    entry = leaderboard_or_404(game)
+    yield 'retry: {0}\n\n'.format(settings.HIGHSCORE_STREAM_RETRY)
+    yield server_sent_event('highscore', highscore_data(game, entry))
+    deadline = time.monotonic() + settings.HIGHSCORE_STREAM_DURATION
+    while time.monotonic() + settings.HIGHSCORE_STREAM_INTERVAL < deadline:
+        time.sleep(settings.HIGHSCORE_STREAM_INTERVAL)
+        version = entry['version']
+        entry = leaderboard_or_404(game)
+        if entry['version'] == version:
+            yield ': keepalive\n\n'
+        else:
+            yield server_sent_event('highscore', highscore_data(game, entry))
+
+def highscore_data(game, entry):
+    """The data of a highscore event for the leaderboard entry of a game.
+    """
+    scores = entry['scores']
+    return {
+        'game': game,
+        'version': entry['version'],
+        'score': scores[0][1] if scores else None
+    }
+
+@require_http_methods(('GET', 'HEAD'))
+def highscore_stream(request, game):
+    """Streams the highscore of a game as server-sent events, see highscore_events.
+
+    :statuscode 200: Success.
+    :statuscode 404: Game not found.
+    """
+    leaderboard_or_404(game)
+    response = StreamingHttpResponse(highscore_events(game), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    #tells nginx and the like not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def apply_message(request, writes, data_dict, data):
+    """Applies a message sent by a game for the requesting player, and returns the
+    response to it: 'success', or a LOAD or SAVED message as a dict.
+
+    A SAVE carrying the version of the state it is based on, and a SAVE_PATCH, are
+    answered with the new version in a SAVED message, or refused with
+    savequeue.Conflict or savequeue.PatchFailed.
+
+    Args:
+        writes - The savequeue.Writes of the player and game, flushed by the caller
+        data_dict - The message
+        data - The message as sent, stored as is by SAVE
+    """
+    if data_dict['messageType'] == 'SAVE':
+        version = None
+        if 'version' in data_dict:
+            #the version is not part of the stored state
+            version = data_dict.pop('version')
+            data = json.dumps(data_dict)
+        new_version = writes.save(data, data_dict['gameState'], version)
+        if version is not None:
+            return {'messageType': 'SAVED', 'version': new_version}
+    if data_dict['messageType'] == 'SAVE_PATCH':
+        new_version = writes.patch(data_dict['patch'], data_dict['version'])
+        return {'messageType': 'SAVED', 'version': new_version}
+    if data_dict['messageType'] == 'SCORE':
+        #checked here, an invalid score would fail every write of the pending write
+        writes.score(int(data_dict['score']))
+    if data_dict['messageType'] == 'LOAD_REQUEST':
+        data, version = writes.load()
+        data = json.loads(data)
+        data['messageType'] = 'LOAD'
+        data['version'] = version
+        return data
+    return 'success'
+
+def error_message(error):
+    """Returns the ERROR message sent to a game for an error in one of its messages,
+    or the CONFLICT or PATCH_FAILED message for a refused save.
+    """
+    if isinstance(error, (savequeue.Conflict, savequeue.PatchFailed)):
+        return {
+            'messageType': 'CONFLICT' if isinstance(error, savequeue.Conflict) else 'PATCH_FAILED',
+            'version': error.version,
+            'info': "Error: {}".format(error)
+        }
+    data = {}
+    data['messageType'] = 'ERROR'
+    data['info'] = "Error: {}".format(error)
+    return data
+
 @require_http_methods(('POST', 'HEAD'))
 @game_player_required #only the game player
 def update_played_game(request, game):
@@ -248,46 +424,116 @@ def update_played_game(request, game):
     and send as response. So, it is with when ERROR messageType is received.
     """
     if request.is_ajax():
-        game_played = GamePlayed.objects.get(user__pk=request.user.pk, game__id=game)
         data = request.POST.get('data')
-        data_dict = json.loads(data)
         try:
-            if data_dict['messageType'] == 'SAVE':
-                game_played.gameState = data
-                #update highscores if score of saved game is higher
-                if data_dict['gameState']['score'] > game_played.gameScore:
-                    game_played.gameScore = data_dict['gameState']['score']
-                    #raise NameError('No name found') just to test if the error is catched
-                game_played.save()
-            if data_dict['messageType'] == 'SCORE':
-                game_played.gameScore = data_dict['score']
-                game_played.save()
-            if data_dict['messageType'] == 'LOAD_REQUEST':
-                data = json.loads(game_played.gameState)
-                data['messageType'] = 'LOAD'
-                return HttpResponse(json.dumps(data), content_type="application/json")
+            with savequeue.Writes(request.user.pk, game) as writes:
+                result = apply_message(request, writes, json.loads(data), data)
+                writes.flush()
         except Exception as error:
-            data = {}
-            data['messageType'] = 'ERROR'
-            data['info'] = "Error: {}".format(error)
-            return HttpResponse(json.dumps(data), content_type="application/json")
-        return HttpResponse('success')#views has to return something
+            result = error_message(error)
+        if result == 'success':
+            return HttpResponse('success')#views has to return something
+        return HttpResponse(json.dumps(result), content_type="application/json")
     else:
         return HttpResponseBadRequest('Only ajax')
 
+@require_http_methods(('POST', 'HEAD'))
+@game_player_required #only the game player
+def update_played_game_batch(request, game):
+    """Applies a batch of messages sent by a game, in order, and responds with the
+    list of their results, as update_played_game would respond to each of them.
+    The saves and scores of the batch are queued together, see game.savequeue.
+
+    The messages are posted as a JSON array in the data field, of at most
+    settings.GAME_MESSAGE_BATCH_SIZE messages. A SAVE without a version is based
+    on the version of the SAVE, SAVE_PATCH or LOAD before it in the batch, if
+    there is one, so a batch of saves fails from its first refused save on.
+
+    The batch is not applied in a database transaction. Its messages are applied
+    to the pending write of the player while holding its lock, and written with a
+    single UPDATE, so a message failing does not undo the ones before it, and gets
+    its own ERROR result. If the write fails, every save and score of the batch is
+    answered with the error instead, and only the saves if they conflict. A write
+    failing in the database stays pending and is tried again by the next flush.
+
+    :statuscode 200: Success, the results may include ERROR messages.
+    :statuscode 400: Not an ajax request, or not a valid batch.
+    """
+    if not request.is_ajax():
+        return HttpResponseBadRequest('Only ajax')
+    try:
+        batch = json.loads(request.POST.get('data', ''))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid batch')
+    if not isinstance(batch, list) or len(batch) > settings.GAME_MESSAGE_BATCH_SIZE:
+        return HttpResponseBadRequest('Invalid batch')
+    results = []
+    #indexes of the saves and scores applied, answered with the error if they are
+    #not written
+    saves = []
+    scores = []
+    #saves without a version follow the version of the previous save of the batch
+    version = None
+    try:
+        with savequeue.Writes(request.user.pk, game) as writes:
+            for data_dict in batch:
+                try:
+                    if data_dict.get('messageType') in ('SAVE', 'SAVE_PATCH'):
+                        data_dict.setdefault('version', version)
+                        version = data_dict['version']
+                    result = apply_message(request, writes, data_dict, json.dumps(data_dict))
+                    if isinstance(result, dict) and result['messageType'] in ('LOAD', 'SAVED'):
+                        version = result['version']
+                    if data_dict['messageType'] in ('SAVE', 'SAVE_PATCH'):
+                        saves.append(len(results))
+                    elif data_dict['messageType'] == 'SCORE':
+                        scores.append(len(results))
+                except Exception as error:
+                    result = error_message(error)
+                    if isinstance(error, (savequeue.Conflict, savequeue.PatchFailed)):
+                        #the saves after a refused one are based on it, and refused too
+                        version = -1
+                results.append(result)
+            try:
+                writes.flush()
+            except savequeue.Conflict as error:
+                #the saves are dropped, a higher score is kept
+                for i in saves:
+                    results[i] = error_message(error)
+            except Exception as error:
+                logger.exception('game.views: writing the batch of game %s failed', game)
+                for i in saves + scores:
+                    results[i] = error_message(error)
+    except savequeue.Busy as error:
+        results = [error_message(error) for data_dict in batch]
+    return JsonResponse({'results': results})
+
 class GameUpdateView(UpdateView):
     model = Game
     form_class = UploadGameForm
     def post(self, request, game):
         self.object = self.get_object()
+        old_original = self.object.gameoriginal.name
         form_class = self.get_form_class()
         form = self.get_form(form_class)
         if form.is_valid():
             new_game = form.save(commit=False)
-            if new_game.gameimage:
-                new_game.gameimage = Game.resize_image(new_game.gameimage, new_game.gameimage.name, ImageSizeEnum.COVER)
-                new_game.gamethumb = Game.resize_image(new_game.gameimage, new_game.gameimage.name,ImageSizeEnum.THUMBNAIL)
-            new_game.save(update_fields=['title', 'url', 'price','description','gameimage', 'gamethumb'])
+            update_fields = ['title', 'url', 'price', 'description']
+            if 'gameimage' in form.changed_data and new_game.gameimage:
+                #the current cover is kept until game.imagejobs replaces it
+                try:
+                    imagejobs.check_image(new_game.gameimage)
+                except ValueError:
+                    form.add_error('gameimage', 'Image not valid')
+                    return render(request, template_name='game/upload.html', context={'form': form })
+                new_game.gameoriginal = new_game.gameimage
+                update_fields.append('gameoriginal')
+            new_game.save(update_fields=update_fields)
+            if 'gameoriginal' in update_fields:
+                if old_original:
+                    thumbnails.purge(old_original)
+                    default_storage.delete(old_original)
+                imagejobs.enqueue(new_game)
             return redirect(reverse('game:detail', kwargs={'game': new_game.id}))
         else:
             return render(request, template_name='game/upload.html', context={'form': form })
@@ -333,3 +579,26 @@ def rate(request, game):
         return HttpResponse(str(rating))
     else:
         return HttpResponseBadRequest('Only ajax')
+
+@require_http_methods(('GET', 'HEAD'))
+def thumbnail(request, width, height, name):
+    """Serves a thumbnail of an uploaded game image, made on first request, see
+    game.thumbnails.
+
+    Args:
+        width (int): Width of the thumbnail, in pixels.
+        height (int): Height of the thumbnail, in pixels.
+        name (str): Name of the uploaded image in storage.
+
+    :statuscode 200: Success.
+    :statuscode 404: Size not allowed, or image not found.
+    """
+    try:
+        path = thumbnails.get(int(width), int(height), name)
+    except ValueError:
+        raise Http404
+    if path is None:
+        raise Http404
+    response = FileResponse(open(path, 'rb'), content_type=mimetypes.guess_type(path)[0])
+    patch_cache_control(response, public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
@@ -61,6 +61,91 @@ PAYMENT_KEY = '77c3d2e61d46cca01d2b5e18c3c6624e'
 #Email Account Activation time in Seconds
 ACTIVATION_TIME = 3600
 
+#Maximum time in seconds game page views are buffered before written to the database
+VIEWCOUNT_FLUSH_INTERVAL = config('VIEWCOUNT_FLUSH_INTERVAL', default=5, cast=int)
+
+#Maximum number of game page views a process buffers before writing them
+VIEWCOUNT_FLUSH_THRESHOLD = config('VIEWCOUNT_FLUSH_THRESHOLD', default=1000, cast=int)
+
+#Number of scores kept in the game leaderboards, and their cache lifetime in seconds
+LEADERBOARD_SIZE = 10
+LEADERBOARD_TIMEOUT = 60
+
+#Highscore event streams: seconds between checks of the leaderboard, seconds before
+#the stream is closed to free its worker, and milliseconds the browser waits
+#before reconnecting
+HIGHSCORE_STREAM_INTERVAL = config('HIGHSCORE_STREAM_INTERVAL', default=2, cast=float)
+HIGHSCORE_STREAM_DURATION = config('HIGHSCORE_STREAM_DURATION', default=30, cast=float)
+HIGHSCORE_STREAM_RETRY = config('HIGHSCORE_STREAM_RETRY', default=3000, cast=int)
+
+#Cache lifetimes in seconds of the number of games, and of the list of most popular
+#games shown in the home page carousel
+GAME_COUNT_TIMEOUT = 300
+TOP_GAMES_TIMEOUT = 600
+
+#Hours it takes the weight of a sale or view in the trending score of games to halve
+TRENDING_HALF_LIFE = 72
+
+#Weight of a view in the trending score of games, relative to a sale
+TRENDING_VIEW_WEIGHT = 0.05
+
+#Sales and views older than this many half-lives are left out of the trending score
+TRENDING_HORIZON = 8
+
+#Cache lifetime in seconds of the group names of a user, 0 disables caching across
+#requests
+GROUP_CACHE_TIMEOUT = config('GROUP_CACHE_TIMEOUT', default=60, cast=int)
+
+#Number of players also bought recommendations kept for each game
+RECOMMENDATIONS = 6
+
+#Number of worker threads producing covers and thumbnails from uploaded images, 0
+#runs the image jobs in the request
+IMAGE_WORKERS = config('IMAGE_WORKERS', default=2, cast=int)
+
+#Seconds after which a running image job that has not been updated is taken over by
+#the process_image_jobs command, as its worker is assumed to have died
+IMAGE_JOB_TIMEOUT = config('IMAGE_JOB_TIMEOUT', default=600, cast=int)
+
+#Largest number of pixels an uploaded image may have, larger images are rejected
+#before being decoded
+IMAGE_MAX_PIXELS = config('IMAGE_MAX_PIXELS', default=40 * 1000 * 1000, cast=int)
+
+#Widths in pixels of the responsive variants made of each image size, the full
+#width is always included
+IMAGE_VARIANT_WIDTHS = {
+    'COVER': (320, 640, 960),
+    'THUMBNAIL': (250,),
+}
+
+#Sizes, as '<width>x<height>', of the thumbnails game.thumbnails may make on demand
+THUMBNAIL_SIZES = (
+    '250x200',
+    '500x400',
+    '320x180',
+    '640x360',
+    '1280x720',
+)
+
+#Maximum size in bytes of the on-disk cache of on demand thumbnails
+THUMBNAIL_CACHE_MAX_SIZE = config('THUMBNAIL_CACHE_MAX_SIZE', default=256 * 1024 * 1024, cast=int)
+
+#Number of thumbnails a process makes between prunes of the thumbnail cache
+THUMBNAIL_PRUNE_INTERVAL = config('THUMBNAIL_PRUNE_INTERVAL', default=100, cast=int)
+
+#Maximum time in seconds saves and scores sent by games are buffered before written
+#to the database
+SAVE_QUEUE_FLUSH_INTERVAL = config('SAVE_QUEUE_FLUSH_INTERVAL', default=5, cast=int)
+
+#Maximum number of game messages posted in one batch
+GAME_MESSAGE_BATCH_SIZE = 50
+
+#Saved game states larger than this many bytes are stored compressed
+SAVE_STATE_COMPRESS_THRESHOLD = config('SAVE_STATE_COMPRESS_THRESHOLD', default=4 * 1024, cast=int)
+
+#Maximum size in bytes of a saved game state, larger saves are rejected
+SAVE_STATE_MAX_SIZE = config('SAVE_STATE_MAX_SIZE', default=1024 * 1024, cast=int)
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -156,6 +241,22 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+#
+# The buffered view counts of game.viewcount, the pending game saves of
+# game.savequeue, the cached leaderboards and the cached group names of
+# accounts.groups are kept in the cache. The default local memory cache is private
+# to each process, so deployments running more than one process, like gunicorn
+# with several workers, must set CACHE_BACKEND and CACHE_LOCATION to a cache all
+# of them share, such as memcached.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -284,6 +385,8 @@ STATICFILES_DIRS = [
 # https://warehouse.python.org/project/whitenoise/
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
+#Uploads are stored by content hash, and only once, see game.storage
+DEFAULT_FILE_STORAGE = 'game.storage.ContentAddressedStorage'
 MEDIA_ROOT = os.path.join(os.path.dirname(PROJECT_ROOT), "media_cdn")
 
 